@@ -7,6 +7,9 @@ import time
 
 from channel import channel_factory
 from common import const
+from common import metrics
+from common.journal import close_journal
+from common import session_store
 from config import load_config
 from plugins import *
 import threading
@@ -18,6 +21,8 @@ def sigterm_handler_wrap(_signo):
     def func(_signo, _stack_frame):
         logger.info("signal {} received, exiting...".format(_signo))
         conf().save_user_datas()
+        session_store.flush_all() # 会话写入 sqlite，重启后继续
+        close_journal()
         if callable(old_handler):  #  check old_handler
             return old_handler(_signo, _stack_frame)
         sys.exit(0)
@@ -37,6 +42,8 @@ def start_channel(channel_name: str):
             threading.Thread(target=linkai_client.start, args=(channel,)).start()
         except Exception as e:
             pass
+    # 插件加载后重放上次没有处理完的消息
+    channel.replay_journal()
     channel.startup()
 
 
@@ -49,6 +56,9 @@ def run():
         # kill signal
         sigterm_handler_wrap(signal.SIGTERM)
 
+        # 在单独的端口上提供监控指标，和通道自己的 HTTP 服务互不影响
+        metrics.start_server(conf().get("metrics_port", 0), conf().get("metrics_host", "127.0.0.1"))
+
         # create channel
         channel_name = conf().get("channel_type", "wx")
 
@@ -0,0 +1,169 @@
+# encoding:utf-8
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 本地的 OpenAI 兼容接口桩服务，用于压测时代替真实的模型接口，不消耗 token 也不受网络波动影响。
+# 支持的接口：
+#   POST /v1/chat/completions     对话补全，支持 stream
+#   POST /v1/audio/transcriptions 语音转文字，返回固定文本
+# 可以配置的行为：
+#   latency       每个请求的基础延迟（秒）
+#   token_rate    生成速度（token/秒），回复耗时 = latency + completion_tokens / token_rate
+#   tokens        每个回复生成的 token 数
+#   error_rate    返回错误的概率，错误码从 error_codes 中随机选择
+# 单独启动：python -m bench.mock_llm_server --port 18080 --latency 0.5 --token-rate 50 --error-rate 0.01
+
+
+class MockOptions:
+    def __init__(self, latency=0.2, token_rate=100.0, tokens=50, error_rate=0.0, error_codes=(429, 500), stt_latency=0.1):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.stt_latency = stt_latency
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0 # 收到的对话请求数
+        self.errors = 0 # 注入的错误数
+        self.transcriptions = 0 # 收到的语音转文字请求数
+
+    def incr(self, field):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def to_dict(self):
+        with self.lock:
+            return {"requests": self.requests, "errors": self.errors, "transcriptions": self.transcriptions}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # 支持 keep-alive，接近真实接口的连接复用情况
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if path.endswith("/chat/completions"):
+            self._chat(body)
+        elif path.endswith("/audio/transcriptions"):
+            self._transcription()
+        else:
+            self._json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def _chat(self, body):
+        options, stats = self.server.options, self.server.stats
+        stats.incr("requests")
+        request = json.loads(body or b"{}")
+        time.sleep(options.latency)
+        if options.error_rate and random.random() < options.error_rate:
+            stats.incr("errors")
+            code = random.choice(options.error_codes)
+            self._json(code, {"error": {"message": "injected error", "type": "server_error" if code >= 500 else "rate_limit_error"}})
+            return
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in request.get("messages", [])) // 2
+        completion_tokens = options.tokens
+        content = "这是压测桩服务的回复。" + "测" * max(0, completion_tokens - 10)
+        if request.get("stream"):
+            self._stream(request, content, completion_tokens)
+            return
+        time.sleep(completion_tokens / options.token_rate if options.token_rate > 0 else 0)
+        self._json(200, {
+            "id": "chatcmpl-" + uuid.uuid4().hex,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    # 按 token_rate 的速度逐字返回 SSE 格式的流式结果
+    def _stream(self, request, content, completion_tokens):
+        options = self.server.options
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        chunk_id = "chatcmpl-" + uuid.uuid4().hex
+        interval = 1 / options.token_rate if options.token_rate > 0 else 0
+        for ch in content:
+            chunk = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [{"index": 0, "delta": {"content": ch}, "finish_reason": None}],
+            }
+            self.wfile.write("data: {}\n\n".format(json.dumps(chunk, ensure_ascii=False)).encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(interval)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def _transcription(self):
+        self.server.stats.incr("transcriptions")
+        time.sleep(self.server.options.stt_latency)
+        self._json(200, {"text": "这是一条语音消息"})
+
+    def _json(self, code, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, options: MockOptions = None):
+        super().__init__((host, port), _Handler)
+        self.options = options or MockOptions()
+        self.stats = MockStats()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}/v1".format(host, port)
+
+
+# 在后台线程中启动桩服务，port 为 0 时随机选择可用端口
+def start(host="127.0.0.1", port=0, options: MockOptions = None) -> MockLLMServer:
+    server = MockLLMServer(host, port, options)
+    threading.Thread(target=server.serve_forever, name="mock-llm-server", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI compatible mock server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency", type=float, default=0.2, help="base latency of each request in seconds")
+    parser.add_argument("--token-rate", type=float, default=100.0, help="generated tokens per second")
+    parser.add_argument("--tokens", type=int, default=50, help="completion tokens of each reply")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of returning an error")
+    parser.add_argument("--error-codes", default="429,500", help="comma separated status codes used for injected errors")
+    args = parser.parse_args()
+    opts = MockOptions(args.latency, args.token_rate, args.tokens, args.error_rate, [int(c) for c in args.error_codes.split(",")])
+    srv = MockLLMServer(args.host, args.port, opts)
+    print("mock llm server listening on {}".format(srv.base_url))
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,300 @@
+# encoding:utf-8
+
+import argparse
+import json
+import math
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import mock_llm_server
+from bridge.context import ContextType
+from bridge.reply import Reply, ReplyType
+from channel.chat_message import ChatMessage
+from channel.terminal.terminal_channel import TerminalChannel
+from common.singleton import singleton
+from config import conf, load_config
+
+# 压测驱动：用 N 个模拟用户通过真实的 ChatChannel 子类（TerminalChannel）发送消息，
+# ChatGPTBot 指向本地的桩服务（bench/mock_llm_server.py），统计吞吐量、端到端延迟、线程数和内存占用。
+# 每个用户发出一条消息后等待回复再发下一条（可以设置思考时间），用于在相同负载下对比调度、线程池、会话存储等改动的效果。
+# 场景：
+#   single   每个用户单独私聊
+#   group    所有用户在同一个群里 @ 机器人，且群聊共用一个会话（热点会话）
+#   voice    私聊语音消息，经过语音转文字后再调用模型
+#   plugin   私聊文本消息，加载全部插件
+#   mixed    公平性场景：每 5 个用户中 1 个私聊，其余在同一个群里 @ 机器人（每个成员一个会话），
+#            对比群聊和私聊的延迟，检查大群是否挤占了私聊的处理机会
+# 结果中的 fairness_index 是按用户平均延迟计算的 Jain 公平指数（1 表示完全公平），latency_by_kind 按私聊/群聊分别统计延迟
+# 用法：python -m bench.run_bench --scenario single --users 50 --messages 10 --latency 0.5
+
+
+class BenchMessage(ChatMessage):
+    def __init__(self, msg_id, ctype, content, user_id, group_id=None):
+        super().__init__(None)
+        self.msg_id = msg_id
+        self.create_time = int(time.time())
+        self.ctype = ctype
+        self.content = content
+        self.from_user_id = group_id or user_id
+        self.from_user_nickname = user_id
+        self.to_user_id = "bench-bot"
+        self.to_user_nickname = "bot"
+        self.other_user_id = group_id or user_id
+        self.other_user_nickname = group_id or user_id
+        self.is_group = group_id is not None
+        self.is_at = self.is_group
+        self.actual_user_id = user_id
+        self.actual_user_nickname = user_id
+        self.at_list = []
+
+
+# 在 TerminalChannel 的基础上记录回复，不输出到终端
+# 会话队列是 ChatChannel 的类属性，多个实例会共享队列但各自有消费线程，所以和其他通道一样使用单例
+@singleton
+class BenchChannel(TerminalChannel):
+    channel_type = "bench"
+
+    def __init__(self):
+        super().__init__()
+        self.name = "bot"
+        self.user_id = "bench-bot"
+        self.waiters_lock = threading.Lock() # 注意不能命名为 lock，会覆盖 ChatChannel 共享的会话锁
+        self.waiters = {} # msg_id --> [发送时间, Event, 用户, 类别]
+        self.reset()
+
+    # 清空上一轮的统计数据
+    def reset(self):
+        self.latencies = []
+        self.samples = [] # [(类别, 用户, 延迟)]
+        self.errors = 0
+
+    def send(self, reply: Reply, context):
+        msg_id = context["msg"].msg_id
+        with self.waiters_lock:
+            waiter = self.waiters.pop(msg_id, None)
+            if waiter is None:
+                return
+            latency = time.time() - waiter[0]
+            self.latencies.append(latency)
+            self.samples.append((waiter[3], waiter[2], latency))
+            if reply.type == ReplyType.ERROR:
+                self.errors += 1
+        waiter[1].set()
+
+    def request(self, msg: BenchMessage, **kwargs):
+        event = threading.Event()
+        with self.waiters_lock:
+            self.waiters[msg.msg_id] = [time.time(), event, msg.actual_user_id, "group" if msg.is_group else "private"]
+        context = self._compose_context(msg.ctype, msg.content, isgroup=msg.is_group, msg=msg, **kwargs)
+        if context is None or not self.produce(context):
+            with self.waiters_lock:
+                self.waiters.pop(msg.msg_id, None)
+            return False
+        return event
+
+
+def _write_silence(path, seconds=1):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(8000)
+        f.writeframes(b"\x00\x00" * 8000 * seconds)
+
+
+def _percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+# Jain 公平指数：(Σx)² / (n·Σx²)，所有值相等时为 1，越小越不公平
+def _jain(values):
+    if not values:
+        return 1.0
+    square_sum = sum(v * v for v in values)
+    return sum(values) ** 2 / (len(values) * square_sum) if square_sum else 1.0
+
+
+# 按类别统计延迟，并按每个用户的平均延迟计算公平指数
+def _fairness(samples):
+    by_kind = {}
+    by_user = {}
+    for kind, user, latency in samples:
+        by_kind.setdefault(kind, []).append(latency)
+        by_user.setdefault(user, []).append(latency)
+    latency_by_kind = {
+        kind: {
+            "count": len(values),
+            "p50_ms": round(_percentile(values, 50) * 1000, 1),
+            "p95_ms": round(_percentile(values, 95) * 1000, 1),
+            "max_ms": round(max(values) * 1000, 1),
+        }
+        for kind, values in sorted(by_kind.items())
+    }
+    return latency_by_kind, round(_jain([sum(values) / len(values) for values in by_user.values()]), 4)
+
+
+# 读取进程的内存占用（KB），Linux 下读取当前值和峰值，其他系统只能取到峰值
+def _rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(status["VmRSS"].split()[0]), int(status["VmHWM"].split()[0])
+    except Exception:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak //= 1024
+        return peak, peak
+
+
+def _configure(args, base_url):
+    load_config()
+    c = conf()
+    c["model"] = args.model
+    c["open_ai_api_key"] = "sk-bench"
+    c["open_ai_api_base"] = base_url
+    c["rate_limit_chatgpt"] = 0
+    c["single_chat_prefix"] = [""]
+    c["group_chat_prefix"] = ["@bot"]
+    c["group_name_white_list"] = ["bench-group"]
+    c["group_chat_in_one_session"] = ["bench-group"]
+    c["speech_recognition"] = True
+    c["voice_to_text"] = "openai"
+    c["voice_reply_voice"] = False
+    c["always_reply_voice"] = False
+    c["expires_in_seconds"] = 3600
+    if args.concurrency_in_session:
+        c["concurrency_in_session"] = args.concurrency_in_session
+    if args.scenario == "mixed": # 群成员各自一个会话，考察调度器是否按群而不是按会话数量分配处理机会
+        c["group_chat_in_one_session"] = []
+
+
+def _user_loop(channel, scenario, user_index, args, voice_file, workdir, counter):
+    user_id = "user{}".format(user_index)
+    for i in range(args.messages):
+        with counter["lock"]:
+            counter["msg_id"] += 1
+            msg_id = counter["msg_id"]
+        if scenario == "group" or scenario == "mixed" and user_index % 5 != 0:
+            msg = BenchMessage(msg_id, ContextType.TEXT, "@bot 第{}个问题，来自{}".format(i, user_id), user_id, "bench-group")
+        elif scenario == "voice":
+            path = os.path.join(workdir, "{}.wav".format(msg_id)) # 处理完成后语音文件会被删除，每条消息使用一个副本
+            shutil.copy(voice_file, path)
+            msg = BenchMessage(msg_id, ContextType.VOICE, path, user_id)
+        else:
+            msg = BenchMessage(msg_id, ContextType.TEXT, "第{}个问题，来自{}".format(i, user_id), user_id)
+        event = channel.request(msg)
+        if not event:
+            with counter["lock"]:
+                counter["rejected"] += 1
+            continue
+        if not event.wait(args.timeout):
+            with counter["lock"]:
+                counter["timeouts"] += 1
+        if args.think_time:
+            time.sleep(args.think_time)
+
+
+def run(args):
+    options = mock_llm_server.MockOptions(args.latency, args.token_rate, args.tokens, args.error_rate)
+    server = mock_llm_server.start(options=options) if not args.base_url else None
+    base_url = args.base_url or server.base_url
+    _configure(args, base_url)
+    if args.scenario == "plugin":
+        from plugins import PluginManager
+        PluginManager().load_plugins()
+
+    channel = BenchChannel()
+    channel.reset()
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    voice_file = os.path.join(workdir, "voice.wav")
+    _write_silence(voice_file)
+    counter = {"lock": threading.Lock(), "msg_id": 0, "rejected": 0, "timeouts": 0}
+
+    peak_threads = [threading.active_count()]
+    done = threading.Event()
+
+    def monitor(): # 定期采样线程数
+        while not done.is_set():
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            time.sleep(0.1)
+
+    threading.Thread(target=monitor, daemon=True).start()
+    start = time.time()
+    users = [
+        threading.Thread(target=_user_loop, args=(channel, args.scenario, i, args, voice_file, workdir, counter), daemon=True)
+        for i in range(args.users)
+    ]
+    for t in users:
+        t.start()
+    for t in users:
+        t.join()
+    elapsed = time.time() - start
+    done.set()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    rss, peak_rss = _rss_kb()
+    latencies = channel.latencies
+    latency_by_kind, fairness_index = _fairness(channel.samples)
+    result = {
+        "scenario": args.scenario,
+        "users": args.users,
+        "messages": args.users * args.messages,
+        "completed": len(latencies),
+        "rejected": counter["rejected"],
+        "timeouts": counter["timeouts"],
+        "error_replies": channel.errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_msg_s": round(len(latencies) / elapsed, 2) if elapsed else 0,
+        "latency_p50_ms": round(_percentile(latencies, 50) * 1000, 1),
+        "latency_p95_ms": round(_percentile(latencies, 95) * 1000, 1),
+        "latency_p99_ms": round(_percentile(latencies, 99) * 1000, 1),
+        "latency_max_ms": round(max(latencies or [0]) * 1000, 1),
+        "latency_by_kind": latency_by_kind,
+        "fairness_index": fairness_index,
+        "peak_threads": peak_threads[0],
+        "rss_mb": round(rss / 1024, 1),
+        "peak_rss_mb": round(peak_rss / 1024, 1),
+    }
+    if server is not None:
+        result["mock_server"] = server.stats.to_dict()
+        server.shutdown()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chatgpt-on-wechat load benchmark")
+    parser.add_argument("--scenario", choices=["single", "group", "voice", "plugin", "mixed"], default="single")
+    parser.add_argument("--users", type=int, default=20, help="number of simulated users")
+    parser.add_argument("--messages", type=int, default=5, help="messages sent by each user")
+    parser.add_argument("--think-time", type=float, default=0, help="seconds a user waits before sending the next message")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for each reply")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--concurrency-in-session", type=int, default=0, help="override concurrency_in_session")
+    parser.add_argument("--base-url", default="", help="use an already running mock server instead of starting one")
+    parser.add_argument("--latency", type=float, default=0.2, help="mock server base latency in seconds")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="mock server tokens per second")
+    parser.add_argument("--tokens", type=int, default=50, help="mock server completion tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="mock server error probability")
+    parser.add_argument("--json", action="store_true", help="print the result as json")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+        return
+    for key, value in result.items():
+        print("{:<18} {}".format(key, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@ from bot.session_manager import SessionManager # 导入SessionManager类，用
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common import retry
 from common import const
 from config import conf, load_config
 
@@ -23,6 +24,7 @@ class AliQwenBot(Bot): # 定义AliQwenBot类，继承自Bot类
         self.api_key_expired_time = self.set_api_key()  # 设置API密钥的过期时间
         # 初始化会话管理器，使用Qwen模型
         self.sessions = SessionManager(AliQwenSession, model=conf().get("model", const.QWEN))
+        self.retry_policy = retry.get_policy("qwen") # 重试退避和熔断，见 common/retry.py
     # 创建并返回一个AccessTokenClient实例，用于获取API密钥
     def api_key_client(self):
         return broadscope_bailian.AccessTokenClient(access_key_id=self.access_key_id(), access_key_secret=self.access_key_secret())
@@ -69,35 +71,44 @@ class AliQwenBot(Bot): # 定义AliQwenBot类，继承自Bot类
             # 如果没有命令相关的回复，设置用户查询
             session = self.sessions.session_query(query, session_id)
             logger.debug("[QWEN] session query={}".format(session.messages)) # 记录会话查询日志
-            reply_content = self.reply_text(session)  # 获取助手最新的回复
-            logger.debug(
-                "[QWEN] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
+            # 获取助手最新的回复，延后重试时重试的结果同样由 _build_reply 处理
+            return retry.chain(
+                lambda: self.reply_text(session, cancel_token=context.get("cancel_token")),
+                lambda reply_content: self._build_reply(session, reply_content),
             )
-            # 如果回复的tokens为0且内容非空(出现异常)，返回错误类型的回复
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            # 如果回复的tokens大于0，说明回复内容有效
-            elif reply_content["completion_tokens"] > 0:
-                # 把助手最新回复加入self.mesaages列表中
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"]) # 设置文本类型的回复
-            else:  # 如果没有有效的回复内容(特殊异常)
-                reply = Reply(ReplyType.ERROR, reply_content["content"]) # 返回错误类型的回复
-                logger.debug("[QWEN] reply {} used 0 tokens.".format(reply_content))  # 记录无效回复日志
-            return reply # 返回最终的回复内容
 
         else: # 如果消息类型不是文本,返回不支持的错误回复
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: AliQwenSession, retry_count=0) -> dict:
+    # 根据 reply_text 返回的内容构建回复
+    def _build_reply(self, session, reply_content):
+        logger.debug(
+            "[QWEN] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session.session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        # 如果回复的tokens为0且内容非空(出现异常)，返回错误类型的回复
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        # 如果回复的tokens大于0，说明回复内容有效
+        elif reply_content["completion_tokens"] > 0:
+            # 把助手最新回复加入self.mesaages列表中
+            self.sessions.session_reply(reply_content["content"], session.session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"]) # 设置文本类型的回复
+        else:  # 如果没有有效的回复内容(特殊异常)
+            reply = Reply(ReplyType.ERROR, reply_content["content"]) # 返回错误类型的回复
+            logger.debug("[QWEN] reply {} used 0 tokens.".format(reply_content))  # 记录无效回复日志
+        return reply # 返回最终的回复内容
+
+    def reply_text(self, session: AliQwenSession, retry_count=0, cancel_token=None) -> dict:
         # 调用百炼的ChatCompletion接口获取回答,param session: 当前会话对象，包含对话历史
         # param retry_count: 当前的重试次数，默认为0,return: 包含生成内容、token信息的字典
+        if not self.retry_policy.allow(retry_count): # 熔断中，直接返回错误
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
         try:
             # 根据会话中的消息列表生成用户最新的消息和多轮对话(问答对)
             prompt, history = self.convert_messages_format(session.messages)
@@ -107,6 +118,7 @@ class AliQwenBot(Bot): # 定义AliQwenBot类，继承自Bot类
              # 传入应用ID,传入消息提示,传入消息历史,取温度和top_p的较小值
             response = broadscope_bailian.Completions().call(\
                 app_id=self.app_id(), prompt=prompt, history=history,top_p=min(self.temperature(), self.top_p()))
+            self.retry_policy.success()
             # 从API响应中提取生成的内容(助手机器人的回复)
             completion_content = self.get_completion_content(response, self.node_id())
             # 计算助手生成的token数和消息列表和当前助手生成(多轮对话)的总token数
@@ -119,25 +131,24 @@ class AliQwenBot(Bot): # 定义AliQwenBot类，继承自Bot类
             }
         except Exception as e:
             # 如果发生异常，根据异常类型处理不同的错误
+            self.retry_policy.failure(e)
             need_retry = retry_count < 2 # 判断是否需要重试，最多重试2次
+            delay = 0 # 重试前等待的秒数，实际等待时间由重试策略退避计算
             # 默认错误结果，表示服务暂时不可用
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             # 如果是RateLimitError（请求过于频繁），提示用户稍等
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[QWEN] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry: # 如果还可以重试，等待20秒后重试
-                    time.sleep(20)
+                delay = 20
             elif isinstance(e, openai.error.Timeout): # 如果是Timeout（请求超时），提示用户未收到消息
                 logger.warn("[QWEN] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry: # 如果还可以重试，等待5秒后重试
-                    time.sleep(5)
+                delay = 5
             elif isinstance(e, openai.error.APIError): # 如果是APIError（API错误），提示用户稍后再试
                 logger.warn("[QWEN] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                delay = 10
             elif isinstance(e, openai.error.APIConnectionError): # 如果是APIConnectionError（API连接错误），提示无法连接到网络
                 logger.warn("[QWEN] APIConnectionError: {}".format(e))
                 need_retry = False  # 不再重试
@@ -146,10 +157,10 @@ class AliQwenBot(Bot): # 定义AliQwenBot类，继承自Bot类
                 logger.exception("[QWEN] Exception: {}".format(e))
                 need_retry = False # 不再重试
                 self.sessions.clear_session(session.session_id) # 清除当前会话的历史
-            # 如果仍然需要重试，则递归调用 reply_text 进行重试
+            # 如果仍然需要重试，按重试策略等待后重试
             if need_retry:
                 logger.warn("[QWEN] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
+                return self.retry_policy.retry(retry_count, delay, lambda: self.reply_text(session, retry_count + 1, cancel_token), result, cancel_token)
             else:
                 return result # 返回错误结果，或在无法重试时返回默认消息
 
@@ -1,6 +1,6 @@
 # encoding:utf-8
 
-import requests
+from common import http_client
 
 from bot.bot import Bot # 从bot模块导入Bot基类
 from bridge.reply import Reply, ReplyType
@@ -21,7 +21,7 @@ class BaiduUnitBot(Bot):
         print(post_data) # 打印POST数据，便于调试
         # 设置请求头，指定内容类型为"application/x-www-form-urlencoded"
         headers = {"content-type": "application/x-www-form-urlencoded"}
-        response = requests.post(url, data=post_data.encode(), headers=headers) # 发送POST请求到百度Unit对话接口
+        response = http_client.post(url, data=post_data.encode(), headers=headers) # 发送POST请求到百度Unit对话接口
         if response: # 如果请求成功，处理响应并生成Reply对象
             # 从响应中提取返回的内容，并创建一个文本回复对象
             reply = Reply(
@@ -36,7 +36,7 @@ class BaiduUnitBot(Bot):
         secret_key = "YOUR_SECRET_KEY"
         # 构造获取访问令牌的请求URL，使用client_credentials授权模式
         host = "https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id=" + access_key + "&client_secret=" + secret_key
-        response = requests.get(host) # 发送GET请求获取访问令牌
+        response = http_client.get(host) # 发送GET请求获取访问令牌
         if response:# 如果响应成功，返回响应中的access_token
             print(response.json())  # 打印返回的JSON响应，方便调试
             return response.json()["access_token"] # 返回从响应中提取的访问令牌
@@ -1,6 +1,6 @@
 # encoding:utf-8
 
-import requests
+from common import http_client
 import json
 from common import const
 from bot.bot import Bot
@@ -94,7 +94,7 @@ class BaiduWenxinBot(Bot):
             # 准备请求数据，根据是否启用系统提示，选择不同的消息结构
             payload = {'messages': session.messages, 'system': self.prompt} if self.prompt_enabled else {'messages': session.messages}
             # 向百度文心API发送POST请求,dumps将python字典对象变成json字符串
-            response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+            response = http_client.request("POST", url, headers=headers, data=json.dumps(payload))
             response_text = json.loads(response.text) # 解析API返回的JSON响应,loads将json字符串变成python字典
             logger.info(f"[BAIDU] response text={response_text}")  # 记录返回的响应数据，方便调试
             res_content = response_text["result"]  # 从响应中提取内容、总令牌数和完成令牌数
@@ -119,4 +119,4 @@ class BaiduWenxinBot(Bot):
         # 定义请求参数，包括授权类型、客户端ID和客户端密钥
         params = {"grant_type": "client_credentials", "client_id": BAIDU_API_KEY, "client_secret": BAIDU_SECRET_KEY}
         # 向百度OAuth 2.0 API发送POST请求，并从响应中提取访问令牌
-        return str(requests.post(url, params=params).json().get("access_token"))
+        return str(http_client.post(url, params=params).json().get("access_token"))
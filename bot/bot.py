@@ -1,8 +1,19 @@
 from bridge.context import Context
 from bridge.reply import Reply
+from common import metrics
+
+# 调用模型接口的指标，bot 标签为模型类型，每次 HTTP 请求（包括重试）记录一次
+REQUEST_SECONDS = metrics.histogram("bot_request_seconds", "Latency of a single request to the model API", ["bot"])
+REQUEST_ERRORS = metrics.counter("bot_request_errors_total", "Failed requests to the model API", ["bot"])
+REQUEST_RETRIES = metrics.counter("bot_request_retries_total", "Retried requests to the model API", ["bot"])
 
 # bot基类
 class Bot(object):
     def reply(self, query, context: Context = None) -> Reply: # 回复方法
         
         raise NotImplementedError
+    # 异步回复方法，异步模式（async_mode）下使用。默认在 llm 线程池中运行同步的 reply，
+    # 已经接入异步 HTTP 客户端的 bot 会重写这个方法，这样等待模型返回时不会占用线程
+    async def areply(self, query, context: Context = None) -> Reply:
+        from common.async_loop import run_sync
+        return await run_sync("llm", self.reply, query, context)
@@ -1,33 +1,42 @@
 # encoding:utf-8
-import time
 import openai
 import openai.error
 import requests
+from common import http_client
 from common import const
-from bot.bot import Bot
+from bot.bot import Bot, REQUEST_ERRORS, REQUEST_RETRIES, REQUEST_SECONDS
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.openai.open_ai_image import OpenAIImage # 导入OpenAI图像生成类
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
-from bridge.reply import Reply, ReplyType
+from bridge.reply import Reply, ReplyStream, ReplyType
 from common.log import logger
+from common.async_loop import run_sync
+from common import cancellation
+from common import hedge
+from common import retry
 from common.token_bucket import TokenBucket  # 导入令牌桶限流工具
 from config import conf, load_config
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
 # OpenAI对话模型API
 class ChatGPTBot(Bot, OpenAIImage):
+    MAX_RETRIES = 2 # 请求出错后的最多重试次数
+
     def __init__(self):
         super().__init__() # 调用父类初始化方法
          # 设置OpenAI的API密钥
         openai.api_key = conf().get("open_ai_api_key")
         if conf().get("open_ai_api_base"): # 如果配置了自定义API地址，进行设置
             openai.api_base = conf().get("open_ai_api_base")
+        openai.requestssession = http_client.new_session(proxy=True) # 同步请求使用独立的连接池保持长连接，代理设置在会话上
         proxy = conf().get("proxy")  # 获取代理配置
         if proxy:
             openai.proxy = proxy # 设置代理
         if conf().get("rate_limit_chatgpt"):  # 如果配置了限速功能
             self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20)) # 初始化令牌桶
+        self.hedger = hedge.Hedger("chatgpt") # 对冲请求，见 common/hedge.py
+        self.retry_policy = retry.get_policy("chatgpt") # 重试退避和熔断，见 common/retry.py
         conf_model = conf().get("model") or "gpt-3.5-turbo" # 设置默认模型
         # 初始化会话管理器
         self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
@@ -52,54 +61,18 @@ class ChatGPTBot(Bot, OpenAIImage):
     def reply(self, query, context=None):
         if context.type == ContextType.TEXT: # 如果是文本请求
             logger.info("[CHATGPT] query={}".format(query))  # 记录日志
-
-            session_id = context["session_id"] # 获取会话ID
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"]) # 获取清除记忆命令列表
-            if query in clear_memory_commands:  # 如果请求为清除记忆
-                self.sessions.clear_session(session_id) # 清除当前会话
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":  # 如果请求为清除所有会话
-                self.sessions.clear_all_session() # 清空所有会话
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":  # 如果请求为更新配置
-                load_config() # 重新加载配置
-                reply = Reply(ReplyType.INFO, "配置已更新")
-            if reply: # 有回复说明是上述指令
+            reply = self._reply_command(query, context["session_id"])
+            if reply: # 有回复说明是清除记忆等指令
                 return reply 
-            #  构建会话,并把用户消息添加进消息列表
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[CHATGPT] session query={}".format(session.messages)) # 记录会话内容
-            api_key = context.get("openai_api_key")  # 获取上下文中的API密钥
-            model = context.get("gpt_model") # 获取指定的模型
-            new_args = None
-            if model:
-                new_args = self.args.copy() # 复制参数
-                new_args["model"] = model # 使用指定模型
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
-            reply_content = self.reply_text(session, api_key, args=new_args)  # 调用生成文本方法
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
+            session, api_key, new_args = self._prepare_query(query, context)
+            retry_count = self._first_retry(context)
+            if context.get("stream"): # 通道支持流式输出时，边生成边返回
+                return self.reply_text_stream(session, api_key, args=new_args, retry_count=retry_count, cancel_token=context.get("cancel_token"))
+            # 调用生成文本方法，延后重试时重试的结果同样由 _build_reply 处理
+            return retry.chain(
+                lambda: self._hedged_reply_text(session, api_key, new_args, retry_count, context.get("cancel_token")),
+                lambda reply_content: self._build_reply(session, reply_content),
             )
-            # 如果出现异常,并且有错误消息
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            # 如果正常生成
-            elif reply_content["completion_tokens"] > 0:
-                # 把回复消息添加到消息列表
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else: # 这种情况没有消息,也是出错
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
         
         elif context.type == ContextType.IMAGE_CREATE: # 如果是图像生成请求
             ok, retstring = self.create_img(query, 0) # 调用图像生成方法
@@ -114,15 +87,108 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+    # 异步获取回复内容，文本请求直接使用 openai 的异步接口，其他类型的请求仍然在线程池中同步处理
+    async def areply(self, query, context=None):
+        if context.type != ContextType.TEXT or context.get("stream"): # 流式回复在线程池中建立请求，由通道在 send 池中逐段读取
+            return await super().areply(query, context)
+        logger.info("[CHATGPT] query={}".format(query))
+        reply = self._reply_command(query, context["session_id"])
+        if reply:
+            return reply
+        session, api_key, new_args = self._prepare_query(query, context)
+        reply_content = await self._ahedged_reply_text(session, api_key, new_args, self._first_retry(context))
+        return self._build_reply(session, reply_content)
+
+    # 处理清除记忆、清除所有、更新配置等指令，不是指令时返回 None
+    def _reply_command(self, query, session_id):
+        reply = None
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"]) # 获取清除记忆命令列表
+        if query in clear_memory_commands:  # 如果请求为清除记忆
+            self.sessions.clear_session(session_id) # 清除当前会话
+            reply = Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":  # 如果请求为清除所有会话
+            self.sessions.clear_all_session() # 清空所有会话
+            reply = Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":  # 如果请求为更新配置
+            load_config() # 重新加载配置
+            reply = Reply(ReplyType.INFO, "配置已更新")
+        return reply
+
+    # 请求的初始重试次数：路由（见 bridge/provider_router.py）还有其他服务可以转移时不重试，出错后直接转移，避免等待重试
+    def _first_retry(self, context):
+        return self.MAX_RETRIES if context.get("failover") else 0
+
+    # 构建会话并把用户消息添加进消息列表，返回会话、API密钥和本次请求的参数
+    def _prepare_query(self, query, context):
+        session = self.sessions.session_query(query, context["session_id"])
+        logger.debug("[CHATGPT] session query={}".format(session.messages)) # 记录会话内容
+        api_key = context.get("openai_api_key")  # 获取上下文中的API密钥
+        model = context.get("gpt_model") # 获取指定的模型
+        new_args = None
+        if model:
+            new_args = self.args.copy() # 复制参数
+            new_args["model"] = model # 使用指定模型
+        return session, api_key, new_args
+
+    # 调用 reply_text，开启对冲请求时超过等待时间还没有返回会再发出一个相同的请求。
+    # 回复字典中的 attempt 为胜出的请求，0 为原始请求，1 为对冲请求，token 用量是胜出的请求的用量
+    def _hedged_reply_text(self, session, api_key, args, retry_count, cancel_token):
+        if not hedge.enabled("same"):
+            reply_content, attempt = self.reply_text(session, api_key, args, retry_count, cancel_token), 0
+        else:
+            call = lambda token: self.reply_text(session, api_key, args, retry_count, token)
+            reply_content, attempt = self.hedger.run([call, call], _succeeded, cancel_token)
+        reply_content["attempt"] = attempt
+        return reply_content
+
+    # _hedged_reply_text 的异步版本，没有胜出的请求直接取消
+    async def _ahedged_reply_text(self, session, api_key, args, retry_count):
+        if not hedge.enabled("same"):
+            reply_content, attempt = await self.areply_text(session, api_key, args, retry_count), 0
+        else:
+            call = lambda token: self.areply_text(session, api_key, args, retry_count)
+            reply_content, attempt = await self.hedger.arun([call, call], _succeeded)
+        reply_content["attempt"] = attempt
+        return reply_content
+
+    # 根据模型返回的结果构建回复，正常生成时把回复添加到会话的消息列表
+    def _build_reply(self, session, reply_content):
+        session_id = session.session_id
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}, attempt={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+                reply_content.get("attempt", 0),
+            )
+        )
+        # 如果出现异常,并且有错误消息
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        # 如果正常生成
+        elif reply_content["completion_tokens"] > 0:
+            # 把回复消息添加到消息列表
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else: # 这种情况没有消息,也是出错
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0, cancel_token=None) -> dict:
         """
         调用OpenAI的ChatCompletion获取回答
         :param session: 会话对象
         :param api_key: API密钥
         :param args: 请求参数
         :param retry_count: 当前重试次数
+        :param cancel_token: 消息的取消标记，取消后不再发起请求和重试，已返回的结果也会被丢弃
         :return: 回复内容的字典
         """
+        cancellation.check(cancel_token)
+        if not self.retry_policy.allow(retry_count): # 熔断中，直接返回错误
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
         try:
             # 如果设置了生成速率限制,并且当前没获取到token
             if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
@@ -131,48 +197,132 @@ class ChatGPTBot(Bot, OpenAIImage):
             if args is None:
                 args = self.args
             # 调用OpenAI的ChatCompletion API获取回答
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+            with REQUEST_SECONDS.time(bot="chatgpt"):
+                response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+            self.retry_policy.success()
+            cancellation.check(cancel_token) # 等待返回期间消息被取消，丢弃结果
             # logger.debug("[CHATGPT] response={}".format(response))
             # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"], # 消息列表中的总token数
-                "completion_tokens": response["usage"]["completion_tokens"], # 助手新生成的token数
-                "content": response.choices[0]["message"]["content"], # 助手生成文本
-            }
+            return self._parse_response(response)
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}  # 默认的错误回复内容
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError): # 处理API连接错误
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
-            else: # 其他错误
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False # 非常规错误不重试
-                self.sessions.clear_session(session.session_id) # 清除当前会话
-            # 如果允许重试，递归调用自身
+            REQUEST_ERRORS.inc(bot="chatgpt")
+            self.retry_policy.failure(e)
+            result, need_retry, delay = self._handle_error(e, session, retry_count)
+            # 如果允许重试，按退避策略等待后重试，等待期间消息被取消时立即结束，不再重试
             if need_retry:
+                REQUEST_RETRIES.inc(bot="chatgpt")
                 logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
+                return self.retry_policy.retry(retry_count, delay, lambda: self.reply_text(session, api_key, args, retry_count + 1, cancel_token), result, cancel_token)
             else:
                 return result # 返回最终失败的结果
 
+    def reply_text_stream(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0, cancel_token=None) -> Reply:
+        """
+        以流式方式调用OpenAI的ChatCompletion，建立请求失败时和 reply_text 一样重试
+        :param session: 会话对象
+        :param api_key: API密钥
+        :param args: 请求参数
+        :param retry_count: 当前重试次数
+        :param cancel_token: 消息的取消标记，读取每个片段前检查，取消后停止读取
+        :return: 流式回复，建立请求失败时返回错误回复
+        """
+        cancellation.check(cancel_token)
+        if not self.retry_policy.allow(retry_count):
+            return Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+        try:
+            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            if args is None:
+                args = self.args
+            with REQUEST_SECONDS.time(bot="chatgpt"): # 流式请求只统计到开始返回为止
+                response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, stream=True, **args)
+            self.retry_policy.success()
+        except Exception as e:
+            REQUEST_ERRORS.inc(bot="chatgpt")
+            self.retry_policy.failure(e)
+            result, need_retry, delay = self._handle_error(e, session, retry_count)
+            if need_retry:
+                REQUEST_RETRIES.inc(bot="chatgpt")
+                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
+                return self.retry_policy.retry(retry_count, delay, lambda: self.reply_text_stream(session, api_key, args, retry_count + 1, cancel_token),
+                                               Reply(ReplyType.ERROR, result["content"]), cancel_token)
+            return Reply(ReplyType.ERROR, result["content"])
+
+        def deltas():
+            for chunk in response:
+                cancellation.check(cancel_token)
+                if chunk.choices:
+                    yield chunk.choices[0].get("delta", {}).get("content")
+
+        # 完整生成后才把回复添加到会话，流式接口不返回token用量，由会话自己计算
+        stream = ReplyStream(deltas(), error_text="我现在有点累了，等会再来吧")
+        stream.on_complete = lambda text: self.sessions.session_reply(text, session.session_id)
+        return Reply(ReplyType.STREAM, stream)
+
+    # reply_text 的异步版本，使用 openai 的异步接口，重试等待时不占用线程
+    async def areply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+        if not self.retry_policy.allow(retry_count):
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        try:
+            if conf().get("rate_limit_chatgpt") and not await run_sync("llm", self.tb4chatgpt.get_token):
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            if args is None:
+                args = self.args
+            with REQUEST_SECONDS.time(bot="chatgpt"):
+                response = await openai.ChatCompletion.acreate(api_key=api_key, messages=session.messages, **args)
+            self.retry_policy.success()
+            return self._parse_response(response)
+        except Exception as e:
+            REQUEST_ERRORS.inc(bot="chatgpt")
+            self.retry_policy.failure(e)
+            result, need_retry, delay = self._handle_error(e, session, retry_count)
+            if need_retry:
+                REQUEST_RETRIES.inc(bot="chatgpt")
+                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
+                return await self.retry_policy.aretry(retry_count, delay, lambda: self.areply_text(session, api_key, args, retry_count + 1), result)
+            else:
+                return result
+
+    # 从 ChatCompletion 的响应中取出回复内容和token用量
+    def _parse_response(self, response) -> dict:
+        return {
+            "total_tokens": response["usage"]["total_tokens"], # 消息列表中的总token数
+            "completion_tokens": response["usage"]["completion_tokens"], # 助手新生成的token数
+            "content": response.choices[0]["message"]["content"], # 助手生成文本
+        }
+
+    # 根据异常类型生成错误回复，并判断是否需要重试以及重试前的等待秒数
+    def _handle_error(self, e, session, retry_count):
+        need_retry = retry_count < self.MAX_RETRIES
+        delay = 0
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}  # 默认的错误回复内容
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            delay = 20
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            delay = 5
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            delay = 10
+        elif isinstance(e, openai.error.APIConnectionError): # 处理API连接错误
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+            delay = 5
+        else: # 其他错误
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            need_retry = False # 非常规错误不重试
+            self.sessions.clear_session(session.session_id) # 清除当前会话
+        return result, need_retry, delay
+
+
+# reply_text 返回的是正常生成的回复
+def _succeeded(reply_content):
+    return reply_content.get("completion_tokens", 0) > 0
+
 
 class AzureChatGPTBot(ChatGPTBot): 
     def __init__(self):
@@ -197,13 +347,13 @@ class AzureChatGPTBot(ChatGPTBot):
             try:
                 # 请求体包含提示词、图片大小和生成数量
                 body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body, proxy=True)
                 operation_location = submission.headers['operation-location'] # 获取操作位置，用于查询任务状态
                 status = "" 
                 while (status != "succeeded"): # 当status为succeeded时退出循环，表示成功
                     if retry_count > 3: # 超过3次失败,返回图片生成失败
                         return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
+                    response = http_client.get(operation_location, headers=headers, proxy=True)
                     status = response.json()['status']
                     retry_count += 1
                 image_url = response.json()['result']['data'][0]['url'] # 声称图片的url
@@ -224,7 +374,7 @@ class AzureChatGPTBot(ChatGPTBot):
                 # 请求体包含提示词、图片大小和质量
                 body = {"prompt": query, "size": conf().get("image_create_size", "1024x1024"), "quality": conf().get(\
                     "dalle3_image_quality", "standard")}
-                response = requests.post(url, headers=headers, json=body)
+                response = http_client.post(url, headers=headers, json=body, proxy=True)
                 response.raise_for_status()  # 检查请求是否成功
                 data = response.json()
                 # 检查响应中是否包含图像 URL
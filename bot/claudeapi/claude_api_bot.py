@@ -1,6 +1,5 @@
 # encoding:utf-8
 
-import time
 
 import openai
 import openai.error
@@ -13,6 +12,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common import retry
 from common import const
 from config import conf
 
@@ -31,6 +31,7 @@ class ClaudeAPIBot(Bot, OpenAIImage):
             base_url=base_url if base_url else None
         )
         self.sessions = SessionManager(BaiduWenxinSession, model=conf().get("model") or "text-davinci-003")
+        self.retry_policy = retry.get_policy("claude_api") # 重试退避和熔断，见 common/retry.py
 
     def reply(self, query, context=None):
         # acquire reply content
@@ -47,22 +48,11 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.INFO, "所有人记忆已清除")
                 else:
                     session = self.sessions.session_query(query, session_id)
-                    result = self.reply_text(session)
-                    logger.info(result)
-                    total_tokens, completion_tokens, reply_content = (
-                        result["total_tokens"],
-                        result["completion_tokens"],
-                        result["content"],
+                    # 延后重试时重试的结果同样由 _build_reply 处理
+                    reply = retry.chain(
+                        lambda: self.reply_text(session, cancel_token=context.get("cancel_token")),
+                        lambda result: self._build_reply(session, result),
                     )
-                    logger.debug(
-                        "[CLAUDE_API] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(str(session), session_id, reply_content, completion_tokens)
-                    )
-
-                    if total_tokens == 0:
-                        reply = Reply(ReplyType.ERROR, reply_content)
-                    else:
-                        self.sessions.session_reply(reply_content, session_id, total_tokens)
-                        reply = Reply(ReplyType.TEXT, reply_content)
                 return reply
             elif context.type == ContextType.IMAGE_CREATE:
                 ok, retstring = self.create_img(query, 0)
@@ -73,7 +63,25 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
-    def reply_text(self, session: BaiduWenxinSession, retry_count=0):
+    def _build_reply(self, session, result):
+        logger.info(result)
+        total_tokens, completion_tokens, reply_content = (
+            result["total_tokens"],
+            result["completion_tokens"],
+            result["content"],
+        )
+        logger.debug(
+            "[CLAUDE_API] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(str(session), session.session_id, reply_content, completion_tokens)
+        )
+
+        if total_tokens == 0:
+            return Reply(ReplyType.ERROR, reply_content)
+        self.sessions.session_reply(reply_content, session.session_id, total_tokens)
+        return Reply(ReplyType.TEXT, reply_content)
+
+    def reply_text(self, session: BaiduWenxinSession, retry_count=0, cancel_token=None):
+        if not self.retry_policy.allow(retry_count): # 熔断中，直接返回错误
+            return {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
         try:
             actual_model = self._model_mapping(conf().get("model"))
             response = self.claudeClient.messages.create(
@@ -82,6 +90,7 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 system=conf().get("character_desc", ""),
                 messages=session.messages
             )
+            self.retry_policy.success()
             # response = openai.Completion.create(prompt=str(session), **self.args)
             res_content = response.content[0].text.strip().replace("<|endoftext|>", "")
             total_tokens = response.usage.input_tokens+response.usage.output_tokens
@@ -93,18 +102,18 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 "content": res_content,
             }
         except Exception as e:
+            self.retry_policy.failure(e)
             need_retry = retry_count < 2
+            delay = 0
             result = {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                delay = 20
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[CLAUDE_API] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                delay = 5
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
                 need_retry = False
@@ -116,7 +125,7 @@ class ClaudeAPIBot(Bot, OpenAIImage):
 
             if need_retry:
                 logger.warn("[CLAUDE_API] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
+                return self.retry_policy.retry(retry_count, delay, lambda: self.reply_text(session, retry_count + 1, cancel_token), result, cancel_token)
             else:
                 return result
 
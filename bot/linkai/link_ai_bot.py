@@ -3,14 +3,17 @@
 
 import re
 import time
-import requests
+from common import http_client
 import config
-from bot.bot import Bot
+from bot.bot import Bot, REQUEST_ERRORS, REQUEST_RETRIES, REQUEST_SECONDS
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common import cancellation
+from common import retry
+from common.async_loop import get_http_session, http_timeout
 from config import conf, pconf
 import threading
 from common import memory, utils
@@ -26,6 +29,7 @@ class LinkAIBot(Bot):
         super().__init__()
         self.sessions = LinkAISessionManager(LinkAISession, model=conf().get("model") or "gpt-3.5-turbo")
         self.args = {}
+        self.retry_policy = retry.get_policy("linkai") # 重试退避和熔断，见 common/retry.py
 
     def reply(self, query, context: Context = None) -> Reply:
         if context.type == ContextType.TEXT:
@@ -44,6 +48,12 @@ class LinkAIBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    # 异步获取回复内容，文本对话通过 aiohttp 直接调用接口，其他请求仍然在线程池中同步处理
+    async def areply(self, query, context: Context = None) -> Reply:
+        if context.type == ContextType.TEXT:
+            return await self._achat(query, context)
+        return await super().areply(query, context)
+
     def _chat(self, query, context, retry_count=0) -> Reply:
         """
         发起对话请求
@@ -57,124 +67,178 @@ class LinkAIBot(Bot):
             logger.warn("[LINKAI] failed after maximum number of retry times")
             return Reply(ReplyType.TEXT, "请再问我一次吧")
 
+        cancel_token = context.get("cancel_token")
+        cancellation.check(cancel_token)
+        if not self.retry_policy.allow(retry_count): # 熔断中，直接返回错误
+            return Reply(ReplyType.TEXT, "请再问我一次吧")
         try:
-            # load config
-            if context.get("generate_breaked_by"):
-                logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
-                app_code = None
-            else:
-                plugin_app_code = self._find_group_mapping_code(context)
-                app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
-            linkai_api_key = conf().get("linkai_api_key")
-
-            session_id = context["session_id"]
-            session_message = self.sessions.session_msg_query(query, session_id)
-            logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
+            url, body, headers, session_id = self._build_chat_request(query, context)
+            # do http request
+            with REQUEST_SECONDS.time(bot="linkai"):
+                res = http_client.post(url=url, json=body, headers=headers,
+                                    timeout=conf().get("request_timeout", 180))
+            cancellation.check(cancel_token) # cancelled while waiting for the response, drop it
+            reply = self._handle_chat_response(res.status_code, res.json(), query, context, session_id, body)
+            if reply:
+                if res.status_code < 400: # 4xx errors are caused by the request itself, not counted by the circuit breaker
+                    self.retry_policy.success()
+                return reply
+            # server error, need retry
+            REQUEST_ERRORS.inc(bot="linkai")
+            self.retry_policy.failure()
+        except Exception as e:
+            logger.exception(e)
+            REQUEST_ERRORS.inc(bot="linkai")
+            self.retry_policy.failure(e)
+        # retry
+        REQUEST_RETRIES.inc(bot="linkai")
+        logger.warn(f"[LINKAI] do retry, times={retry_count}")
+        return self.retry_policy.retry(retry_count, 2, lambda: self._chat(query, context, retry_count + 1),
+                                       Reply(ReplyType.TEXT, "请再问我一次吧"), cancel_token)
+
+    # _chat 的异步版本，使用共享的 aiohttp 会话发送请求，重试等待时不占用线程
+    async def _achat(self, query, context, retry_count=0) -> Reply:
+        if retry_count > 2:
+            logger.warn("[LINKAI] failed after maximum number of retry times")
+            return Reply(ReplyType.TEXT, "请再问我一次吧")
+        if not self.retry_policy.allow(retry_count):
+            return Reply(ReplyType.TEXT, "请再问我一次吧")
 
-            # image process
-            img_cache = memory.USER_IMAGE_CACHE.get(session_id)
-            if img_cache:
-                messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
-                if messages:
-                    session_message = messages
-
-            model = conf().get("model")
-            # remove system message
-            if session_message[0].get("role") == "system":
-                if app_code or model == "wenxin":
-                    session_message.pop(0)
-            body = {
-                "app_code": app_code,
-                "messages": session_message,
-                "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
-                "temperature": conf().get("temperature"),
-                "top_p": conf().get("top_p", 1),
-                "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "session_id": session_id,
-                "sender_id": session_id,
-                "channel_type": conf().get("channel_type", "wx")
-            }
-            try:
-                from linkai import LinkAIClient
-                client_id = LinkAIClient.fetch_client_id()
-                if client_id:
-                    body["client_id"] = client_id
-                    # start: client info deliver
-                    if context.kwargs.get("msg"):
-                        body["session_id"] = context.kwargs.get("msg").from_user_id
-                        if context.kwargs.get("msg").is_group:
-                            body["is_group"] = True
-                            body["group_name"] = context.kwargs.get("msg").from_user_nickname
-                            body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
+        try:
+            url, body, headers, session_id = self._build_chat_request(query, context)
+            http_session = await get_http_session()
+            with REQUEST_SECONDS.time(bot="linkai"):
+                async with http_session.post(url, json=body, headers=headers,
+                                             timeout=http_timeout(conf().get("request_timeout", 180))) as res:
+                    reply = self._handle_chat_response(res.status, await res.json(content_type=None), query, context, session_id, body)
+            if reply:
+                if res.status < 400:
+                    self.retry_policy.success()
+                return reply
+            REQUEST_ERRORS.inc(bot="linkai")
+            self.retry_policy.failure()
+        except Exception as e:
+            logger.exception(e)
+            REQUEST_ERRORS.inc(bot="linkai")
+            self.retry_policy.failure(e)
+        REQUEST_RETRIES.inc(bot="linkai")
+        logger.warn(f"[LINKAI] do retry, times={retry_count}")
+        return await self.retry_policy.aretry(retry_count, 2, lambda: self._achat(query, context, retry_count + 1),
+                                              Reply(ReplyType.TEXT, "请再问我一次吧"))
+
+    def _build_chat_request(self, query, context):
+        """
+        构建对话请求
+        :return: 请求地址、请求体、请求头和会话id
+        """
+        # load config
+        if context.get("generate_breaked_by"):
+            logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
+            app_code = None
+        else:
+            plugin_app_code = self._find_group_mapping_code(context)
+            app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
+        linkai_api_key = conf().get("linkai_api_key")
+
+        session_id = context["session_id"]
+        session_message = self.sessions.session_msg_query(query, session_id)
+        logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
+
+        # image process
+        img_cache = memory.USER_IMAGE_CACHE.get(session_id)
+        if img_cache:
+            messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
+            if messages:
+                session_message = messages
+
+        model = conf().get("model")
+        # remove system message
+        if session_message[0].get("role") == "system":
+            if app_code or model == "wenxin":
+                session_message.pop(0)
+        body = {
+            "app_code": app_code,
+            "messages": session_message,
+            "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
+            "temperature": conf().get("temperature"),
+            "top_p": conf().get("top_p", 1),
+            "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "session_id": session_id,
+            "sender_id": session_id,
+            "channel_type": conf().get("channel_type", "wx")
+        }
+        try:
+            from linkai import LinkAIClient
+            client_id = LinkAIClient.fetch_client_id()
+            if client_id:
+                body["client_id"] = client_id
+                # start: client info deliver
+                if context.kwargs.get("msg"):
+                    body["session_id"] = context.kwargs.get("msg").from_user_id
+                    if context.kwargs.get("msg").is_group:
+                        body["is_group"] = True
+                        body["group_name"] = context.kwargs.get("msg").from_user_nickname
+                        body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
+                    else:
+                        if body.get("channel_type") in ["wechatcom_app"]:
+                            body["sender_name"] = context.kwargs.get("msg").from_user_id
                         else:
-                            if body.get("channel_type") in ["wechatcom_app"]:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_id
-                            else:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_nickname
-
-            except Exception as e:
-                pass
-            file_id = context.kwargs.get("file_id")
-            if file_id:
-                body["file_id"] = file_id
-            logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
-            headers = {"Authorization": "Bearer " + linkai_api_key}
+                            body["sender_name"] = context.kwargs.get("msg").from_user_nickname
 
-            # do http request
-            base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
-            if res.status_code == 200:
-                # execute success
-                response = res.json()
-                reply_content = response["choices"][0]["message"]["content"]
-                total_tokens = response["usage"]["total_tokens"]
-                res_code = response.get('code')
-                logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
-                if res_code == 429:
-                    logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
-                else:
-                    self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
-                agent_suffix = self._fetch_agent_suffix(response)
-                if agent_suffix:
-                    reply_content += agent_suffix
-                if not agent_suffix:
-                    knowledge_suffix = self._fetch_knowledge_search_suffix(response)
-                    if knowledge_suffix:
-                        reply_content += knowledge_suffix
-                # image process
-                if response["choices"][0].get("img_urls"):
-                    thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
-                    thread.start()
-                    if response["choices"][0].get("text_content"):
-                        reply_content = response["choices"][0].get("text_content")
-                reply_content = self._process_url(reply_content)
-                return Reply(ReplyType.TEXT, reply_content)
+        except Exception as e:
+            pass
+        file_id = context.kwargs.get("file_id")
+        if file_id:
+            body["file_id"] = file_id
+        logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
+        headers = {"Authorization": "Bearer " + linkai_api_key}
+        base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
+        return base_url + "/v1/chat/completions", body, headers, session_id
 
+    def _handle_chat_response(self, status_code, response, query, context, session_id, body):
+        """
+        处理对话接口的响应
+        :return: 回复，服务端错误需要重试时返回 None
+        """
+        if status_code == 200:
+            # execute success
+            reply_content = response["choices"][0]["message"]["content"]
+            total_tokens = response["usage"]["total_tokens"]
+            res_code = response.get('code')
+            logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
+            if res_code == 429:
+                logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
             else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                if res.status_code >= 500:
-                    # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
-
-                error_reply = "提问太快啦，请休息一下再问我吧"
-                if res.status_code == 409:
-                    error_reply = "这个问题我还没有学会，请问我其它问题吧"
-                return Reply(ReplyType.TEXT, error_reply)
+                self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
+            agent_suffix = self._fetch_agent_suffix(response)
+            if agent_suffix:
+                reply_content += agent_suffix
+            if not agent_suffix:
+                knowledge_suffix = self._fetch_knowledge_search_suffix(response)
+                if knowledge_suffix:
+                    reply_content += knowledge_suffix
+            # image process
+            if response["choices"][0].get("img_urls"):
+                thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
+                thread.start()
+                if response["choices"][0].get("text_content"):
+                    reply_content = response["choices"][0].get("text_content")
+            reply_content = self._process_url(reply_content)
+            return Reply(ReplyType.TEXT, reply_content)
+
+        error = response.get("error")
+        logger.error(f"[LINKAI] chat failed, status_code={status_code}, "
+                     f"msg={error.get('message')}, type={error.get('type')}")
+
+        if status_code >= 500:
+            # server error, need retry
+            return None
 
-        except Exception as e:
-            logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+        error_reply = "提问太快啦，请休息一下再问我吧"
+        if status_code == 409:
+            error_reply = "这个问题我还没有学会，请问我其它问题吧"
+        return Reply(ReplyType.TEXT, error_reply)
 
     def _process_image_msg(self, app_code: str, session_id: str, query:str, img_cache: dict):
         try:
@@ -237,14 +301,17 @@ class LinkAIBot(Bot):
             logger.exception(e)
 
     def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0) -> dict:
+        failed = {
+            "total_tokens": 0,
+            "completion_tokens": 0,
+            "content": "请再问我一次吧"
+        }
         if retry_count >= 2:
             # exit from retry 2 times
             logger.warn("[LINKAI] failed after maximum number of retry times")
-            return {
-                "total_tokens": 0,
-                "completion_tokens": 0,
-                "content": "请再问我一次吧"
-            }
+            return failed
+        if not self.retry_policy.allow(retry_count):
+            return failed
 
         try:
             body = {
@@ -262,8 +329,10 @@ class LinkAIBot(Bot):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
                                 timeout=conf().get("request_timeout", 180))
+            if res.status_code < 400:
+                self.retry_policy.success()
             if res.status_code == 200:
                 # execute success
                 response = res.json()
@@ -284,9 +353,9 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
+                    self.retry_policy.failure()
                     logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self.reply_text(session, app_code, retry_count + 1)
+                    return self.retry_policy.retry(retry_count, 2, lambda: self.reply_text(session, app_code, retry_count + 1), failed)
 
                 return {
                     "total_tokens": 0,
@@ -297,16 +366,16 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
+            self.retry_policy.failure(e)
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self.reply_text(session, app_code, retry_count + 1)
+            return self.retry_policy.retry(retry_count, 2, lambda: self.reply_text(session, app_code, retry_count + 1), failed)
 
     def _fetch_app_info(self, app_code: str):
         headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
         # do http request
         base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
         params = {"app_code": app_code}
-        res = requests.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
+        res = http_client.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
         if res.status_code == 200:
             return res.json()
         else:
@@ -327,7 +396,7 @@ class LinkAIBot(Bot):
                 "img_proxy": conf().get("image_proxy")
             }
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/images/generations"
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 90))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 90))
             t2 = time.time()
             image_url = res.json()["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
@@ -430,7 +499,7 @@ def _download_file(url: str):
             os.makedirs(file_path)
         file_name = url.split("/")[-1]  # 获取文件名
         file_path = os.path.join(file_path, file_name)
-        response = requests.get(url)
+        response = http_client.get(url)
         with open(file_path, "wb") as f:
             f.write(response.content)
         return file_path
@@ -441,11 +510,13 @@ def _download_file(url: str):
 class LinkAISessionManager(SessionManager):
     def session_msg_query(self, query, session_id):
         session = self.build_session(session_id)
+        self.apply_compaction(session)
         messages = session.messages + [{"role": "user", "content": query}]
         return messages
 
     def session_reply(self, reply, session_id, total_tokens=None, query=None):
         session = self.build_session(session_id)
+        self.apply_compaction(session)
         if query:
             session.add_query(query)
         session.add_reply(reply)
@@ -453,6 +524,7 @@ class LinkAISessionManager(SessionManager):
             max_tokens = conf().get("conversation_max_tokens", 2500)
             tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
             logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
+            self.compact_async(session, tokens_cnt, max_tokens)
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
         return session
@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import json
 import time
 
 import openai
@@ -8,11 +9,11 @@ from bot.bot import Bot
 from bot.minimax.minimax_session import MinimaxSession
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
-from bridge.reply import Reply, ReplyType
+from bridge.reply import Reply, ReplyStream, ReplyType
 from common.log import logger
 from config import conf, load_config
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
-import requests
+from common import http_client
 from common import const
 
 
@@ -68,9 +69,10 @@ class MinimaxBot(Bot):
             new_args = self.args.copy()
             if model:
                 new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
+            if context.get("stream"):
+                reply = self.reply_text_stream(session, args=new_args)
+                if reply: # 建立流式请求失败时退回普通请求，由 reply_text 负责重试和错误提示
+                    return reply
 
             reply_content = self.reply_text(session, args=new_args)
             logger.debug(
@@ -94,6 +96,37 @@ class MinimaxBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    def reply_text_stream(self, session: MinimaxSession, args=None):
+        """
+        call the chatcompletion_pro api with stream=True
+        :param session: a conversation session
+        :return: a STREAM reply, or None when the request fails
+        """
+        try:
+            headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
+            body = dict(self.request_body, messages=list(session.messages), stream=True)
+            res = http_client.post(self.base_url, headers=headers, json=body, stream=True)
+            if res.status_code != 200:
+                logger.error(f"[Minimax_AI] stream request failed, status_code={res.status_code}")
+                res.close()
+                return None
+        except Exception as e:
+            logger.exception(e)
+            return None
+
+        def deltas():
+            for data in http_client.iter_sse_data(res):
+                chunk = json.loads(data)
+                if chunk.get("usage") or chunk.get("reply"): # 最后一个事件包含完整的回复，不再重复输出
+                    return
+                for choice in chunk.get("choices") or []:
+                    for message in choice.get("messages") or []:
+                        yield message.get("text")
+
+        stream = ReplyStream(deltas(), error_text="我现在有点累了，等会再来吧")
+        stream.on_complete = lambda text: self.sessions.session_reply(text, session.session_id)
+        return Reply(ReplyType.STREAM, stream)
+
     def reply_text(self, session: MinimaxSession, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -107,7 +140,7 @@ class MinimaxBot(Bot):
             self.request_body["messages"].extend(session.messages)
             logger.info("[Minimax_AI] request_body={}".format(self.request_body))
             # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(self.base_url, headers=headers, json=self.request_body)
+            res = http_client.post(self.base_url, headers=headers, json=self.request_body)
 
             # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
             if res.status_code == 200:
@@ -1,21 +1,27 @@
 # encoding:utf-8
 
-import time
+import json
 
 import openai
 import openai.error
-from bot.bot import Bot
+from bot.bot import Bot, REQUEST_ERRORS, REQUEST_RETRIES, REQUEST_SECONDS
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
-from bridge.reply import Reply, ReplyType
+from bridge.reply import Reply, ReplyStream, ReplyType
 from common.log import logger
+from common import cancellation
+from common import hedge
+from common import retry
+from common.async_loop import get_http_session
 from config import conf, load_config
 from .moonshot_session import MoonshotSession
-import requests
+from common import http_client
 
 
 # ZhipuAI对话模型API
 class MoonshotBot(Bot):
+    MAX_RETRIES = 2 # 请求出错后的最多重试次数
+
     def __init__(self):
         super().__init__()
         self.sessions = SessionManager(MoonshotSession, model=conf().get("model") or "moonshot-v1-128k")
@@ -29,118 +35,267 @@ class MoonshotBot(Bot):
         }
         self.api_key = conf().get("moonshot_api_key")
         self.base_url = conf().get("moonshot_base_url", "https://api.moonshot.cn/v1/chat/completions")
+        self.hedger = hedge.Hedger("moonshot") # 对冲请求，见 common/hedge.py
+        self.retry_policy = retry.get_policy("moonshot") # 重试退避和熔断，见 common/retry.py
 
     def reply(self, query, context=None):
         # acquire reply content
         if context.type == ContextType.TEXT:
             logger.info("[MOONSHOT_AI] query={}".format(query))
-
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply = self._reply_command(query, context["session_id"])
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[MOONSHOT_AI] session query={}".format(session.messages))
-
-            model = context.get("moonshot_model")
-            new_args = self.args.copy()
-            if model:
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
-
-            reply_content = self.reply_text(session, args=new_args)
-            logger.debug(
-                "[MOONSHOT_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
+            session, new_args = self._prepare_query(query, context)
+            retry_count = self._first_retry(context)
+            if context.get("stream"):
+                return self.reply_text_stream(session, args=new_args, retry_count=retry_count, cancel_token=context.get("cancel_token"))
+            return retry.chain(
+                lambda: self._hedged_reply_text(session, new_args, retry_count, context.get("cancel_token")),
+                lambda reply_content: self._build_reply(session, reply_content),
             )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[MOONSHOT_AI] reply {} used 0 tokens.".format(reply_content))
-            return reply
         else:
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: MoonshotSession, args=None, retry_count=0) -> dict:
+    # 异步获取回复内容，文本请求通过 aiohttp 直接调用接口
+    async def areply(self, query, context=None):
+        if context.type != ContextType.TEXT or context.get("stream"): # 流式回复在线程池中建立请求
+            return await super().areply(query, context)
+        logger.info("[MOONSHOT_AI] query={}".format(query))
+        reply = self._reply_command(query, context["session_id"])
+        if reply:
+            return reply
+        session, new_args = self._prepare_query(query, context)
+        reply_content = await self._ahedged_reply_text(session, new_args, self._first_retry(context))
+        return self._build_reply(session, reply_content)
+
+    # 处理清除记忆、清除所有、更新配置等指令，不是指令时返回 None
+    def _reply_command(self, query, session_id):
+        reply = None
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            reply = Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            reply = Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            reply = Reply(ReplyType.INFO, "配置已更新")
+        return reply
+
+    # 请求的初始重试次数：路由还有其他服务可以转移时不重试
+    def _first_retry(self, context):
+        return self.MAX_RETRIES if context.get("failover") else 0
+
+    # 构建会话并把用户消息添加进消息列表，返回会话和本次请求的参数
+    def _prepare_query(self, query, context):
+        session = self.sessions.session_query(query, context["session_id"])
+        logger.debug("[MOONSHOT_AI] session query={}".format(session.messages))
+
+        model = context.get("moonshot_model")
+        new_args = self.args.copy()
+        if model:
+            new_args["model"] = model
+        return session, new_args
+
+    # 调用 reply_text，开启对冲请求时超过等待时间还没有返回会再发出一个相同的请求，回复字典中的 attempt 为胜出的请求
+    def _hedged_reply_text(self, session, args, retry_count, cancel_token):
+        if not hedge.enabled("same"):
+            reply_content, attempt = self.reply_text(session, args, retry_count, cancel_token), 0
+        else:
+            call = lambda token: self.reply_text(session, args, retry_count, token)
+            reply_content, attempt = self.hedger.run([call, call], _succeeded, cancel_token)
+        reply_content["attempt"] = attempt
+        return reply_content
+
+    async def _ahedged_reply_text(self, session, args, retry_count):
+        if not hedge.enabled("same"):
+            reply_content, attempt = await self.areply_text(session, args, retry_count), 0
+        else:
+            call = lambda token: self.areply_text(session, args, retry_count)
+            reply_content, attempt = await self.hedger.arun([call, call], _succeeded)
+        reply_content["attempt"] = attempt
+        return reply_content
+
+    # 根据接口返回的结果构建回复，正常生成时把回复添加到会话的消息列表
+    def _build_reply(self, session, reply_content):
+        session_id = session.session_id
+        logger.debug(
+            "[MOONSHOT_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}, attempt={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+                reply_content.get("attempt", 0),
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[MOONSHOT_AI] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def reply_text(self, session: MoonshotSession, args=None, retry_count=0, cancel_token=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
         :param retry_count: retry count
+        :param cancel_token: cancellation token of the message, no request or retry is made after it is cancelled
         :return: {}
         """
+        cancellation.check(cancel_token)
+        if not self.retry_policy.allow(retry_count): # circuit breaker is open, fail fast
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
-            }
-            body = args
-            body["messages"] = session.messages
+            headers, body = self._build_request(session, args)
             # logger.debug("[MOONSHOT_AI] response={}".format(response))
             # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(
-                self.base_url,
-                headers=headers,
-                json=body
-            )
-            if res.status_code == 200:
-                response = res.json()
-                return {
-                    "total_tokens": response["usage"]["total_tokens"],
-                    "completion_tokens": response["usage"]["completion_tokens"],
-                    "content": response["choices"][0]["message"]["content"]
-                }
+            with REQUEST_SECONDS.time(bot="moonshot"):
+                res = http_client.post(
+                    self.base_url,
+                    headers=headers,
+                    json=body
+                )
+            cancellation.check(cancel_token)
+            result, need_retry = self._parse_response(res.status_code, res.json(), retry_count)
+            if need_retry:
+                REQUEST_RETRIES.inc(bot="moonshot")
+                return self.retry_policy.retry(retry_count, 3, lambda: self.reply_text(session, args, retry_count + 1, cancel_token), result, cancel_token)
             else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[MOONSHOT_AI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[MOONSHOT_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
-                    result["content"] = "授权失败，请检查API Key是否正确"
-                elif res.status_code == 429:
-                    result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
-                else:
-                    need_retry = False
+                return result
+        except Exception as e:
+            logger.exception(e)
+            REQUEST_ERRORS.inc(bot="moonshot")
+            self.retry_policy.failure(e)
+            need_retry = retry_count < self.MAX_RETRIES
+            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            if need_retry:
+                REQUEST_RETRIES.inc(bot="moonshot")
+                return self.retry_policy.retry(retry_count, 3, lambda: self.reply_text(session, args, retry_count + 1, cancel_token), result, cancel_token)
+            else:
+                return result
 
+    def reply_text_stream(self, session: MoonshotSession, args=None, retry_count=0, cancel_token=None) -> Reply:
+        """
+        call the chat completions api with stream=True, the reply is read from the server-sent events
+        :param session: a conversation session
+        :param retry_count: retry count
+        :param cancel_token: cancellation token of the message, checked before reading each chunk
+        :return: a STREAM reply, or an ERROR reply when the request fails
+        """
+        cancellation.check(cancel_token)
+        if not self.retry_policy.allow(retry_count):
+            return Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+        try:
+            headers, body = self._build_request(session, args)
+            body["stream"] = True
+            with REQUEST_SECONDS.time(bot="moonshot"):
+                res = http_client.post(self.base_url, headers=headers, json=body, stream=True)
+            if res.status_code != 200: # 出错时响应不是流式的，按普通响应解析错误信息
+                result, need_retry = self._parse_response(res.status_code, res.json(), retry_count)
                 if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
+                    REQUEST_RETRIES.inc(bot="moonshot")
+                    return self.retry_policy.retry(retry_count, 3, lambda: self.reply_text_stream(session, args, retry_count + 1, cancel_token),
+                                                   Reply(ReplyType.ERROR, result["content"]), cancel_token)
+                return Reply(ReplyType.ERROR, result["content"])
+            self.retry_policy.success()
+        except Exception as e:
+            logger.exception(e)
+            REQUEST_ERRORS.inc(bot="moonshot")
+            self.retry_policy.failure(e)
+            error = Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+            if retry_count < self.MAX_RETRIES:
+                REQUEST_RETRIES.inc(bot="moonshot")
+                return self.retry_policy.retry(retry_count, 3, lambda: self.reply_text_stream(session, args, retry_count + 1, cancel_token), error, cancel_token)
+            return error
+
+        def deltas():
+            for data in http_client.iter_sse_data(res):
+                cancellation.check(cancel_token)
+                choices = json.loads(data).get("choices")
+                if choices:
+                    yield choices[0].get("delta", {}).get("content")
+
+        stream = ReplyStream(deltas(), error_text="我现在有点累了，等会再来吧")
+        stream.on_complete = lambda text: self.sessions.session_reply(text, session.session_id)
+        return Reply(ReplyType.STREAM, stream)
+
+    # reply_text 的异步版本，使用共享的 aiohttp 会话发送请求
+    async def areply_text(self, session: MoonshotSession, args=None, retry_count=0) -> dict:
+        if not self.retry_policy.allow(retry_count):
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        try:
+            headers, body = self._build_request(session, args)
+            http_session = await get_http_session()
+            with REQUEST_SECONDS.time(bot="moonshot"):
+                async with http_session.post(self.base_url, headers=headers, json=body) as res:
+                    result, need_retry = self._parse_response(res.status, await res.json(content_type=None), retry_count)
+            if need_retry:
+                REQUEST_RETRIES.inc(bot="moonshot")
+                return await self.retry_policy.aretry(retry_count, 3, lambda: self.areply_text(session, args, retry_count + 1), result)
+            else:
+                return result
         except Exception as e:
             logger.exception(e)
-            need_retry = retry_count < 2
+            REQUEST_ERRORS.inc(bot="moonshot")
+            self.retry_policy.failure(e)
+            need_retry = retry_count < self.MAX_RETRIES
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if need_retry:
-                return self.reply_text(session, args, retry_count + 1)
+                REQUEST_RETRIES.inc(bot="moonshot")
+                return await self.retry_policy.aretry(retry_count, 3, lambda: self.areply_text(session, args, retry_count + 1), result)
             else:
                 return result
+
+    # 构建请求头和请求体
+    def _build_request(self, session: MoonshotSession, args):
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + self.api_key
+        }
+        body = args
+        body["messages"] = session.messages
+        return headers, body
+
+    # 解析接口响应，返回结果和是否需要重试。服务端错误和限流记为熔断器的失败，其他 4xx 错误和请求本身有关，不计入熔断器
+    def _parse_response(self, status_code, response, retry_count):
+        if status_code >= 500 or status_code == 429:
+            self.retry_policy.failure()
+        elif status_code >= 400:
+            self.retry_policy.neutral()
+        else:
+            self.retry_policy.success()
+        if status_code == 200:
+            return {
+                "total_tokens": response["usage"]["total_tokens"],
+                "completion_tokens": response["usage"]["completion_tokens"],
+                "content": response["choices"][0]["message"]["content"]
+            }, False
+        REQUEST_ERRORS.inc(bot="moonshot")
+        error = response.get("error")
+        logger.error(f"[MOONSHOT_AI] chat failed, status_code={status_code}, "
+                     f"msg={error.get('message')}, type={error.get('type')}")
+
+        result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+        need_retry = False
+        if status_code >= 500:
+            # server error, need retry
+            logger.warn(f"[MOONSHOT_AI] do retry, times={retry_count}")
+            need_retry = retry_count < self.MAX_RETRIES
+        elif status_code == 401:
+            result["content"] = "授权失败，请检查API Key是否正确"
+        elif status_code == 429:
+            result["content"] = "请求过于频繁，请稍后再试"
+            need_retry = retry_count < self.MAX_RETRIES
+        return result, need_retry
+
+
+# reply_text 返回的是正常生成的回复
+def _succeeded(reply_content):
+    return reply_content.get("completion_tokens", 0) > 0
@@ -1,5 +1,4 @@
 # encoding:utf-8
-import time
 import openai
 import openai.error
 from bot.bot import Bot
@@ -8,7 +7,9 @@ from bot.openai.open_ai_session import OpenAISession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
 from common.log import logger
+from common import retry
 from config import conf
 
 user_session = dict()  # 全局变量，用于存储所有用户会话
@@ -20,6 +21,7 @@ class OpenAIBot(Bot, OpenAIImage):
         openai.api_key = conf().get("open_ai_api_key") # 设置OpenAI API密钥
         if conf().get("open_ai_api_base"): # 如果配置了自定义API地址，进行设置
             openai.api_base = conf().get("open_ai_api_base")
+        openai.requestssession = http_client.new_session(proxy=True) # 同步请求使用独立的连接池保持长连接，代理设置在会话上
         proxy = conf().get("proxy") # 获取代理配置
         if proxy:
             openai.proxy = proxy # 设置代理
@@ -37,6 +39,7 @@ class OpenAIBot(Bot, OpenAIImage):
             "timeout": conf().get("request_timeout", None),  # 重试的超时时间
             "stop": ["\n\n\n"],  # 设置停止符号，控制生成的结束点
         }
+        self.retry_policy = retry.get_policy("openai") # 重试退避和熔断，见 common/retry.py
     # 处理用户请求的主方法
     def reply(self, query, context=None):
         if context and context.type: # 如果有消息且类型已定义
@@ -53,22 +56,11 @@ class OpenAIBot(Bot, OpenAIImage):
                 else:  # 普通文本请求
                     # 构建会话并添加用户消息到消息列表中
                     session = self.sessions.session_query(query, session_id)
-                    result = self.reply_text(session)  # 调用方法获取回复
-                    total_tokens, completion_tokens, reply_content = (
-                        result["total_tokens"], # 消息列表和新回复的总token数
-                        result["completion_tokens"], # 助手新生成的回复的token数
-                        result["content"], # 助手回复
+                    # 调用方法获取回复，延后重试时重试的结果同样由 _build_reply 处理
+                    reply = retry.chain(
+                        lambda: self.reply_text(session, cancel_token=context.get("cancel_token")),
+                        lambda result: self._build_reply(session, result),
                     )
-                    # 打印调试信息,记录消息列表,当前会话id,助手回复,助手回复的token数
-                    logger.debug(
-                        "[OPEN_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                            str(session), session_id, reply_content, completion_tokens)
-                    )
-                    if total_tokens == 0: # 如果总Token为0，表示出现异常
-                        reply = Reply(ReplyType.ERROR, reply_content)
-                    else: # 这个是正常回复的情况,添加助手新回复到消息列表
-                        self.sessions.session_reply(reply_content, session_id, total_tokens)
-                        reply = Reply(ReplyType.TEXT, reply_content)
                 return reply
             elif context.type == ContextType.IMAGE_CREATE: # 如果是图像生成请求
                 ok, retstring = self.create_img(query, 0) # 调用图像生成方法,0是retry_count
@@ -78,10 +70,31 @@ class OpenAIBot(Bot, OpenAIImage):
                 else:   # 否则返回错误信息
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
+    # 根据 reply_text 的结果构建回复
+    def _build_reply(self, session, result):
+        total_tokens, completion_tokens, reply_content = (
+            result.get("total_tokens", 0), # 消息列表和新回复的总token数
+            result["completion_tokens"], # 助手新生成的回复的token数
+            result["content"], # 助手回复
+        )
+        # 打印调试信息,记录消息列表,当前会话id,助手回复,助手回复的token数
+        logger.debug(
+            "[OPEN_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                str(session), session.session_id, reply_content, completion_tokens)
+        )
+        if total_tokens == 0: # 如果总Token为0，表示出现异常
+            return Reply(ReplyType.ERROR, reply_content)
+        # 这个是正常回复的情况,添加助手新回复到消息列表
+        self.sessions.session_reply(reply_content, session.session_id, total_tokens)
+        return Reply(ReplyType.TEXT, reply_content)
+
      # 获取文本回复
-    def reply_text(self, session: OpenAISession, retry_count=0):
+    def reply_text(self, session: OpenAISession, retry_count=0, cancel_token=None):
+        if not self.retry_policy.allow(retry_count): # 熔断中，直接返回错误
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
         try:
             response = openai.Completion.create(prompt=str(session), **self.args) # 调用OpenAI文本生成接口
+            self.retry_policy.success()
             res_content = response.choices[0]["text"].strip().replace("<|endoftext|>", "") # 获取回复内容
             total_tokens = response["usage"]["total_tokens"]  # 获取总Token数
             completion_tokens = response["usage"]["completion_tokens"] # 获取生成部分的Token数
@@ -92,18 +105,18 @@ class OpenAIBot(Bot, OpenAIImage):
                 "content": res_content,
             }
         except Exception as e:  # 处理异常
+            self.retry_policy.failure(e)
             need_retry = retry_count < 2  # 控制重试次数(不满足条件时,返回False)
+            delay = 0 # 重试前等待的秒数，实际等待时间由重试策略退避计算
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError): # 如果触发速率限制
                 logger.warn("[OPEN_AI] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                delay = 20
             elif isinstance(e, openai.error.Timeout): # 如果请求超时
                 logger.warn("[OPEN_AI] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                delay = 5
             elif isinstance(e, openai.error.APIConnectionError):  # 如果连接失败
                 logger.warn("[OPEN_AI] APIConnectionError: {}".format(e))
                 need_retry = False
@@ -113,8 +126,8 @@ class OpenAIBot(Bot, OpenAIImage):
                 need_retry = False
                 self.sessions.clear_session(session.session_id) # 清除当前会话
 
-            if need_retry: # 如果需要重试，递归调用
+            if need_retry: # 如果需要重试，按重试策略等待后重试
                 logger.warn("[OPEN_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
+                return self.retry_policy.retry(retry_count, delay, lambda: self.reply_text(session, retry_count + 1, cancel_token), result, cancel_token)
             else:  # 否则返回错误结果
                 return result
@@ -1,4 +1,5 @@
 from bot.session_manager import Session
+from common import token_counter
 from common.log import logger
 
 class OpenAISession(Session): # 定义一个 OpenAISession 类，继承自 Session 类
@@ -58,9 +59,6 @@ class OpenAISession(Session): # 定义一个 OpenAISession 类，继承自 Sessi
     def calc_tokens(self): # 计算当前会话的 token 数
         return num_tokens_from_string(str(self), self.model) # 计算并返回当前对话的 token 数量
 
-# refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+# 整段提示的 token 数，编码器按模型缓存（见 common/token_counter.py）
 def num_tokens_from_string(string: str, model: str) -> int:
-    import tiktoken # 导入 tiktoken 库，它是 OpenAI 提供的用于处理 token 的工具
-    encoding = tiktoken.encoding_for_model(model)  # 获取指定模型的编码器
-    num_tokens = len(encoding.encode(string, disallowed_special=())) # 编码字符串并计算 token 数量
-    return num_tokens
+    return token_counter.count_string(string, model)
@@ -1,13 +1,28 @@
-from common.expired_dict import ExpiredDict # 引入过期字典和日志工具
+import time
+
+from common import compaction
+from common import session_store # 引入会话存储和日志工具
 from common.log import logger
+from common.worker_pool import get_pool
 from config import conf
 
 # 会话类，用于管理每个会话的状态和消息
+# token 数按消息增量计算：每条消息的 token 数在第一次计算时编码并缓存，会话记录总数，丢弃消息时直接减去，
+# 不再每次都重新编码整个消息列表。子类实现 count_message 计算单条消息的 token 数。
 class Session(object):
+    # 会话压缩的状态（见 common/compaction.py）：None 没有进行中的压缩，"running" 后台正在生成摘要，"ready" 摘要已生成、等待替换
+    # 写成类属性，从 sqlite 读回的旧会话也有默认值
+    compaction_state = None
+    _compaction_started = 0 # 开始生成摘要的时间（time.time()），会话被淘汰后读回时原来的任务不会再更新它，超时后重新压缩
+    _compaction = None # (被总结的消息, 摘要)
+
     def __init__(self, session_id, system_prompt=None):
         # 初始化会话，session_id为会话的唯一标识
         self.session_id = session_id
         self.messages = [] # 存储会话中的消息
+        self.tokens = 0 # 最近一次计算的会话 token 数，限流时作为请求的 token 用量（见 common/rate_limiter.py）
+        self._counted = [] # (消息, token 数)，和 messages 一一对应
+        self._counted_tokens = 0 # _counted 中的 token 总数
         # 如果没有传入system_prompt，则从配置文件中获取默认的system_prompt
         if system_prompt is None:
             self.system_prompt = conf().get("character_desc", "")
@@ -30,65 +45,244 @@ class Session(object):
     def add_reply(self, reply):
         assistant_item = {"role": "assistant", "content": reply}
         self.messages.append(assistant_item)
-    # 丢弃超过最大token数的消息，具体实现未提供
+    # 消息的角色：system、user 或 assistant
+    def message_role(self, message):
+        return message.get("role")
+    # 消息的文本
+    def message_text(self, message):
+        return str(message.get("content", ""))
+    # 代替被总结的消息的摘要消息，放在系统提示之后、保留的消息之前
+    def summary_messages(self, summary):
+        return [{"role": "assistant", "content": compaction.SUMMARY_PREFIX + summary}]
+    # 可以被总结的消息范围 [start, end)：系统提示之后到倒数 keep 条消息之前，保留的消息从用户消息开始，
+    # 保证替换后角色仍然交替出现。不足两条消息时返回 None
+    def compaction_range(self, keep):
+        start = 1 if self.messages and self.message_role(self.messages[0]) == "system" else 0
+        end = len(self.messages) - max(keep, 1) # 最新的一条消息总是保留
+        while end > start and self.message_role(self.messages[end]) != "user":
+            end -= 1
+        return (start, end) if end - start >= 2 else None
+    # 用生成好的摘要替换被总结的消息，返回是否替换成功。生成摘要期间最早的几条消息可能已经因为超出 token 数被丢弃，
+    # 替换剩下的部分（摘要中仍然包含被丢弃的内容）；被总结的消息全部不在了或者会话被重置时放弃这次压缩
+    def apply_compaction(self):
+        if self.compaction_state != "ready":
+            return False
+        compacted, summary = self._compaction
+        self.compaction_state, self._compaction = None, None
+        positions = {id(message): index for index, message in enumerate(compacted)}
+        for start, message in enumerate(self.messages):
+            if id(message) in positions:
+                break
+        else:
+            return False
+        compacted = compacted[positions[id(self.messages[start])]:]
+        end = start + len(compacted)
+        if end > len(self.messages) or any(a is not b for a, b in zip(self.messages[start:end], compacted)):
+            return False
+        self.messages[start:end] = self.summary_messages(summary) # 新的摘要消息在下次计算 token 数时计算
+        return True
+    # 删除第 index 条消息，从 token 总数中减去它的 token 数
+    def pop_message(self, index):
+        message = self.messages.pop(index)
+        if index < len(self._counted) and self._counted[index][0] is message:
+            self._counted_tokens -= self._counted.pop(index)[1]
+        return message
+    # 丢弃最早的对话直到不超过最大token数，返回丢弃后的token数。系统提示和最新的用户消息不会丢弃。
+    # 无法精确计算时（比如没有安装tiktoken）使用传入的cur_tokens，每丢弃一次粗略地减去max_tokens
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
-        raise NotImplementedError
-    # 计算当前会话使用的token数，具体实现未提供
+        precise = True
+        try:
+            cur_tokens = self.calc_tokens()
+        except Exception as e:
+            precise = False
+            if cur_tokens is None:
+                raise e
+            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+        while cur_tokens > max_tokens:
+            if len(self.messages) > 2 and precise: # 按缓存的 token 数一次删除系统提示之后足够多的最早消息
+                cur_tokens = self._drop_oldest(cur_tokens - max_tokens)
+                continue
+            elif len(self.messages) > 2: # 删除系统提示之后最早的一条消息
+                self.pop_message(1)
+            elif len(self.messages) == 2 and self.message_role(self.messages[1]) == "assistant":
+                self.pop_message(1)
+                cur_tokens = self.calc_tokens() if precise else cur_tokens - max_tokens
+                break
+            elif len(self.messages) == 2 and self.message_role(self.messages[1]) == "user":
+                logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
+                break
+            else:
+                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                break
+            cur_tokens = self.calc_tokens() if precise else cur_tokens - max_tokens
+        return cur_tokens
+    # 计算当前会话使用的token数，只有新加入的消息需要计算
     def calc_tokens(self):
+        return self._sync_tokens() + self.reply_tokens()
+    # 单条消息的token数，具体实现未提供
+    def count_message(self, message):
         raise NotImplementedError
+    # 每次回复固定的token开销
+    def reply_tokens(self):
+        return 0
+
+    # 从第二条消息开始删除，直到删除的 token 数不少于 excess 或者只剩最后一条消息，返回删除后的 token 数
+    def _drop_oldest(self, excess):
+        self._sync_tokens()
+        end, dropped = 1, 0
+        while end < len(self.messages) - 1 and dropped < excess:
+            dropped += self._counted[end][1]
+            end += 1
+        del self.messages[1:end]
+        del self._counted[1:end]
+        self._counted_tokens -= dropped
+        return self.calc_tokens()
+
+    # 让 _counted 和 messages 一致，返回消息的token总数。messages 可能被直接修改（重置、插件删除系统提示等），
+    # 按消息对象匹配已经计算过的消息，只计算新的消息
+    def _sync_tokens(self):
+        counted = self._counted
+        if len(counted) == len(self.messages) and all(item[0] is message for item, message in zip(counted, self.messages)):
+            return self._counted_tokens
+        known = {id(message): tokens for message, tokens in counted}
+        synced, total = [], 0
+        for message in self.messages:
+            tokens = known.get(id(message))
+            if tokens is None:
+                tokens = self.count_message(message)
+            synced.append((message, tokens))
+            total += tokens
+        self._counted, self._counted_tokens = synced, total
+        return total
+
+
+# 按字符数估算token数的会话，用于没有公开分词规则的模型
+class CharacterSession(Session):
+    text_key = "content" # 消息中文本的字段
+
+    def count_message(self, message):
+        return len(message[self.text_key])
+
+    def message_text(self, message):
+        return str(message.get(self.text_key, ""))
+
+
 # 会话管理类，用于管理多个会话的创建、查询和清理
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
-        # 如果配置文件中有expires_in_seconds，使用过期字典，否则使用普通字典
-        if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
-        else:
-            sessions = dict()
-        self.sessions = sessions # 会话字典
         self.sessioncls = sessioncls # 会话类
         self.session_args = session_args # 会话类初始化参数
+        self.sessions = self.create_store() # 会话存储，session_id --> 会话
+    # 创建保存会话的存储，默认使用有内存上限、可以写入 sqlite 的 SessionStore（见 common/session_store.py），
+    # 子类可以覆盖这个方法换成其他的存储，需要支持 get、[]、del、pop 和 clear
+    def create_store(self):
+        namespace = "{}:{}".format(self.sessioncls.__name__, self.session_args.get("model", ""))
+        return session_store.create_store(namespace)
     # 构建会话，如果session_id不存在则创建新的会话
     def build_session(self, session_id, system_prompt=None):
         # 如果session_id为None
         if session_id is None:
             return self.sessioncls(session_id, system_prompt, **self.session_args)
+        session = self.sessions.get(session_id) # 内存中没有时会从 sqlite 中读回
         # 如果session_id不在sessions中,创建一个新的session并添加到sessions中
-        if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+        if session is None:
+            session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            self.sessions[session_id] = session
         # 走到这个分支的前提是session_id在self.sessions中,但是system_prompt不为None
         # 这时会更改系统提示
         elif system_prompt is not None:  
-            self.sessions[session_id].set_system_prompt(system_prompt)
-        session = self.sessions[session_id] # 获取session_id对应的session
+            session.set_system_prompt(system_prompt)
         return session # 返回会话
     # 处理会话的查询请求
     def session_query(self, query, session_id):
         session = self.build_session(session_id) # 构建会话
+        self.apply_compaction(session) # 后台已经生成摘要时先替换，这次请求就使用压缩后的上下文
         session.add_query(query) # 添加用户查询
         try:
             max_tokens = conf().get("conversation_max_tokens", 1000)  # 获取最大token数
             total_tokens = session.discard_exceeding(max_tokens, None) # 丢弃超出的token
+            session.tokens = total_tokens
             logger.debug("prompt tokens used={}".format(total_tokens)) # 记录调试日志
+            self.compact_async(session, total_tokens, max_tokens)
         except Exception as e:  # 异常处理
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
         return session
     # 处理会话返回的回复
     def session_reply(self, reply, session_id, total_tokens=None):
         session = self.build_session(session_id)
+        self.apply_compaction(session)
         session.add_reply(reply)
         try:
             max_tokens = conf().get("conversation_max_tokens", 1000)
             tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+            session.tokens = tokens_cnt
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            self.compact_async(session, tokens_cnt, max_tokens)
         # 异常捕获后，程序继续运行：Python 的异常处理机制会阻止异常传播到外部函数或方法，从而避免整个函数失败。
         # except 块不会阻止后续代码执行：在 except 块执行完后，程序会继续执行 return session。
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
         return session
+    # 会话的 token 数达到压缩阈值时，在 compaction 线程池中总结较早的消息，不占用请求的线程。
+    # 摘要生成后只记录在会话中，下次请求时由 apply_compaction 替换，和请求线程对消息的修改不会交错
+    def compact_async(self, session, tokens, max_tokens):
+        if not compaction.enabled() or session.session_id is None or tokens < compaction.threshold(max_tokens):
+            return
+        if session.compaction_state == "running" and time.time() - session._compaction_started < conf().get("compaction_timeout", 120):
+            return
+        if session.compaction_state == "ready":
+            return
+        span = session.compaction_range(conf().get("compaction_keep_messages", 4))
+        if span is None:
+            return
+        messages = session.messages[span[0]:span[1]]
+        session.compaction_state, session._compaction_started = "running", time.time()
+        try:
+            get_pool("compaction").submit(self._compact, session, messages)
+        except Exception as e:
+            session.compaction_state = None
+            compaction.COMPACTIONS.inc(result="rejected")
+            logger.warning("[session] submit compaction failed: {}".format(e))
+
+    def _compact(self, session, messages):
+        try:
+            summary = self.summarize(session, messages)
+        except Exception as e:
+            session.compaction_state = None
+            compaction.COMPACTIONS.inc(result="failed")
+            logger.warning("[session] compact session {} failed: {}".format(session.session_id, e))
+            return
+        session._compaction = (messages, summary)
+        session.compaction_state = "ready"
+        logger.debug("[session] session {} summarized {} messages".format(session.session_id, len(messages)))
+
+    # 把消息总结成一段摘要，子类可以覆盖，换成 bot 自己的模型
+    def summarize(self, session, messages) -> str:
+        return compaction.summarize([(session.message_role(message), session.message_text(message)) for message in messages])
+
+    # 替换已经生成好的摘要
+    def apply_compaction(self, session):
+        if session.compaction_state != "ready":
+            return
+        try:
+            before = session.calc_tokens()
+        except Exception:
+            before = None
+        if not session.apply_compaction():
+            compaction.COMPACTIONS.inc(result="stale")
+            return
+        compaction.COMPACTIONS.inc(result="applied")
+        try:
+            after = session.calc_tokens()
+            if before is not None:
+                compaction.SAVED_TOKENS.inc(max(before - after, 0))
+            session.tokens = after
+            logger.debug("[session] session {} compacted, tokens {} -> {}".format(session.session_id, before, after))
+        except Exception:
+            pass
     # 清除指定的会话
     def clear_session(self, session_id):
-        if session_id in self.sessions:
-            del self.sessions[session_id] # 删除sessions中的指定项
+        self.sessions.pop(session_id, None) # 删除sessions中的指定项
     # 清除所有会话
     def clear_all_session(self):
         self.sessions.clear()
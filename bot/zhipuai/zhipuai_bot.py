@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
@@ -9,8 +7,9 @@ from bot.zhipuai.zhipu_ai_session import ZhipuAISession
 from bot.zhipuai.zhipu_ai_image import ZhipuAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
-from bridge.reply import Reply, ReplyType
+from bridge.reply import Reply, ReplyStream, ReplyType
 from common.log import logger
+from common import retry
 from config import conf, load_config
 from zhipuai import ZhipuAI
 
@@ -26,6 +25,7 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             "top_p": conf().get("top_p", 0.7),  # 值在(0,1)之间(智谱AI 的 top_p 不能取 0 或者 1)
         }
         self.client = ZhipuAI(api_key=conf().get("zhipu_ai_api_key"))
+        self.retry_policy = retry.get_policy("zhipuai") # 重试退避和熔断，见 common/retry.py
 
     def reply(self, query, context=None):
         # acquire reply content
@@ -55,28 +55,16 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             if model:
                 new_args = self.args.copy()
                 new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
+            if context.get("stream"):
+                reply = self.reply_text_stream(session, args=new_args)
+                if reply: # 建立流式请求失败时退回普通请求，由 reply_text 负责重试和错误提示
+                    return reply
 
-            reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[ZHIPU_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
+            # 延后重试时重试的结果同样由 _build_reply 处理
+            return retry.chain(
+                lambda: self.reply_text(session, api_key, args=new_args, cancel_token=context.get("cancel_token")),
+                lambda reply_content: self._build_reply(session, reply_content),
             )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[ZHIPU_AI] reply {} used 0 tokens.".format(reply_content))
-            return reply
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
             reply = None
@@ -90,14 +78,60 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ZhipuAISession, api_key=None, args=None, retry_count=0) -> dict:
+    # 根据 reply_text 返回的内容构建回复
+    def _build_reply(self, session, reply_content):
+        logger.debug(
+            "[ZHIPU_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session.session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session.session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[ZHIPU_AI] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def reply_text_stream(self, session: ZhipuAISession, args=None):
+        """
+        call ZhipuAI's chat completions with stream=True
+        :param session: a conversation session
+        :return: a STREAM reply, or None when the request fails
+        """
+        try:
+            if args is None:
+                args = self.args
+            response = self.client.chat.completions.create(messages=session.messages, stream=True, **args)
+        except Exception as e:
+            logger.warn("[ZHIPU_AI] stream request failed: {}".format(e))
+            return None
+
+        def deltas():
+            for chunk in response:
+                if chunk.choices:
+                    yield chunk.choices[0].delta.content
+
+        stream = ReplyStream(deltas(), error_text="我现在有点累了，等会再来吧")
+        stream.on_complete = lambda text: self.sessions.session_reply(text, session.session_id)
+        return Reply(ReplyType.STREAM, stream)
+
+    def reply_text(self, session: ZhipuAISession, api_key=None, args=None, retry_count=0, cancel_token=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
         :param retry_count: retry count
+        :param cancel_token: cancellation token of the message, no retry is made after it is cancelled
         :return: {}
         """
+        if not self.retry_policy.allow(retry_count): # 熔断中，直接返回错误
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
         try:
             # if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
             #     raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
@@ -106,6 +140,7 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
                 args = self.args
             # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
             response = self.client.chat.completions.create(messages=session.messages, **args)
+            self.retry_policy.success()
             # logger.debug("[ZHIPU_AI] response={}".format(response))
             # logger.info("[ZHIPU_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
 
@@ -115,28 +150,26 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
                 "content": response.choices[0].message.content,
             }
         except Exception as e:
+            self.retry_policy.failure(e)
             need_retry = retry_count < 2
+            delay = 0
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                delay = 20
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                delay = 5
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                delay = 10
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
                 result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
+                delay = 5
             else:
                 logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
                 need_retry = False
@@ -144,6 +177,6 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
 
             if need_retry:
                 logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
+                return self.retry_policy.retry(retry_count, delay, lambda: self.reply_text(session, api_key, args, retry_count + 1, cancel_token), result, cancel_token)
             else:
                 return result
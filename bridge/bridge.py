@@ -1,13 +1,30 @@
+import hashlib
+import json
+import time
+
 from bot.bot_factory import create_bot
-from bridge.context import Context
-from bridge.reply import Reply
+from bridge.context import Context, ContextType
+from bridge.provider_router import ProviderRouter
+from bridge.reply import Reply, ReplyType
 from common import const
+from common import memory
+from common import metrics
+from common import rate_limiter
+from common import reply_cache
+from common import retry
+from common import trace
 from common.log import logger
+from common.singleflight import SingleFlight
 from common.singleton import singleton
 from config import conf
 from translate.factory import create_translator
 from voice.factory import create_voice
 
+# 每次获取聊天回复的耗时（包括 bot 内部的重试），覆盖所有类型的 bot
+# 流式回复时 REPLY_SECONDS 只统计到开始返回为止，首字延迟单独统计
+REPLY_SECONDS = metrics.histogram("bridge_reply_seconds", "Latency of fetching a chat reply from the bot", ["bot"])
+FIRST_TOKEN_SECONDS = metrics.histogram("bridge_stream_first_token_seconds", "Latency until the first streamed token of a chat reply", ["bot"])
+
 @singleton # 单例模式装饰器，确保该类的实例在整个程序中只有一个
 class Bridge(object):
     def __init__(self):
@@ -19,6 +36,8 @@ class Bridge(object):
             "translate": conf().get("translate", "baidu"),
         }
         # 根据配置文件中的 `bot_type` 设置聊天模型类型
+        # 合并相同的并发请求，leader 结束后 singleflight_window 秒内的相同请求也使用它的结果
+        self.single_flight = SingleFlight(conf().get("singleflight_window", 0))
         bot_type = conf().get("bot_type")
         if bot_type:
             self.btype["chat"] = bot_type # 如果配置有bot_type，则覆盖默认的chat模型
@@ -62,6 +81,13 @@ class Bridge(object):
                     self.btype["text_to_voice"] = const.LINKAI
         self.bots = {} # 存储已创建的 bot 实例
         self.chat_bots = {} # 存储已创建的聊天 bot 实例
+        # 配置了多个聊天服务时按延迟和错误率路由，出错时自动转移到其他服务
+        self.router = None
+        providers = conf().get("chat_providers") or []
+        if len(providers) >= 2:
+            self.router = ProviderRouter(providers, self.find_chat_bot)
+            first = providers[0]
+            self.btype["chat"] = first["bot_type"] if isinstance(first, dict) else first
 
     # 获取并返回指定类型的 bot 实例
     def get_bot(self, typename):
@@ -81,7 +107,83 @@ class Bridge(object):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply: # 获取聊天机器人回复内容
-        return self.get_bot("chat").reply(query, context)
+        bot_type, bot = self._chat_bot(context)
+        cache_key = reply_cache.cache_key(bot, bot_type, query, context) # 需要在调用 bot 之前计算
+        if cache_key is not None:
+            reply = reply_cache.load(bot, cache_key, query, context)
+            if reply is not None: # 命中缓存，不再调用模型
+                return reply
+        start = time.time()
+        shared = False
+        flight_key = _flight_key(bot, bot_type, query, context)
+        # ChatChannel 线程池中的消息允许延后重试（见 common/retry.py），使用路由时由路由转移到其他服务，不延后
+        deferrable = context is not None and context.get("defer_retry", False) and self.router is None
+        with trace.span(context, "bot." + bot_type), REPLY_SECONDS.time(bot=bot_type):
+            call = self.router.reply if self.router else bot.reply
+            if flight_key is None:
+                reply = _call_bot(call, query, context, deferrable)
+            else: # 同样的请求正在进行时等待它的结果
+                reply, shared = self.single_flight.do(flight_key, lambda: _call_bot(call, query, context, deferrable), context.get("cancel_token"))
+                reply = _own_reply(bot, query, context, reply, shared)
+        # 延后重试的回复在重试完成后再缓存和记录
+        return _when_ready(reply, lambda reply: self._after_reply(context, reply, cache_key, shared, bot_type, start))
+
+    async def afetch_reply_content(self, query, context: Context) -> Reply: # 异步获取聊天机器人回复内容
+        bot_type, bot = self._chat_bot(context)
+        cache_key = reply_cache.cache_key(bot, bot_type, query, context)
+        if cache_key is not None:
+            reply = reply_cache.load(bot, cache_key, query, context)
+            if reply is not None:
+                return reply
+        start = time.time()
+        shared = False
+        flight_key = _flight_key(bot, bot_type, query, context)
+        with trace.span(context, "bot." + bot_type), REPLY_SECONDS.time(bot=bot_type):
+            call = self.router.areply if self.router else bot.areply
+            if flight_key is None:
+                reply = await call(query, context)
+            else:
+                reply, shared = await self.single_flight.ado(flight_key, lambda: call(query, context), context.get("cancel_token"))
+                reply = _own_reply(bot, query, context, reply, shared)
+        return self._after_reply(context, reply, cache_key, shared, bot_type, start)
+
+    # 返回这次请求使用的 (bot 类型, bot)。使用路由时返回会话当前所在的服务，回复缓存和合并请求在它的会话中记录对话，
+    # 路由的 bot 类型为 router，实际调用的服务见 context["route"]
+    def _chat_bot(self, context):
+        if self.router:
+            return "router", self.router.session_bot(context.get("session_id") if context else None)
+        return str(self.get_bot_type("chat")), self.get_bot("chat")
+
+    # 模型回复之后：缓存回复、记录 token 用量和首字延迟，合并请求中使用其他调用方结果的不重复记录
+    def _after_reply(self, context, reply, cache_key, shared, bot_type, start):
+        if not shared:
+            if cache_key is not None:
+                reply_cache.save(cache_key, reply)
+            self._charge_tokens(context, reply)
+        return _observe_stream(reply, bot_type, start)
+
+    # 按会话中计算好的 token 数记录这次请求的用量，用于按 token 数限流。流式回复在完整结束后记录
+    def _charge_tokens(self, context, reply):
+        if not reply or not conf().get("rate_limits") or context is None or context.get("session_id") is None:
+            return
+        session_id = context["session_id"]
+        bot = self._chat_bot(context)[1] # 使用路由时回复可能来自其他服务，重新取会话所在的服务
+
+        def charge():
+            sessions = getattr(getattr(bot, "sessions", None), "sessions", None)
+            session = sessions.get(session_id) if sessions is not None else None
+            rate_limiter.charge(context, getattr(session, "tokens", 0))
+        if reply.type == ReplyType.TEXT:
+            charge()
+        elif reply.type == ReplyType.STREAM:
+            stream = reply.content
+            on_complete = stream.on_complete
+
+            def complete(text):
+                if on_complete:
+                    on_complete(text)
+                charge()
+            stream.on_complete = complete
 
     def fetch_voice_to_text(self, voiceFile) -> Reply: # 获取语音转文本的结果
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
@@ -99,3 +201,69 @@ class Bridge(object):
     # 重新初始化
     def reset_bot(self):
         self.__init__() # 通过重新调用构造函数来重置整个对象
+
+
+# 流式回复收到第一个片段时记录首字延迟
+def _observe_stream(reply, bot_type, start):
+    if reply and reply.type == ReplyType.STREAM:
+        reply.content.on_first = lambda: FIRST_TOKEN_SECONDS.observe(time.time() - start, bot=bot_type)
+    return reply
+
+
+# 合并相同请求使用的 key：bot 类型、模型、API 密钥和 bot 即将发送的完整消息列表（会话中已有的消息加上这次的问题），不合并时返回 None。
+# 流式回复只能被读取一次，不能共用；管理命令会修改会话，也不合并。
+# 带有图片（USER_IMAGE_CACHE）、文件（file_id）或指定应用（app_code）的请求，bot 发送的内容不只由消息列表决定，也不合并；
+# 群聊中 LinkAI 插件会按群名称（group_app_map）选择不同的应用，所以群名称也在 key 中
+def _flight_key(bot, bot_type, query, context):
+    if not conf().get("singleflight", False) or context is None or context.type != ContextType.TEXT or context.get("stream"):
+        return None
+    if not query or query.startswith("#") or query in conf().get("clear_memory_commands", ["#清除记忆"]):
+        return None
+    sessions = getattr(bot, "sessions", None)
+    if sessions is None: # 没有会话管理的 bot 无法为 follower 记录对话
+        return None
+    if context.get("app_code") or context.get("file_id") or memory.USER_IMAGE_CACHE.get(context["session_id"]):
+        return None
+    session = sessions.build_session(context["session_id"])
+    model = context.get("gpt_model") or context.get("moonshot_model") or conf().get("model")
+    msg = context.get("msg")
+    group_name = msg.from_user_nickname if context.get("isgroup") and msg else None
+    data = json.dumps([bot_type, model, context.get("openai_api_key"), group_name, session.messages, query], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+# 合并请求的结果由多个调用方共用，每个调用方拿到自己的副本（通道装饰回复时会修改内容）。
+# follower 没有调用 bot，需要自己把问题和回复加入会话，和 bot 一样只有正常的文本回复才会加入
+def _own_reply(bot, query, context, reply, shared):
+    if not reply:
+        return reply
+    if shared:
+        bot.sessions.session_query(query, context["session_id"])
+    return _copy_reply(bot, context, reply, shared)
+
+
+def _copy_reply(bot, context, reply, shared):
+    if reply.type == ReplyType.DEFERRED: # 等重试完成后再复制
+        return Reply(ReplyType.DEFERRED, retry.then(reply.content, lambda result: _copy_reply(bot, context, result, shared)))
+    if shared and reply.type == ReplyType.TEXT:
+        bot.sessions.session_reply(reply.content, context["session_id"])
+    return Reply(reply.type, reply.content)
+
+
+# 调用 bot。允许延后重试时，bot 需要等待重试会抛出 RetryLater，转换为 DEFERRED 回复
+def _call_bot(call, query, context, deferrable):
+    if not deferrable:
+        return call(query, context)
+    try:
+        with retry.allow_defer():
+            return call(query, context)
+    except retry.RetryLater as e:
+        logger.info("[Bridge] reply deferred, {}".format(e))
+        return Reply(ReplyType.DEFERRED, retry.defer(e))
+
+
+# 回复可用时用 fn 处理，DEFERRED 回复在重试完成后处理
+def _when_ready(reply, fn):
+    if reply and reply.type == ReplyType.DEFERRED:
+        return Reply(ReplyType.DEFERRED, retry.then(reply.content, fn))
+    return fn(reply)
@@ -0,0 +1,365 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from bridge.context import Context
+from bridge.reply import ReplyType
+from common import cancellation
+from common import const
+from common import hedge
+from common import metrics
+from common import trace
+from common.async_loop import run_sync
+from common.cancellation import Cancelled
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf
+
+# 多个模型服务之间的路由和故障转移。
+# 配置 chat_providers 后（至少两个），每次请求按实时的表现选择服务，而不是整个进程固定使用 bot_type：
+#   每个服务维护请求耗时和错误率的指数加权移动平均（EWMA），得分 = 平均耗时 * (1 + router_error_penalty * 错误率)，得分低的优先；
+#   连续失败 router_failure_threshold 次的服务在 router_cooldown 秒内排到最后；
+#   请求出错（bot 返回 ERROR 回复或者抛出异常，包括超时、限流和 5xx）时转到下一个服务，还有可用的服务时 bot 内部不再重试等待。
+# 每个服务的 bot 有自己的会话管理，会话格式也不同（比如 minimax 使用 sender_type/text）。会话切换到另一个服务时，
+# 先把上一个服务中的对话记录转换为通用的 (角色, 文本) 列表，再写入目标服务的会话，上下文不会因为切换而丢失。
+# 管理命令（清除记忆等）发给所有已经创建的服务。
+# 每次路由的决策（排序、得分、每次尝试的结果和耗时）写入日志和 context["route"]，最近的决策可以通过 decisions() 查看。
+# hedge_target 为 alternate 时，第一个服务超过等待时间还没有返回会同时请求第二个服务，使用先成功的回复（见 common/hedge.py）。
+# chat_providers 的每一项可以是 bot 类型，也可以是 {"bot_type": "moonshot", "model": "moonshot-v1-8k"}，model 通过 context 传给 bot
+
+ROUTED = metrics.counter("router_requests_total", "Requests sent to each chat provider by the router", ["provider", "result"])
+FAILOVERS = metrics.counter("router_failovers_total", "Requests moved from one provider to another after an error", ["source", "target"])
+
+# bot 从 context 中读取模型的参数名，没有列出的 bot 使用 gpt_model
+MODEL_KEYS = {const.MOONSHOT: "moonshot_model", const.MiniMax: "Minimax_model"}
+# 会发给所有服务的管理命令
+_COMMANDS = ["#清除所有", "#更新配置"]
+
+
+class Provider:
+    def __init__(self, bot_type, model=None):
+        self.name = bot_type
+        self.model = model
+        self.latency = None # 请求耗时的 EWMA（秒），还没有请求过时为 None
+        self.error_rate = 0.0 # 错误率的 EWMA
+        self.failures = 0 # 连续失败的次数
+        self.failed_at = 0 # 最近一次失败的时间
+
+    def record(self, seconds, ok, alpha):
+        self.record_latency(seconds, alpha)
+        self.error_rate = alpha * (0 if ok else 1) + (1 - alpha) * self.error_rate
+        if ok:
+            self.failures = 0
+        else:
+            self.failures += 1
+            self.failed_at = time.monotonic()
+
+    def record_latency(self, seconds, alpha):
+        self.latency = seconds if self.latency is None else alpha * seconds + (1 - alpha) * self.latency
+
+    def cooling_down(self, now):
+        return self.failures >= conf().get("router_failure_threshold", 3) and now - self.failed_at < conf().get("router_cooldown", 30)
+
+
+class ProviderRouter:
+    def __init__(self, providers, find_bot):
+        self.providers = []
+        for item in providers:
+            if isinstance(item, dict):
+                self.providers.append(Provider(item["bot_type"], item.get("model")))
+            else:
+                self.providers.append(Provider(item))
+        self.find_bot = find_bot # bot 类型 --> bot 实例，使用 Bridge.find_chat_bot
+        self._lock = threading.Lock()
+        self._decisions = deque(maxlen=100)
+        self.hedger = hedge.Hedger("router") # hedge_target 为 alternate 时的对冲请求
+        expires = conf().get("expires_in_seconds")
+        self.session_providers = ExpiredDict(expires) if expires else {} # session_id --> 会话最近使用的服务，会话记录以它为准
+        global _router
+        _router = self
+
+    # 按得分排序的服务列表，返回 [(服务, 得分)]。还没有请求过的服务使用已知的最低耗时，得分相同时保持配置的顺序
+    def rank(self):
+        now = time.monotonic()
+        penalty = conf().get("router_error_penalty", 5)
+        with self._lock:
+            known = [p.latency for p in self.providers if p.latency is not None]
+            default = min(known) if known else 0
+            scored = []
+            for provider in self.providers:
+                latency = provider.latency if provider.latency is not None else default
+                scored.append((provider, latency * (1 + penalty * provider.error_rate)))
+        # 冷却中的服务排到最后，仍然可以作为最后的选择
+        return sorted(scored, key=lambda item: (item[0].cooling_down(now), item[1]))
+
+    # 会话当前使用的 bot，用于在会话中记录对话（回复缓存、合并请求），没有使用过时为第一个服务
+    def session_bot(self, session_id):
+        name = self.session_providers.get(session_id) if session_id is not None else None
+        return self.find_bot(name or self.providers[0].name)
+
+    def reply(self, query, context):
+        if _is_command(query):
+            return self._broadcast(lambda bot: bot.reply(query, context))
+        decision = self._start(context)
+        candidates = decision["candidates"]
+        index, reply, error = 0, None, None
+        while index < len(candidates):
+            if index == 0 and len(candidates) > 1 and hedge.enabled("alternate"):
+                # 第一个服务超过等待时间还没有返回时，同时请求第二个服务
+                outcomes = []
+                calls = [self._hedge_call(provider, query, context, decision, outcomes) for provider in candidates[:2]]
+                self.hedger.run(calls, _attempt_ok, context.get("cancel_token"))
+            else:
+                outcomes = [(candidates[index], self._attempt(candidates[index], query, context, decision))]
+            finished, reply, error = self._finish_attempts(outcomes, decision)
+            if finished:
+                break
+            index += len(outcomes)
+        self._log(decision, context)
+        if error is not None:
+            raise error
+        return reply
+
+    # reply 的异步版本
+    async def areply(self, query, context):
+        if _is_command(query):
+            return await run_sync("llm", self._broadcast, lambda bot: bot.reply(query, context))
+        decision = self._start(context)
+        candidates = decision["candidates"]
+        index, reply, error = 0, None, None
+        while index < len(candidates):
+            if index == 0 and len(candidates) > 1 and hedge.enabled("alternate"):
+                outcomes = []
+                calls = [self._ahedge_call(provider, query, context, decision, outcomes) for provider in candidates[:2]]
+                await self.hedger.arun(calls, _attempt_ok, context.get("cancel_token"))
+            else:
+                outcomes = [(candidates[index], await self._aattempt(candidates[index], query, context, decision))]
+            finished, reply, error = self._finish_attempts(outcomes, decision)
+            if finished:
+                break
+            index += len(outcomes)
+        self._log(decision, context)
+        if error is not None:
+            raise error
+        return reply
+
+    # 请求一个服务，返回 (回复, 异常, 耗时)
+    def _attempt(self, provider, query, context, decision):
+        bot = self._prepare(provider, query, context, decision)
+        start = time.monotonic()
+        try:
+            with trace.span(context, "route." + provider.name), _model_override(provider, context):
+                reply = bot.reply(query, context)
+            return reply, None, time.monotonic() - start
+        except Cancelled:
+            raise
+        except Exception as e:
+            return None, e, time.monotonic() - start
+
+    async def _aattempt(self, provider, query, context, decision):
+        bot = self._prepare(provider, query, context, decision)
+        start = time.monotonic()
+        try:
+            with trace.span(context, "route." + provider.name), _model_override(provider, context):
+                reply = await bot.areply(query, context)
+            return reply, None, time.monotonic() - start
+        except Cancelled:
+            raise
+        except Exception as e:
+            return None, e, time.monotonic() - start
+
+    # 对冲请求中的一次尝试。每次尝试使用 context 的副本（各自的取消标记和模型），结束的尝试按结束顺序加入 outcomes，被取消的不加入
+    def _hedge_call(self, provider, query, context, decision, outcomes):
+        def call(token):
+            start = time.monotonic()
+            try:
+                outcome = self._attempt(provider, query, _fork(context, token), decision)
+            except Cancelled:
+                self._lost(provider, context, time.monotonic() - start)
+                raise
+            outcomes.append((provider, outcome))
+            return outcome
+        return call
+
+    def _ahedge_call(self, provider, query, context, decision, outcomes):
+        async def call(token):
+            start = time.monotonic()
+            try:
+                outcome = await self._aattempt(provider, query, _fork(context, token), decision)
+            except (Cancelled, asyncio.CancelledError):
+                self._lost(provider, context, time.monotonic() - start)
+                raise
+            outcomes.append((provider, outcome))
+            return outcome
+        return call
+
+    # 对冲请求中输掉的服务，已经等待的时间是它耗时的下限，计入平均耗时，否则卡住的服务一直没有耗时记录，排名不会下降
+    def _lost(self, provider, context, seconds):
+        token = context.get("cancel_token")
+        if token is not None and token.cancelled: # 消息本身被取消
+            return
+        with self._lock:
+            provider.record_latency(seconds, conf().get("router_ewma_alpha", 0.3))
+
+    # 记录结束的尝试，返回 (是否结束, 回复, 异常)。成功的尝试最后记录，会话以它为准
+    def _finish_attempts(self, outcomes, decision):
+        finished, reply, error = False, None, None
+        for provider, (reply, error, seconds) in sorted(outcomes, key=lambda item: _attempt_ok(item[1])):
+            finished = self._finish_attempt(provider, reply, error, seconds, decision)
+        return finished, reply, error
+
+    def _start(self, context):
+        ranked = self.rank()
+        max_attempts = conf().get("router_max_attempts", 0) or len(ranked)
+        session_id = context.get("session_id")
+        return {
+            "session_id": session_id,
+            "ranking": [(provider.name, round(score, 3)) for provider, score in ranked],
+            "candidates": [provider for provider, score in ranked[:max_attempts]],
+            # 会话所在的服务，没有路由过的会话在第一个服务中（回复缓存等在 session_bot 中记录的对话）
+            "source": (self.session_providers.get(session_id) or self.providers[0].name) if session_id is not None else None,
+            "attempts": [],
+        }
+
+    # 调用服务前的准备：会话上次使用的是其他服务时，把对话记录转换到这个服务的会话中
+    def _prepare(self, provider, query, context, decision):
+        cancellation.check(context.get("cancel_token"))
+        bot = self.find_bot(provider.name)
+        source = decision["source"]
+        if source is not None and source != provider.name:
+            _copy_session(self.find_bot(source), bot, decision["session_id"], query)
+        context["failover"] = provider is not decision["candidates"][-1] # 还有其他服务可以转移时，bot 出错后不再重试等待
+        return bot
+
+    # 记录一次尝试的结果，返回是否结束（成功或者已经没有其他服务）
+    def _finish_attempt(self, provider, reply, error, seconds, decision):
+        ok = _attempt_ok((reply, error, seconds))
+        last = provider is decision["candidates"][-1]
+        with self._lock:
+            provider.record(seconds, ok, conf().get("router_ewma_alpha", 0.3))
+        ROUTED.inc(provider=provider.name, result="ok" if ok else "error")
+        decision["attempts"].append((provider.name, "ok" if ok else (repr(error) if error else "error_reply"), round(seconds, 3)))
+        session_id = decision["session_id"]
+        if session_id is not None:
+            # 失败的服务也已经把这次的问题加入了会话，下一个服务从它的会话中转换对话记录
+            decision["source"] = provider.name
+            if ok or last:
+                self.session_providers[session_id] = provider.name
+        if ok or last:
+            return True
+        index = decision["candidates"].index(provider)
+        FAILOVERS.inc(source=provider.name, target=decision["candidates"][index + 1].name)
+        return False
+
+    def _broadcast(self, call):
+        result = None
+        for provider in reversed(self.providers): # 返回第一个服务的回复
+            result = call(self.find_bot(provider.name))
+        return result
+
+    def _log(self, decision, context):
+        record = {key: value for key, value in decision.items() if key != "candidates"}
+        record["time"] = time.time()
+        self._decisions.append(record)
+        context["route"] = record
+        logger.info("[router] session={}, ranking={}, attempts={}".format(record["session_id"], record["ranking"], record["attempts"]))
+
+    # 最近的路由决策，用于排查问题
+    def decisions(self, limit=20):
+        return list(self._decisions)[-limit:]
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "provider": p.name,
+                    "latency": p.latency,
+                    "error_rate": p.error_rate,
+                    "failures": p.failures,
+                    "cooling_down": p.cooling_down(now),
+                }
+                for p in self.providers
+            ]
+
+
+def _attempt_ok(outcome):
+    reply, error, seconds = outcome
+    return error is None and reply is not None and reply.type != ReplyType.ERROR
+
+
+# context 的副本，使用自己的取消标记，对冲的两次尝试互不影响
+def _fork(context, token):
+    return Context(context.type, context.content, dict(context.kwargs, cancel_token=token))
+
+
+def _is_command(query):
+    return query in _COMMANDS or query in conf().get("clear_memory_commands", ["#清除记忆"])
+
+
+# 在 context 中设置这个服务使用的模型，调用结束后恢复
+class _model_override:
+    def __init__(self, provider, context):
+        self.key = MODEL_KEYS.get(provider.name, "gpt_model")
+        self.model = provider.model
+        self.context = context
+
+    def __enter__(self):
+        if self.model:
+            self.saved = self.context.get(self.key)
+            self.context[self.key] = self.model
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.model:
+            self.context[self.key] = self.saved
+
+
+# 把会话中的消息转换为 [(角色, 文本)]，角色为 user 或 assistant，不包括系统提示
+def _export_messages(messages):
+    turns = []
+    for message in messages:
+        if "role" in message:
+            role, text = message["role"], message.get("content")
+        elif "sender_type" in message: # minimax
+            role, text = ("user" if message["sender_type"] == "USER" else "assistant"), message.get("text")
+        else:
+            continue
+        if role in ("user", "assistant") and isinstance(text, str):
+            turns.append((role, text))
+    return turns
+
+
+# 用源服务的会话覆盖目标服务的会话。源会话末尾是这次的问题时（刚刚失败的请求加入的）去掉，目标 bot 会重新加入
+def _copy_session(source_bot, target_bot, session_id, query):
+    source_sessions = getattr(source_bot, "sessions", None)
+    target_sessions = getattr(target_bot, "sessions", None)
+    if session_id is None or source_sessions is None or target_sessions is None:
+        return
+    source = source_sessions.build_session(session_id)
+    turns = _export_messages(source.messages)
+    if turns and turns[-1] == ("user", query):
+        turns.pop()
+    target_sessions.clear_session(session_id)
+    target = target_sessions.build_session(session_id, source.system_prompt)
+    for role, text in turns:
+        if role == "user":
+            target.add_query(text)
+        else:
+            target.add_reply(text)
+    logger.debug("[router] copied {} messages of session {} to {}".format(len(turns), session_id, type(target_bot).__name__))
+
+
+_router = None # 最近创建的路由，用于输出指标
+
+
+def _collect(field):
+    def collect():
+        if _router is None:
+            return {}
+        return {(item["provider"],): item[field] or 0 for item in _router.stats()}
+    return collect
+
+
+metrics.gauge("router_latency_ewma_seconds", "Moving average of request latency per chat provider", ["provider"], func=_collect("latency"))
+metrics.gauge("router_error_rate", "Moving average of the error rate per chat provider", ["provider"], func=_collect("error_rate"))
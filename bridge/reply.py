@@ -1,5 +1,8 @@
 # encoding:utf-8
 from enum import Enum
+from itertools import chain
+
+from common.log import logger
 
 class ReplyType(Enum):
     TEXT = 1  # 文本
@@ -15,6 +18,8 @@ class ReplyType(Enum):
     TEXT_ = 11  # 强制文本
     VIDEO = 12
     MINIAPP = 13  # 小程序
+    STREAM = 14  # 流式文本，content 为 ReplyStream
+    DEFERRED = 15  # 模型请求在等待重试，content 为最终回复的 concurrent.futures.Future（见 common/retry.py）
     def __str__(self):
         return self.name
 # Reply 类封装了机器人的回复内容。它包含两个主要属性
@@ -27,3 +32,99 @@ class Reply:
 
     def __str__(self):
         return "Reply(type={}, content={})".format(self.type, self.content)
+
+
+# 句子结束的标点，按句子分段发送流式回复时在这些位置切分
+SENTENCE_ENDS = "。！？!?；;\n"
+
+
+# 流式回复的内容：包装模型逐段返回的文本（delta）的迭代器，只能被消费一次。
+# 消费过程中会累积已经收到的文本，完整结束后通过 on_complete 把全文交给 bot（比如保存到会话），没有输出、中途出错或被放弃时不会调用。
+# 需要全文的地方（插件、语音合成、不支持流式输出的通道）通过 read() 一次读完，相当于把流式回复缓冲成普通的文本回复。
+# 中途出错时记录日志并结束输出，取消（Cancelled）不是 Exception，会直接抛给调用方
+class ReplyStream:
+    def __init__(self, deltas, on_complete=None, error_text=None):
+        self._deltas = deltas # 文本片段的迭代器
+        self._parts = [] # 已经收到的文本片段
+        self._consumed = False
+        self.on_complete = on_complete # 完整结束时的回调，参数为全文
+        self.on_first = None # 收到第一个片段时的回调，用于统计首字延迟
+        self.error_text = error_text # 没有输出任何文本就出错时输出的提示
+        self.done = False # 是否已经完整结束
+        self.error = None # 中途出错时的异常
+        self._source = None # wrap 得到的流所包装的原始流
+
+    def __iter__(self):
+        if self._consumed:
+            raise RuntimeError("reply stream can only be consumed once")
+        self._consumed = True
+        return self._iterate()
+
+    def _iterate(self):
+        try:
+            for delta in self._deltas:
+                if not delta:
+                    continue
+                if not self._parts and self.on_first:
+                    self.on_first()
+                self._parts.append(delta)
+                yield delta
+        except Exception as e:
+            self.error = e
+            logger.exception("[reply_stream] stream interrupted: {}".format(e))
+            if not self._parts and self.error_text:
+                yield self.error_text
+            return
+        self.done = True
+        if self.on_complete and self._parts:
+            self.on_complete(self.text)
+
+    # 已经收到的文本
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    # 读完剩余的片段，返回全文（缓冲适配）
+    def read(self):
+        if not self._consumed:
+            for _ in self:
+                pass
+        if not self._parts and self.error is not None and self.error_text:
+            return self.error_text
+        return self.text
+
+    # 按句子合并片段：攒够 min_chars 个字符后在最后一个句子结束的位置切分，适合每条消息都有开销、不能逐字发送的通道
+    def chunks(self, min_chars=0):
+        buffer = ""
+        for delta in self:
+            buffer += delta
+            if len(buffer) < min_chars:
+                continue
+            cut = max(buffer.rfind(c) for c in SENTENCE_ENDS) + 1
+            if cut < max(min_chars, 1):
+                continue
+            chunk, buffer = buffer[:cut].strip(), buffer[cut:]
+            if chunk:
+                yield chunk
+        if buffer.strip():
+            yield buffer.strip()
+
+    # 返回在前后加上固定文本（回复的前后缀）的新流，原来的流完整结束时仍然调用它的 on_complete
+    def wrap(self, prefix="", suffix=""):
+        if not prefix and not suffix:
+            return self
+        stream = ReplyStream(chain([prefix], self, [suffix]))
+        stream._source = self
+        return stream
+
+    # 放弃剩余的输出，关闭底层的迭代器（比如释放 HTTP 连接）
+    def close(self):
+        self._consumed = True
+        close = getattr(self._deltas, "close", None)
+        if close:
+            close()
+        if self._source is not None:
+            self._source.close()
+
+    def __str__(self):
+        return "ReplyStream(done={}, text={})".format(self.done, self.text)
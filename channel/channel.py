@@ -5,6 +5,9 @@ from bridge.reply import *
 class Channel(object):
     channel_type = "" # 通道类型，初始化为空字符串
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE, ReplyType.IMAGE] # 不支持的回复类型（语音和图片）
+    # 流式回复（stream_reply）的输出方式：render 为收到一段输出一段（子类实现 send_stream），
+    # sentence 为按句子分段、以普通文本消息发送，None 为不支持流式回复（模型生成完后一次回复）
+    STREAM_MODE = "sentence"
     def startup(self):
         raise NotImplementedError # 子类需要实现该方法，初始化通道时调用
     # 处理收到的文本消息,msg: 消息对象，包含接收到的文本
@@ -13,9 +16,15 @@ class Channel(object):
     # 统一的发送函数，每个Channel自行实现，根据回复的类型发送不同类型的消息
     def send(self, reply: Reply, context: Context):
         raise NotImplementedError
+    # 逐段输出流式回复，STREAM_MODE 为 render 的通道实现，stream 为 ReplyStream，迭代得到每一段文本
+    def send_stream(self, stream: ReplyStream, context: Context):
+        raise NotImplementedError
     # 构建回复内容，底层调用不同模型的聊天机器人回复文本消息
     def build_reply_content(self, query, context: Context = None) -> Reply:
         return Bridge().fetch_reply_content(query, context)
+    # 异步构建回复内容，异步模式（async_mode）下使用
+    async def abuild_reply_content(self, query, context: Context = None) -> Reply:
+        return await Bridge().afetch_reply_content(query, context)
     # 将语音文件转为文本，底层调用语音转换成文本的不同的api
     def build_voice_to_text(self, voice_file) -> Reply:
         return Bridge().fetch_voice_to_text(voice_file)
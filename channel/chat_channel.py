@@ -1,14 +1,30 @@
+import asyncio
+import heapq
 import os
 import re
 import threading
 import time
 from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Full
+from concurrent.futures import Future, InvalidStateError, CancelledError as FutureCancelledError
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
 from common.dequeue import Dequeue
 from common import memory
+from common.worker_pool import get_pool
+from common import async_loop
+from common import trace as tracer
+from common import metrics
+from common import cancellation
+from common import rate_limiter
+from common.cancellation import CancelToken, Cancelled
+from common.journal import get_journal, dump_context, load_context
+from channel.message_coalescer import MessageCoalescer
+from channel.fair_scheduler import FairScheduler
+from channel.context_matcher import at_pattern, get_matcher
+from channel.process_workers import get_process_workers
+from config import global_config
 from plugins import *
 try:
     from voice.audio_convert import any_to_wav
@@ -17,7 +33,15 @@ except Exception as e:
 # handler_pool 是在模块级别定义的一个变量，这意味着它 只在当前模块中是全局的。在当前模块内，任何函数、类或者方法都可以访问它
 # ，前提是它们在 handler_pool 被定义之后调用。
 # 但它并没有被声明为 全局变量，因此在模块外部无法直接访问。
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+# 消息处理按阶段使用不同的线程池（见 common/worker_pool.py）：生成回复在 llm 池，语音转码在 media 池，装饰和发送回复在 send 池。
+# handler_pool 指向 llm 池，保留这个名字是为了兼容直接访问它的子类通道
+handler_pool = get_pool("llm")  # 处理消息的线程池
+# 消息收发的指标，channel 标签为通道类型
+MESSAGES_RECEIVED = metrics.counter("chat_messages_received_total", "Messages received by the channel", ["channel"])
+MESSAGES_DROPPED = metrics.counter("chat_messages_dropped_total", "Messages dropped because the queue was full", ["channel", "policy"])
+MESSAGES_REPLIED = metrics.counter("chat_messages_replied_total", "Replies sent successfully", ["channel"])
+# 消息在会话队列中等待派发的时间，lane 为 command（管理命令）、admin（管理员）、group（群聊）、private（私聊）
+QUEUE_WAIT = metrics.histogram("chat_queue_wait_seconds", "Time messages wait in the session queue before dispatch", ["lane"])
 # 抽象类, 它包含了与具体的子类消息通道无关的通用处理逻辑
 # 一个 ChatChannel 实例 ：表示一个消息通道的实例，它负责处理消息的接收和发送。
 # 多个 session_id ：表示多个会话的标识，每个会话可能对应一个用户或一个群聊。
@@ -33,17 +57,51 @@ class ChatChannel(Channel):
     futures = {} # futures 用来存储与每个会话相关联的 future 对象，可以用于检查线程池中任务的执行状态，以及在需要时取消任务。
     sessions = {} # sessions 用来存储与每个 session_id 相关的消息队列和信号量。这是为了确保同一个会话中的消息按顺序处理 
     lock = threading.Lock() # lock 是一个线程锁，确保对 sessions 和 futures 的访问是线程安全的，以避免多线程并发操作时发生数据竞争。
+    # 就绪队列：只存放“有待处理消息、可能可以派发”的 session_id，consume 只需要处理这些会话，而不是每次遍历所有会话。
+    # 会话之间按权重公平调度，管理命令走优先通道（见 channel/fair_scheduler.py）
+    scheduler = FairScheduler()
+    session_flows = {} # session_id --> (调度的流, 权重, 类别)，由会话最近一条消息决定
+    # 条件变量和 lock 共用同一把锁，produce 和任务完成回调在持锁状态下 notify，唤醒 consume 线程
+    ready_cond = threading.Condition(lock)
+    queued_count = 0 # 所有会话中排队等待处理的消息总数
+    in_flight = 0 # 已派发到线程池、还没有处理完的消息总数
+    generating = 0 # 已派发、还在生成回复的消息数。回复生成后（或者等待重试时）就不再计入，公平调度的默认上限按它计算
+    shed_counts = {"drop_oldest": 0, "drop_newest": 0, "busy_reply": 0} # 过载时按不同策略丢弃的消息数
+    cancel_tokens = {} # session_id --> 已派发、还没处理完的普通消息的 CancelToken 列表，cancel_session 时取消（见 common/cancellation.py）
+    deferred = [] # 被限流延后的会话，(可以重新派发的时间, session_id) 的最小堆（见 common/rate_limiter.py）
     # 每个 ChatChannel 实例 只有一个后台线程执行 consume 方法，而 不是为每个 ChatChannel 实例创建多个线程。
-    # 该线程在后台不断地检查消息队列是否有待处理的消息，并将其提交到线程池中处理。
+    # 该线程平时阻塞在条件变量上，只有当有会话变为就绪状态时才会被唤醒，并将消息提交到线程池中处理。
     def __init__(self):
+        self.coalescer = MessageCoalescer(self._enqueue) # 连续消息合并，未开启 message_coalesce_window 时直接入队
         _thread = threading.Thread(target=self.consume) # 初始化一个后台线程，执行 consume 方法。
         _thread.setDaemon(True) # 将线程设置为守护线程（daemon thread）。
         _thread.start() # 启动线程后，线程进入 就绪状态，等待 CPU 调度
 
-    # 根据消息构造context，消息内容相关的触发项写在这里
+    # 根据消息构造context，首次构造时按 trace_sample_rate 决定是否追踪这条消息的处理耗时，并创建用于取消处理的 cancel_token
     def _compose_context(self, ctype: ContextType, content, **kwargs):
+        first_in = "receiver" not in kwargs
+        if first_in:
+            kwargs["cancel_token"] = CancelToken()
+            trace = tracer.start_trace(getattr(kwargs.get("msg"), "msg_id", None))
+            if trace is not None:
+                kwargs["trace"] = trace # kwargs 会成为 context.kwargs，后续各阶段通过 context["trace"] 记录耗时
+        with tracer.span(kwargs, "compose_context"):
+            context = self._build_context(ctype, content, **kwargs)
+        if context is None and first_in: # 消息不需要处理，追踪到此结束
+            tracer.finish(kwargs, status="ignored")
+        if first_in and context is not None and context.type == ContextType.TEXT and self._stream_enabled():
+            context["stream"] = True # bot 返回流式回复（ReplyType.STREAM）
+        return context
+
+    # 是否请求流式回复：回复在工作进程中生成时无法把流传回当前进程
+    def _stream_enabled(self):
+        return conf().get("stream_reply", False) and self.STREAM_MODE is not None and conf().get("process_workers", 0) <= 0
+
+    # 根据消息构造context，消息内容相关的触发项写在这里
+    def _build_context(self, ctype: ContextType, content, **kwargs):
         context = Context(ctype, content) # 创建一个新的 Context 对象，类型为 ctype，内容为 content
         context.kwargs = kwargs  # 将其他参数存储到 context 的 kwargs 属性中
+        matcher = get_matcher() # 根据当前配置预编译的白名单、前缀和关键词，配置变化时自动重建
         # 在第一次进入这个方法时，会在上下文中设置消息的原始类型
         if "origin_ctype" not in context:
             context["origin_ctype"] = ctype 
@@ -52,7 +110,6 @@ class ChatChannel(Channel):
         # 单聊：如果是单聊消息，那么 cmsg.from_user_id 和 cmsg.actual_user_id 是相同的，因为只有一个发送者。
         # 群聊：在群聊中，cmsg.from_user_id 可能是群聊的 ID（因为消息是发到群的），而 cmsg.actual_user_id 是发送消息的具体群成员的 ID。
         if first_in:  # 如果是首次传入
-            config = conf() # 获取配置
             cmsg = context["msg"] # 获取上下文中的ChatMessage实例
             # 这是消息的发送者 ID。在单聊中，它通常指的是发送消息的用户；在群聊中，它可能是群聊消息中的用户 ID。
             # 场景：用于标识消息的发起者，通常是消息发送者的 ID。
@@ -64,26 +121,14 @@ class ChatChannel(Channel):
                 group_id = cmsg.other_user_id # 获取群 ID
                 # 群名称白名单列表：是一个配置项，包含了允许机器人回复的群聊名称（或者说群组的昵称）。这个列表中的群聊，机器人才
                 # 会处理其发来的消息。
-                group_name_white_list = config.get("group_name_white_list", [])  
                 # 群名称关键字白名单列表：这个列表包含了一些关键字，只要群名称中包含这些关键字，该群的消息就会被机器人回复。它提供了
                 # 比直接匹配群名称白名单更灵活的方式。群聊的名称只要包含关键字，就会被认为是有效的群组。
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", []) 
-                # any() 函数接受一个可迭代对象（如列表、元组等），如果可迭代对象中的任何一个元素为 True，则 any() 返回 True；否则返回 False。
-                # 这里传入的列表包含了 三个条件：
-                # group_name in group_name_white_list：判断群名称是否在群名称白名单列表中。
-                # "ALL_GROUP" in group_name_white_list：判断是否存在一个特殊的白名单项 "ALL_GROUP"，这个值表示所有群组都可以被允许。
-                # 最后一个条件：检查群名称是否包含在群名称关键字白名单列表中的某个关键字。
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
+                # 满足以下任一条件即可：群名称在群名称白名单列表中；白名单中有特殊项 "ALL_GROUP"，表示所有群组都可以被允许；
+                # 群名称包含群名称关键字白名单列表中的某个关键字。
+                if matcher.group_allowed(group_name):
                     # group_chat_in_one_session 是一个配置项，用来定义哪些群聊应该在同一个会话中进行处理。这个配置通常用于限制
                     # 在特定群组内，所有的消息都可以使用相同的会话 ID。
                     # 这个配置项是一个包含群组名称的列表，表示这些群组的消息会被视为属于同一个会话进行处理
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
                     # 这一行设置 session_id 为 cmsg.actual_user_id，即群消息中的实际发送者ID
                     # 这里的 session_id 可能用于跟踪与该用户相关的所有消息，确保机器人能够在多轮对话中维持会话上下文。
                     # 在一个时刻多个用户发送消息时，每个用户的 session_id 都是独立的，即每个用户会有一个自己的 session_id。在这种情
@@ -97,12 +142,7 @@ class ChatChannel(Channel):
                     # "ALL_GROUP" in group_chat_in_one_session：这是一个特殊的条件，检查 group_chat_in_one_session 中是否
                     # 包含 "ALL_GROUP"。如果包含，意味着所有群聊中的消息都应该共享同一个会话 ID。也就是说，无论是哪一个群的消息，都会使
                     # 用相同的 session_id。
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
+                    if matcher.group_in_one_session(group_name):
                         # session_id = group_id 将 会话 ID 设置为群组 ID，也就是说，在该群中的所有消息都会共享同一个 session_id，
                         # 而不是基于发送者的用户 ID。这样做的目的是让同一个群聊中的所有消息被视为同一个会话，方便机器人进行群体回复。
                         # 同一个群聊内的消息共享 session_id：这样做的好处是，群内所有人的消息都会被视为同一个会话，机器人可以根据群组 ID 
@@ -125,7 +165,7 @@ class ChatChannel(Channel):
             if e_context.is_pass() or context is None:
                 return context
             # 如果消息是机器人自己发送的且配置中不允许处理自己发送的消息，返回None
-            if cmsg.from_user_id == self.user_id and not config.get("trigger_by_self", True):
+            if cmsg.from_user_id == self.user_id and not matcher.trigger_by_self:
                 logger.debug("[chat_channel]self message skipped")
                 return None
         # 处理文本消息内容,群聊和私聊时处理@
@@ -135,12 +175,12 @@ class ChatChannel(Channel):
                 logger.debug(content) # 输出当前内容到日志
                 logger.debug("[chat_channel]reference query skipped") # 输出跳过处理的日志
                 return None  # 跳过此次处理，返回 None
-            # 获取黑名单中的昵称列表
-            nick_name_black_list = conf().get("nick_name_black_list", [])
+            # 获取黑名单中的昵称集合
+            nick_name_black_list = matcher.nick_name_black_list
             if context.get("isgroup", False):  # 如果是群聊消息，处理群聊相关的逻辑
                 # match_prefix检查content是否包含@bot这样的前缀,match_contain检查是否包含这些关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match_prefix = matcher.match_group_prefix(content)
+                match_contain = matcher.match_group_keyword(content)
                 flag = False # 标志位，是否触发了机器人的回复
                 # 如果消息接收者不是实际发送者
                 # 在群聊中 机器人自己发送的消息，to_user_id 和 actual_user_id 是相同的，因为发送者和接收者都是机器人。(过滤的是这种情况)
@@ -166,28 +206,26 @@ class ChatChannel(Channel):
                         # group_at_off 控制机器人是否响应群聊中的 @ 提及。
                         # 如果 group_at_off 为 False（或未设置），意味着机器人会响应群聊中的 @ 消息，无论是 @bot 还是 @其他用户。
                         # 如果 group_at_off 为 True，则机器人不会响应任何群聊中的 @ 消息。
-                        if not conf().get("group_at_off", False):
+                        if not matcher.group_at_off:
                             flag = True # 如果在群聊中机器人被@,机器人会处理回复
                          # 确保 self.name 已经赋值
                         self.name = self.name if self.name is not None else "" 
                         # 匹配@self.name(一般是bot),后面跟空格或四分之一空格的模式
                         # 如果 self.name = "chatbot\u2005"（四分之一空格），re.escape(self.name) 会返回 chatbot\u2005，
                         # 而不是将它转化为 \u2005 形式。
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        # re.sub 会扫描 content 中的文本，找到所有符合 pattern 的部分，并用空字符串 r"" 将它们替换掉，
+                        # 编译好的正则按昵称缓存，不需要每条消息重新拼接
+                        # sub 会扫描 content 中的文本，找到所有符合 pattern 的部分，并用空字符串 r"" 将它们替换掉，
                         # 最终返回替换后的结果 subtract_res。
-                        subtract_res = re.sub(pattern, r"", content)
+                        subtract_res = at_pattern(self.name).sub(r"", content)
                         # at_list 通常是指被@的用户的昵称列表，也就是说，at_list 中保存了所有在当前消息中提到（@）的群成员的昵称。
                         # 如果消息中有@群内其他人的情况，它会删除所有类似 @user 后跟空格的提及部分。
                         if isinstance(context["msg"].at_list, list):
                             for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
+                                subtract_res = at_pattern(at).sub(r"", subtract_res)
                         # context["msg"](ChatMessage实例).self_display_name 指的是 机器人在当前群聊中的显示昵称。
                         # 这里移除content中@机器人昵称的部分
                         if subtract_res == content and context["msg"].self_display_name:
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = at_pattern(context["msg"].self_display_name).sub(r"", content)
                         content = subtract_res # 更新content会去除@后的部分
                 # 虽然接收到的origin_ctype是语音，但由于没有触发机器人回复(flag=Faslse)，机器人不会回复，并且通过日志提示这一点。
                 if not flag:
@@ -200,7 +238,7 @@ class ChatChannel(Channel):
                     logger.warning(f"[chat_channel] Nickname '{nick_name}' in In BlackList, ignore")
                     return None
                 # 检查私聊消息是否匹配前缀
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = matcher.match_single_prefix(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()  # 去掉匹配到的前缀
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -208,7 +246,7 @@ class ChatChannel(Channel):
                 else:
                     return None # 如果没有匹配到前缀，且不是语音消息,返回None
             content = content.strip() # 去除内容前后的空白字符
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix",[""])) # 检查消息是否包含图像生成的前缀(画)
+            img_match_prefix = matcher.match_image_prefix(content) # 检查消息是否包含图像生成的前缀(画)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)  # 移除图像生成命令前缀
                 context.type = ContextType.IMAGE_CREATE # 设置消息类型为图像生成
@@ -217,28 +255,127 @@ class ChatChannel(Channel):
             context.content = content.strip()  # 更新消息内容，去除空格
             # 回复类型的设置：如果消息上下文中没有设置 desire_rtype（期望的回复类型），并且配置总是回复语音（always_reply_voice）
             # ，则将期望的回复类型设置为语音（ReplyType.VOICE）。
-            if "desire_rtype" not in context and conf().get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and matcher.always_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE  # 设置期望的回复类型为语音
         # 处理语音消息的回复类型：对于语音消息，如果没有设置期望的回复类型，并且配置语音回复，则将 desire_rtype 设置为语音
         elif context.type == ContextType.VOICE:
-            if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and matcher.voice_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE # 设置期望的语音回复类型
         return context
-    # 处理消息
-    def _handle(self, context: Context):
-        if context is None or not context.content: # 判断context是否为空或其内容为空，如果为空则返回
-            return
-        # 打印调试信息，表示准备处理context
-        logger.debug("[chat_channel] ready to handle context: {}".format(context))
-        # 生成回复的步骤
-        reply = self._generate_reply(context)
-        # 打印调试信息，表示准备包装回复
-        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
-        # 如果回复不为空且有内容，进行回复的包装
-        if reply and reply.content:
-            reply = self._decorate_reply(context, reply)
-            # 发送包装后的回复
-            self._send_reply(context, reply)
+
+    # 按阶段在不同线程池之间流转处理消息：在 llm 池中生成回复，然后切换到 send 池中装饰并发送回复。
+    # 返回代表整个处理流程的 future，只有发送完成后它才会结束，所以会话的信号量会一直占用到回复发出为止，保证同一会话的回复顺序。
+    # 生成阶段结束（回复已生成、出错或者等待重试）时调用 on_generated，释放生成回复的名额
+    def _submit_handle(self, context: Context, on_generated=lambda: None) -> Future:
+        if conf().get("async_mode", False): # 异步模式下，整个处理流程作为协程运行在后台事件循环中
+            return async_loop.submit(self._ahandle(context))
+        if conf().get("process_workers", 0) > 0: # 多进程模式下，回复在工作进程中生成
+            return self._submit_process(context, on_generated)
+        future = Future()
+
+        def send_stage(reply):
+            try:
+                with tracer.span(context, "decorate_reply"):
+                    reply = self._decorate_reply(context, reply) # 装饰回复
+                self._send_reply(context, reply) # 发送包装后的回复
+                _set_result(future)
+            except BaseException as e:
+                _set_exception(future, e)
+
+        def generated(reply):
+            logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+            if not reply or not reply.content: # 没有回复内容，流程结束
+                _set_result(future)
+                return
+            try:
+                get_pool("send").submit(send_stage, reply)
+            except Full: # send 池排队已满时，直接在当前线程中发送，不丢弃已经生成的回复
+                send_stage(reply)
+
+        def retried(deferred: Future):
+            try:
+                reply = deferred.result()
+            except BaseException as e:
+                _set_exception(future, e)
+                return
+            generated(reply)
+
+        def generate_stage():
+            if not future.set_running_or_notify_cancel(): # 任务在开始执行前已被取消
+                return
+            try:
+                if context is None or not context.content: # 判断context是否为空或其内容为空，如果为空则返回
+                    _set_result(future)
+                    return
+                logger.debug("[chat_channel] ready to handle context: {}".format(context))
+                context["defer_retry"] = True # 模型请求需要重试时不在当前线程中等待（见 common/retry.py）
+                reply = self._generate_reply(context) # 生成回复的步骤
+            except BaseException as e:
+                on_generated()
+                _set_exception(future, e)
+                return
+            on_generated() # 之后的发送、发送重试和等待模型重试都不占用生成回复的名额
+            if reply and reply.type == ReplyType.DEFERRED: # 重试完成后在 llm 池中继续，等待期间不占用线程
+                reply.content.add_done_callback(retried)
+                return
+            generated(reply)
+
+        try:
+            handler_pool.submit(generate_stage)
+        except Full as e: # llm 池排队已满，放弃处理这条消息
+            logger.warning("[chat_channel] handler pool is full, drop context: {}".format(context))
+            future.set_exception(e)
+        return future
+
+    # 多进程模式：按 session_id 分片交给工作进程生成并装饰回复（见 channel/process_workers.py），回复回到当前进程后在 send 池中发送
+    def _submit_process(self, context: Context, on_generated=lambda: None) -> Future:
+        future = Future()
+        span = tracer.span(context, "process_worker")
+
+        def send_stage(reply):
+            try:
+                self._send_reply(context, reply) # 工作进程中已经装饰过回复，这里直接发送
+                _set_result(future)
+            except BaseException as e:
+                _set_exception(future, e)
+
+        def on_reply(worker_future: Future):
+            span.__exit__(None, None, None)
+            on_generated()
+            if not future.set_running_or_notify_cancel(): # 等待回复期间任务已被取消，不再发送
+                return
+            try:
+                reply = worker_future.result()
+            except BaseException as e:
+                _set_exception(future, e)
+                return
+            if not reply: # 没有回复内容，流程结束
+                _set_result(future)
+                return
+            try:
+                get_pool("send").submit(send_stage, reply)
+            except Full:
+                send_stage(reply)
+
+        def dispatch():
+            if future.cancelled():
+                return
+            try:
+                if context.get("msg") is not None:
+                    context["msg"].prepare() # 附件（比如语音文件）在当前进程中下载，工作进程无法使用原始消息对象
+                span.__enter__()
+                get_process_workers(self).submit(context).add_done_callback(on_reply)
+            except BaseException as e:
+                on_generated()
+                if future.set_running_or_notify_cancel():
+                    _set_exception(future, e)
+
+        try:
+            handler_pool.submit(dispatch)
+        except Full as e: # llm 池排队已满，放弃处理这条消息
+            logger.warning("[chat_channel] handler pool is full, drop context: {}".format(context))
+            future.set_exception(e)
+        return future
 
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
         # 调用插件管理实例的触发事件逻辑,内部会依照优先级调用事件对应的一系列插件对消息做处理,直到
@@ -257,6 +394,7 @@ class ChatChannel(Channel):
             # 处理文字消息和图片创建消息
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  
                 context["channel"] = e_context["channel"] # 设置消息上下文通道为e_context的通道
+                cancellation.check(context.get("cancel_token")) # 插件处理期间消息可能已经被取消
                 # 底层实际调用聊天机器人的回复方法(传入用户发送消息,消息上下文)
                 reply = super().build_reply_content(context.content, context)
             # context.type 表示的是用户发送的消息类型是语音类型。
@@ -265,13 +403,18 @@ class ChatChannel(Channel):
                 cmsg.prepare()
                 file_path = context.content # 上下文中的内容是语音文件的路径
                 wav_path = os.path.splitext(file_path)[0] + ".wav" # 构建wav文件路径
+                cancellation.check(context.get("cancel_token"))
                 try:
-                    any_to_wav(file_path, wav_path) # 尝试将语音文件转换为wav格式
+                    # 转码是 CPU 密集型任务，放到 media 线程池中执行，避免大量语音消息占满处理回复的线程
+                    with tracer.span(context, "voice_convert"):
+                        get_pool("media").submit(any_to_wav, file_path, wav_path).result() # 尝试将语音文件转换为wav格式
                 except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
                     logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
                     wav_path = file_path
                 # 语音识别，将语音转为文字
-                reply = super().build_voice_to_text(wav_path)
+                cancellation.check(context.get("cancel_token"))
+                with tracer.span(context, "voice_to_text"):
+                    reply = super().build_voice_to_text(wav_path)
                 # 删除临时文件
                 try:
                     os.remove(file_path)
@@ -302,7 +445,44 @@ class ChatChannel(Channel):
                 return
         return reply # 返回最终生成的回复
 
+    # 异步模式下的消息处理流程，和 _submit_handle 中的同步流程对应。等待模型返回时不占用线程，插件事件等同步逻辑在线程池中执行
+    async def _ahandle(self, context: Context):
+        if context is None or not context.content: # 判断context是否为空或其内容为空，如果为空则返回
+            return
+        logger.debug("[chat_channel] ready to handle context: {}".format(context))
+        reply = await self._agenerate_reply(context) # 生成回复的步骤
+        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+        if reply and reply.content:
+            with tracer.span(context, "decorate_reply"):
+                reply = await async_loop.run_sync("send", self._decorate_reply, context, reply)
+            await self._asend_reply(context, reply) # 发送包装后的回复
+
+    # 异步生成回复，只有文字消息和图片创建消息会异步调用聊天机器人，其他类型的消息仍然在线程池中走同步流程
+    async def _agenerate_reply(self, context: Context, reply: Reply = None) -> Reply:
+        if context.type != ContextType.TEXT and context.type != ContextType.IMAGE_CREATE:
+            return await async_loop.run_sync("llm", self._generate_reply, context)
+        reply = reply or Reply()
+        e_context = await async_loop.run_sync(
+            "llm",
+            PluginManager().emit_event,
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": reply},
+            ),
+        )
+        reply = e_context["reply"] # 更新reply为插件事件处理后的回复内容
+        if not e_context.is_pass(): # 如果e_context的事件传播行为不是BREAK_PASS,调用默认的事件处理逻辑
+            logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
+            context["channel"] = e_context["channel"]
+            cancellation.check(context.get("cancel_token"))
+            reply = await self.abuild_reply_content(context.content, context)
+        return reply
+
     def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
+        # 流式回复需要全文时先读完，缓冲成普通的文本回复
+        if reply and reply.type == ReplyType.STREAM and self._need_full_text(context):
+            with tracer.span(context, "read_stream"):
+                reply = Reply(ReplyType.TEXT, reply.content.read())
         # 如果回复对象存在且其类型有效
         if reply and reply.type:
             e_context = PluginManager().emit_event( # 触发插件事件，处理回复装饰操作
@@ -324,7 +504,9 @@ class ChatChannel(Channel):
                     reply_text = reply.content
                     # 如果期望的是语音类型的回复，且语音回复类型支持
                     if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
-                        reply = super().build_text_to_voice(reply.content) # 将文本转换为语音，并递归调用装饰方法
+                        cancellation.check(context.get("cancel_token")) # 已取消的消息不再合成语音
+                        with tracer.span(context, "text_to_voice"):
+                            reply = super().build_text_to_voice(reply.content) # 将文本转换为语音，并递归调用装饰方法
                         return self._decorate_reply(context, reply)
                     if context.get("isgroup", False): # 如果是群组消息，处理@操作和群聊前后缀
                         if not context.get("no_need_at", False): # 需要@的情况
@@ -333,6 +515,16 @@ class ChatChannel(Channel):
                     else: # 如果是私聊，处理私聊前后缀(私聊不需要加@)
                         reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
                     reply.content = reply_text # 更新回复内容为处理后的回复
+                # 流式回复，在输出的前后加上@和前后缀
+                elif reply.type == ReplyType.STREAM:
+                    if context.get("isgroup", False):
+                        prefix = "" if context.get("no_need_at", False) else "@" + context["msg"].actual_user_nickname + "\n"
+                        prefix = conf().get("group_chat_reply_prefix", "") + prefix
+                        suffix = conf().get("group_chat_reply_suffix", "")
+                    else:
+                        prefix = conf().get("single_chat_reply_prefix", "")
+                        suffix = conf().get("single_chat_reply_suffix", "")
+                    reply.content = reply.content.wrap(prefix, suffix)
                # 如果回复类型是错误或信息类型，添加前缀标记
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
@@ -347,6 +539,12 @@ class ChatChannel(Channel):
                 logger.warning("[chat_channel] desire_rtype: {}, but reply type: {}".format(context.get("desire_rtype"), reply.type))
             return reply # 返回最终装饰后的回复
 
+    # 流式回复是否需要先读完全文：通道不支持流式输出、需要合成语音，或者有插件要处理完整的回复（比如 Banwords 过滤敏感词）
+    def _need_full_text(self, context: Context):
+        if self.STREAM_MODE is None or context.get("desire_rtype") == ReplyType.VOICE:
+            return True
+        return PluginManager().has_listeners(Event.ON_DECORATE_REPLY, Event.ON_SEND_REPLY)
+
     def _send_reply(self, context: Context, reply: Reply):
         if reply and reply.type: # 如果回复对象存在且其类型有效
             e_context = PluginManager().emit_event( # 触发插件事件，处理发送回复的逻辑
@@ -362,17 +560,92 @@ class ChatChannel(Channel):
                 self._send(reply, context) # 调用发送方法将回复发送出去
 
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
+        if self._is_cancelled(context, reply):
+            return
+        if reply.type == ReplyType.STREAM:
+            self._send_stream(reply, context)
+            return
         try:
-            self.send(reply, context) # 调用具体子类的send 方法实际发送消息
+            with tracer.span(context, "send"):
+                self.send(reply, context) # 调用具体子类的send 方法实际发送消息
+            MESSAGES_REPLIED.inc(channel=self._metrics_label())
         except Exception as e: # 如果出现异常
             logger.error("[chat_channel] sendMsg error: {}".format(str(e))) # 记录发送消息时的错误
             if isinstance(e, NotImplementedError): # 如果是 NotImplementedError 异常，则不做处理，直接返回
                 return
             logger.exception(e) # 记录异常详细信息
             if retry_cnt < 2: # 如果重试次数小于 2，则进行重试
-                time.sleep(3 + 3 * retry_cnt) # 等待 3 秒后进行重试，重试次数越多，等待时间越长
+                try:
+                    # 等待 3 秒后进行重试，重试次数越多，等待时间越长，等待期间消息被取消则不再重试
+                    cancellation.sleep(context.get("cancel_token"), 3 + 3 * retry_cnt)
+                except Cancelled:
+                    return
                 self._send(reply, context, retry_cnt + 1) # 递归调用 _send 方法进行重试
 
+    # 发送流式回复：render 模式交给通道逐段输出，sentence 模式按句子分段，每段作为普通文本消息发送。
+    # 已经输出的部分无法撤回，所以整体出错时不重试；分段发送时每段各自按 _send 的逻辑重试
+    def _send_stream(self, reply: Reply, context: Context):
+        stream = reply.content
+        try:
+            if self.STREAM_MODE == "render":
+                try:
+                    with tracer.span(context, "send"):
+                        self.send_stream(stream, context)
+                    MESSAGES_REPLIED.inc(channel=self._metrics_label())
+                except Exception as e:
+                    logger.exception("[chat_channel] send stream error: {}".format(e))
+            else:
+                for chunk in stream.chunks(conf().get("stream_chunk_min_chars", 50)):
+                    if self._is_cancelled(context, reply):
+                        return
+                    self._send(Reply(ReplyType.TEXT, chunk), context)
+        finally:
+            stream.close()
+
+    # 异步发送回复，和 _send_reply 对应
+    async def _asend_reply(self, context: Context, reply: Reply):
+        if reply and reply.type:
+            e_context = await async_loop.run_sync(
+                "send",
+                PluginManager().emit_event,
+                EventContext(
+                    Event.ON_SEND_REPLY,
+                    {"channel": self, "context": context, "reply": reply},
+                ),
+            )
+            reply = e_context["reply"]
+            if not e_context.is_pass() and reply and reply.type:
+                logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
+                await self._asend(reply, context)
+
+    # 异步发送，重试时用 asyncio.sleep 等待，不会占用线程
+    async def _asend(self, reply: Reply, context: Context, retry_cnt=0):
+        if self._is_cancelled(context, reply):
+            return
+        if reply.type == ReplyType.STREAM: # 读取流式回复会阻塞，在 send 池中完成
+            await async_loop.run_sync("send", self._send_stream, reply, context)
+            return
+        try:
+            with tracer.span(context, "send"):
+                await async_loop.run_sync("send", self.send, reply, context)
+            MESSAGES_REPLIED.inc(channel=self._metrics_label())
+        except Exception as e:
+            logger.error("[chat_channel] sendMsg error: {}".format(str(e)))
+            if isinstance(e, NotImplementedError):
+                return
+            logger.exception(e)
+            if retry_cnt < 2:
+                await asyncio.sleep(3 + 3 * retry_cnt)
+                await self._asend(reply, context, retry_cnt + 1)
+
+    # 消息已被取消时不再发送回复
+    def _is_cancelled(self, context: Context, reply: Reply):
+        token = context.get("cancel_token")
+        if token is not None and token.cancelled:
+            logger.info("[chat_channel] message cancelled ({}), drop reply: {}".format(token.reason, reply))
+            return True
+        return False
+
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
         # 打印调试日志，记录成功的线程结束，输出 session_id
         logger.debug("Worker return success, session_id = {}".format(session_id))
@@ -381,28 +654,125 @@ class ChatChannel(Channel):
         # 记录异常信息到日志，输出线程抛出的异常
         logger.exception("Worker return exception: {}".format(exception))
     # 定义并返回一个实际的回调函数，在任务执行完毕后调用
-    def _thread_pool_callback(self, session_id, **kwargs):
+    # release 为 consume 中占用的生成回复名额，生成阶段没有执行（比如任务被取消）时在这里释放
+    def _thread_pool_callback(self, session_id, release=lambda: None, **kwargs):
         def func(worker: Future):
+            release()
+            status = "ok"
             try:
                 # worker.exception(),如果任务有异常，它返回的是异常对象；如果没有异常，则返回 None。
                 worker_exception = worker.exception() # 检查任务是否抛出了异常
-                if worker_exception:
+                if isinstance(worker_exception, Cancelled): # 处理过程中被 cancel_session 取消
+                    status = "cancelled"
+                    logger.info("Worker cancelled, session_id = {}".format(session_id))
+                elif worker_exception:
+                    status = "error"
                     # 如果任务执行中抛出异常，调用失败的回调函数
                     self._fail_callback(session_id, exception=worker_exception, **kwargs)
                 else:
                     self._success_callback(session_id, **kwargs) # 如果任务执行成功，调用成功的回调函数
-            except CancelledError as e:
+            except (CancelledError, FutureCancelledError) as e: # 线程池和事件循环中的任务被取消时抛出的异常类型不同
+                status = "cancelled"
                 logger.info("Worker cancelled, session_id = {}".format(session_id)) # 如果任务被取消，打印相关日志
             except Exception as e: # 其他异常，记录异常日志
                 logger.exception("Worker raise exception: {}".format(e))
+            tracer.finish(kwargs.get("context"), status=status) # 消息处理结束，导出追踪记录
+            _journal_done(kwargs.get("context")) # 在消息日志中记录处理结束，重启后不再重放
             # 在此释放信号量，标志着该任务的处理完毕,1指信号量对应的索引
             with self.lock:
                 self.sessions[session_id][1].release()
+                self.in_flight -= 1
+                if self.scheduler and not self._over_budget(): # 空出了全局并发配额，唤醒可能在等待的 consume 线程
+                    self.ready_cond.notify()
+                if session_id in self.futures: # 顺便过滤掉已完成的任务
+                    self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
+                token = kwargs["context"].get("cancel_token")
+                if token in self.cancel_tokens.get(session_id, ()): # 消息处理完毕，不再需要取消
+                    self.cancel_tokens[session_id].remove(token)
+                # 信号量空出一个位置，如果队列中还有消息，会话重新进入就绪队列；否则尝试回收空闲会话
+                if not self.sessions[session_id][0].empty():
+                    self._mark_ready(session_id)
+                else:
+                    self._release_idle_session(session_id)
 
         return func
+
+    # 把会话标记为就绪并唤醒 consume 线程，队首是管理命令时放入优先通道，调用方必须已经持有 self.lock
+    def _mark_ready(self, session_id):
+        context_queue = self.sessions[session_id][0]
+        priority = bool(context_queue.queue) and _is_command(context_queue.queue[0])
+        flow_key, weight, _ = self.session_flows.get(session_id, (session_id, 1.0, "private"))
+        self.scheduler.push(session_id, flow_key, weight, priority)
+        self.ready_cond.notify()
+
+    # 限流时间已到的会话重新放入就绪队列，调用方必须已经持有 self.lock
+    def _promote_deferred(self):
+        now = time.monotonic()
+        while self.deferred and self.deferred[0][0] <= now:
+            _, session_id = heapq.heappop(self.deferred)
+            if session_id in self.sessions and not self.sessions[session_id][0].empty(): # 会话可能已经被取消或回收
+                self._mark_ready(session_id)
+
+    # 如果会话的消息队列为空且没有正在执行的任务，删除该会话的记录，调用方必须已经持有 self.lock
+    def _release_idle_session(self, session_id):
+        context_queue, semaphore = self.sessions[session_id]
+        # 这种情况是消息队列为空,当前没有任务在占有信号量
+        if context_queue.empty() and semaphore._initial_value == semaphore._value and session_id not in self.scheduler:
+            self.futures.pop(session_id, None)
+            self.cancel_tokens.pop(session_id, None)
+            self.session_flows.pop(session_id, None)
+            del self.sessions[session_id] # 删除该 session 的记录，表示该 session 已处理完所有任务
+
     # 这是生产者方法，负责将消息（context）放入指定会话的消息队列中。
+    # 开启消息合并时，连续到达的文本消息会先经过 MessageCoalescer 合并，再由 _enqueue 放入队列。返回消息是否被接收
     def produce(self, context: Context):
+        MESSAGES_RECEIVED.inc(channel=self._metrics_label())
+        return self.coalescer.offer(context)
+
+    # 重放上次运行时已经接收、但没有处理完的消息（见 common/journal.py），返回重放的消息数。
+    # 在插件加载之后、通道开始接收新消息之前调用一次，重放的消息直接放入队列，不再经过消息合并
+    def replay_journal(self):
+        journal = get_journal()
+        if journal is None:
+            return 0
+        count = 0
+        for journal_id, data in journal.take_unfinished():
+            try:
+                context = load_context(data)
+            except Exception as e:
+                logger.warning("[chat_channel] drop journal entry {} that cannot be restored: {}".format(journal_id, e))
+                journal.complete(journal_id)
+                continue
+            context["journal_id"] = journal_id
+            context["cancel_token"] = CancelToken()
+            if self._replay(context):
+                count += 1
+        if count:
+            logger.info("[chat_channel] replayed {} unfinished messages from journal".format(count))
+        return count
+
+    # 把重放的消息放入队列，子通道可以覆盖，在入队前恢复自己的状态
+    def _replay(self, context: Context):
+        return self._enqueue(context)
+
+    # 指标中使用的通道名称
+    def _metrics_label(self):
+        return self.channel_type or self.__class__.__name__
+
+    # 把消息放入会话的消息队列。
+    # 队列长度受 max_queue_size_in_session（单个会话）和 max_pending_messages（所有会话）限制，超出时按 queue_shed_policy 丢弃消息。
+    # 以 "#" 开头的管理命令不受限制，总是会被接收并优先处理。返回消息是否被接收
+    def _enqueue(self, context: Context):
         session_id = context["session_id"] # 获取当前消息的 session_id
+        is_command = _is_command(context)
+        accepted = False
+        busy_reply = False
+        # 在锁外写入消息日志（只是放入写缓冲区），重放的消息已经带有 journal_id。管理命令可能包含密码，不写入日志
+        journal = get_journal()
+        if journal is not None and not is_command and "journal_id" not in context:
+            context["journal_id"] = journal.append(dump_context(context))
+        schedule = self._schedule_flow(context)
+        context["enqueue_time"] = time.monotonic()
         with self.lock: # 使用锁确保访问 sessions 字典时的线程安全
             if session_id not in self.sessions: # 如果该 session_id 没有对应的会话记录
                 # 初始化一个新的会话，包含一个消息队列和一个信号量
@@ -410,68 +780,274 @@ class ChatChannel(Channel):
                     Dequeue(), # 消息队列（用于存储待处理的消息）
                     threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),  # 信号量，控制每个会话的最大并发数
                 ]
-            # 如果消息类型是文本且内容以 "#" 开头，则认为是管理命令，优先处理
-            if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 将该管理命令放入队列的左侧，优先处理
+            if not is_command and not self._admit(session_id):
+                # 放弃新消息，如果配置了回复繁忙提示，在锁外发送
+                policy = conf().get("queue_shed_policy", "drop_newest")
+                busy_reply = policy == "busy_reply"
+                self.shed_counts["busy_reply" if busy_reply else "drop_newest"] += 1
+                MESSAGES_DROPPED.inc(channel=self._metrics_label(), policy="busy_reply" if busy_reply else "drop_newest")
+                logger.warning("[chat_channel] queue is full, drop new message in session {}".format(session_id))
+                _journal_done(context)
+                self._release_idle_session(session_id)
             else:
-                self.sessions[session_id][0].put(context) # 将常规消息放入队列的右侧
+                self.session_flows[session_id] = schedule
+                # 如果消息类型是文本且内容以 "#" 开头，则认为是管理命令，优先处理
+                if is_command:
+                    self.sessions[session_id][0].putleft(context)  # 将该管理命令放入队列的左侧，优先处理
+                else:
+                    self.sessions[session_id][0].put(context) # 将常规消息放入队列的右侧
+                self.queued_count += 1
+                accepted = True
+                self._mark_ready(session_id) # 会话有了新消息，放入就绪队列并唤醒消费者
+        if busy_reply:
+            reply = Reply(ReplyType.TEXT, conf().get("queue_busy_reply", "当前消息太多啦，请稍后再试"))
+            try:
+                get_pool("send").submit(lambda: self._send_reply(context, self._decorate_reply(context, reply)))
+            except Full:
+                logger.warning("[chat_channel] send pool is full, skip busy reply in session {}".format(session_id))
+        return accepted
+
+    # 判断会话是否还能接收新消息，在 drop_oldest 策略下会先丢弃最早的普通消息来腾出位置，调用方必须已经持有 self.lock
+    def _admit(self, session_id):
+        max_in_session = conf().get("max_queue_size_in_session", 0)
+        max_pending = conf().get("max_pending_messages", 0)
+        session_full = max_in_session > 0 and self.sessions[session_id][0].qsize() >= max_in_session
+        global_full = max_pending > 0 and self.queued_count >= max_pending
+        if not session_full and not global_full:
+            return True
+        if conf().get("queue_shed_policy", "drop_newest") != "drop_oldest":
+            return False
+        # 单个会话满了就丢弃该会话最早的消息；全局满了则从排队最多的会话中丢弃，优先惩罚刷屏的会话
+        victim = session_id if session_full else max(self.sessions, key=lambda sid: self.sessions[sid][0].qsize())
+        dropped = self.sessions[victim][0].remove_first(
+            lambda c: not _is_command(c) # 管理命令不会被丢弃
+        )
+        if dropped is None:
+            return False
+        self.queued_count -= 1
+        _journal_done(dropped)
+        self.shed_counts["drop_oldest"] += 1
+        MESSAGES_DROPPED.inc(channel=self._metrics_label(), policy="drop_oldest")
+        logger.warning("[chat_channel] queue is full, drop oldest message in session {}".format(victim))
+        if session_full:
+            return True
+        return self._admit(session_id) # 全局腾出位置后，当前会话自身也可能已满，再检查一次
+
+    # 判断是否达到全局的并发处理上限，调用方必须已经持有 self.lock
+    def _over_budget(self):
+        max_in_flight = conf().get("max_in_flight", 0)
+        if max_in_flight > 0:
+            return self.in_flight >= max_in_flight
+        budget = self._dispatch_budget()
+        return budget > 0 and self.generating >= budget
+
+    # 没有配置 max_in_flight 时，公平调度模式下同时生成回复的消息数上限，0 表示不限制。
+    # 以生成回复的线程数为上限：超出的消息留在会话队列中由调度器决定顺序，而不是全部提交到线程池的先进先出队列里。
+    # 只计算正在生成回复的消息，已经生成回复、正在发送或者在等待重试的消息不占用名额，不会在服务故障时堵住派发。
+    # 异步模式下等待模型回复不占用线程，不设上限
+    def _dispatch_budget(self):
+        if not conf().get("fair_scheduling", True) or conf().get("async_mode", False):
+            return 0
+        return handler_pool.max_workers * max(1, conf().get("process_workers", 0))
+
+    # 占用一个生成回复的名额，返回释放名额的函数，多次调用只释放一次。调用方必须已经持有 self.lock，释放时不能持有
+    def _generation_slot(self):
+        released = []
+
+        def release():
+            with self.lock:
+                if released:
+                    return
+                released.append(True)
+                self.generating -= 1
+                if self.scheduler and not self._over_budget(): # 空出了名额，唤醒可能在等待的 consume 线程
+                    self.ready_cond.notify()
+
+        self.generating += 1
+        return release
+
+    # 消息所属的调度流、权重和类别：私聊按会话调度，群聊中所有成员的会话属于同一个群的流，管理员的会话单独调度。
+    # 权重为通道权重 schedule_channel_weights 乘以类别权重 schedule_weight_private / schedule_weight_group / schedule_weight_admin
+    def _schedule_flow(self, context: Context):
+        session_id = context["session_id"]
+        msg = context.get("msg")
+        weight = (conf().get("schedule_channel_weights") or {}).get(self._metrics_label(), 1.0)
+        if context.get("isgroup", False):
+            user = getattr(msg, "actual_user_id", None)
+            flow_key, lane = "group:{}".format(getattr(msg, "other_user_id", None) or session_id), "group"
+            weight *= conf().get("schedule_weight_group", 1.0)
+        else:
+            user = context.get("receiver")
+            flow_key, lane = session_id, "private"
+            weight *= conf().get("schedule_weight_private", 1.0)
+        if user and user in global_config["admin_users"]:
+            flow_key, lane = "admin:{}".format(session_id), "admin"
+            weight *= conf().get("schedule_weight_admin", 2.0)
+        return flow_key, weight, lane
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 返回消息队列的使用情况，用于观察过载和丢弃情况
+    def queue_stats(self) -> dict:
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "queued": self.queued_count,
+                "in_flight": self.in_flight,
+                "generating": self.generating,
+                "shed": dict(self.shed_counts),
+                "deferred": len(self.deferred),
+                "scheduler": self.scheduler.stats(),
+            }
+
+    # 消费者函数，单独线程，用于从就绪队列中取出会话并派发其中的消息
     # 锁的作用：它的目的是保证同一时间 只有一个线程 可以进入 with self.lock 代码块。这样，多个线程就不会在同一时间修改共享资源，从而避免了竞争条件
+    # 派发的开销只和就绪会话的数量有关，空闲会话不会被访问；没有就绪会话时线程阻塞在条件变量上，不占用 CPU
     def consume(self):
         while True: # 无限循环，持续消费消息
-            with self.lock: # 确保在访问 sessions 时线程安全
-                session_ids = list(self.sessions.keys()) # 获取当前所有 session_id
-            for session_id in session_ids: # 遍历所有的 session_id
-                with self.lock: # 确保在访问 sessions[session_id] 时线程安全
-                    context_queue, semaphore = self.sessions[session_id] # 获取当前 session 的消息队列和信号量
-                # 尝试获取信号量，如果没有剩余信号量，则 acquire 返回 False，并不会阻塞当前线程。进入会消耗一个信号量
-                if semaphore.acquire(blocking=False): 
-                    if not context_queue.empty(): # 如果队列中有消息待处理
-                        context = context_queue.get() # 获取队列中的一个消息
-                        logger.debug("[chat_channel] consume context: {}".format(context)) # 打印日志，调试时查看消息内容
-                        # 将 context 提交到线程池中进行处理，_handle 方法将会在其他线程中执行。
-                        # 任务 提交之后，不管任务是否已经开始或完成，回调函数 self._thread_pool_callback 会被立即注册。即使当前任务还
-                        # 没有执行，回调函数已经挂载到 Future 对象上。
-                        # 当任务执行完毕时，线程池会在后台自动执行回调函数。此时，future 对象的 done() 方法会返回 True，然后会触发回调函数的执行。
-                        future: Future = handler_pool.submit(self._handle, context) 
-                        # 给 future 添加回调函数，当任务完成时执行回调，回调函数会根据 session_id 和 context 处理后续操作。
-                        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                        with self.lock: # 确保对 futures 的修改线程安全
-                            if session_id not in self.futures: # 如果该 session_id 尚未在 futures 中
-                                self.futures[session_id] = []  # 初始化 futures 对应的列表
-                            self.futures[session_id].append(future) # 将 future 对象加入 futures 字典中，用于追踪该会话中的任务。
-                    # 这种情况是消息队列为空,当前没有任务在占有信号量,除了当前占有的信号量,没其他占有的情况
-                    elif semaphore._initial_value == semaphore._value + 1: 
-                        with self.lock:  # 确保对 sessions 和 futures 的修改线程安全
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()] # 过滤掉已完成的任务
-                            # assert 失败时会抛出异常 (AssertionError)，并且带有你提供的错误消息（如果有的话）
-                            assert len(self.futures[session_id]) == 0, "thread pool error" # 如果有未完成的任务，则抛出异常
-                            del self.sessions[session_id] # 删除该 session 的记录，表示该 session 已处理完所有任务
-                    else: # 这种情况是消息队列为空,但是还有未完成任务在占用信号量,这时会释放信号量
+            with self.ready_cond: # 等待有会话进入就绪队列
+                # 没有就绪会话，或者正在处理的消息已经达到全局上限时等待，任务完成回调会重新唤醒。管理命令不受全局上限限制
+                # 有被限流延后的会话时最多等到它可以派发的时间
+                while True:
+                    self._promote_deferred()
+                    if self.scheduler.has_priority() or (self.scheduler and not self._over_budget()):
+                        break
+                    self.ready_cond.wait(self.deferred[0][0] - time.monotonic() if self.deferred else None)
+                session_id, flow_key = self.scheduler.pop(priority_only=self._over_budget()) # 按公平调度选出下一个会话
+                if session_id not in self.sessions: # 会话可能已经被回收
+                    continue
+                context_queue, semaphore = self.sessions[session_id] # 获取当前 session 的消息队列和信号量
+                # 尝试获取信号量，如果没有剩余信号量，说明该会话的并发已满，等任务完成回调时会重新把会话放回就绪队列
+                if not semaphore.acquire(blocking=False):
+                    self.scheduler.refund(flow_key)
+                    continue
+                if context_queue.empty(): # 队列已经被清空（比如被 cancel_session 取消），释放信号量并尝试回收会话
+                    semaphore.release()
+                    self.scheduler.refund(flow_key)
+                    self._release_idle_session(session_id)
+                    continue
+                if not _is_command(context_queue.queue[0]): # 超出 rate_limits 时会话延后派发，不占用处理线程
+                    wait, dimension = rate_limiter.check(context_queue.queue[0])
+                    if wait > 0:
                         semaphore.release()
-            time.sleep(0.2) # 暂停 0.2 秒，避免频繁占用 CPU，减轻负担
+                        self.scheduler.refund(flow_key)
+                        heapq.heappush(self.deferred, (time.monotonic() + wait, session_id))
+                        logger.debug("[chat_channel] session {} rate limited by {}, retry after {:.1f}s".format(session_id, dimension, wait))
+                        continue
+                context = context_queue.get() # 获取队列中的一个消息
+                self.queued_count -= 1
+                self.in_flight += 1
+                release = self._generation_slot()
+                lane = "command" if _is_command(context) else self.session_flows.get(session_id, (None, None, "private"))[2]
+                # 队列中还有消息时，把会话放回就绪队列的尾部，让其他会话也有机会被派发，同时利用剩余的并发配额
+                if not context_queue.empty():
+                    self._mark_ready(session_id)
+            if "enqueue_time" in context:
+                QUEUE_WAIT.observe(time.monotonic() - context["enqueue_time"], lane=lane)
+            logger.debug("[chat_channel] consume context: {}".format(context)) # 打印日志，调试时查看消息内容
+            # 将 context 提交到线程池中进行处理，各个处理阶段将会在其他线程中执行。
+            # 提交和注册回调都在锁外进行，因为如果任务已经完成，add_done_callback 会在当前线程中立即执行回调，而回调需要获取 self.lock
+            future: Future = self._submit_handle(context, release)
+            # 给 future 添加回调函数，当任务完成时执行回调，回调函数会根据 session_id 和 context 处理后续操作。
+            future.add_done_callback(self._thread_pool_callback(session_id, release, context=context))
+            # 管理命令（比如重置会话）本身会调用 cancel_session，不能被取消，否则命令的回复也会被丢弃。
+            # 异步模式下正在执行的协程的 future 仍然是 PENDING 状态，所以命令的 future 和 token 都不追踪
+            if _is_command(context):
+                continue
+            token = context.get("cancel_token")
+            with self.lock: # 确保对 futures 的修改线程安全
+                if not future.done(): # 已完成的任务不需要追踪
+                    self.futures.setdefault(session_id, []).append(future) # 将 future 对象加入 futures 字典中，用于追踪该会话中的任务。
+                    if token is not None:
+                        self.cancel_tokens.setdefault(session_id, []).append(token)
+            if token is not None: # 取消时立即结束 future，释放会话的并发配额，已经在执行的阶段会在下一个检查点退出
+                token.add_callback(lambda future=future: _abort(future)) # 绑定当前的 future，consume 循环中的变量之后会指向下一条消息
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
+    # 正在处理的消息通过 cancel_token 取消：中止重试和等待，丢弃回复
     def cancel_session(self, session_id):
         with self.lock: # 使用锁确保对 sessions 和 futures 的访问是线程安全的
-            if session_id in self.sessions: # 检查 session_id 是否存在于 sessions 中
-                for future in self.futures[session_id]:  # 遍历该 session_id 对应的所有 future 对象
-                    future.cancel() # 取消该 future 对象，即停止其执行
-                cnt = self.sessions[session_id][0].qsize() # 获取该 session 对应消息队列中的消息数量
-                if cnt > 0: # 如果队列中有消息
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id)) # 记录取消的消息数
-                self.sessions[session_id][0] = Dequeue() # 清空该 session 对应的消息队列，重置为新的空队列
+            futures = self._clear_session_queue(session_id)
+            tokens = self.cancel_tokens.pop(session_id, [])
+        # future.cancel() 和 token.cancel() 会在当前线程中同步执行完成回调，而回调需要获取 self.lock，所以必须在锁外取消
+        for token in tokens:
+            token.cancel("session {} cancelled".format(session_id))
+        for future in futures:  # 遍历该 session_id 对应的所有 future 对象
+            future.cancel() # 取消该 future 对象，即停止其执行
     # 取消所有会话对应的所有任务
     def cancel_all_session(self):
+        futures = []
+        tokens = []
         with self.lock:  # 使用锁确保对 sessions 和 futures 的访问是线程安全的
-            for session_id in self.sessions: # 遍历所有 session_id
-                for future in self.futures[session_id]:  # 遍历该 session_id 对应的所有 future 对象
-                    future.cancel() # 取消该 future 对象，即停止其执行
-                cnt = self.sessions[session_id][0].qsize()  # 获取该 session 对应消息队列中的消息数量
-                if cnt > 0: # 如果队列中有消息
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id)) # 记录取消的消息数
-                self.sessions[session_id][0] = Dequeue() # 清空该 session 对应的消息队列，重置为新的空队列
+            for session_id in list(self.sessions): # 遍历所有 session_id
+                futures.extend(self._clear_session_queue(session_id))
+                tokens.extend(self.cancel_tokens.pop(session_id, []))
+        for token in tokens:
+            token.cancel("all sessions cancelled")
+        for future in futures:
+            future.cancel()
+    # 清空会话的消息队列，并返回该会话中待取消的 future 列表（不包括管理命令，见 consume），调用方必须已经持有 self.lock
+    def _clear_session_queue(self, session_id):
+        if session_id not in self.sessions: # 检查 session_id 是否存在于 sessions 中
+            return []
+        cnt = self.sessions[session_id][0].qsize() # 获取该 session 对应消息队列中的消息数量
+        if cnt > 0: # 如果队列中有消息
+            logger.info("Cancel {} messages in session {}".format(cnt, session_id)) # 记录取消的消息数
+        self.queued_count -= cnt
+        for context in self.sessions[session_id][0].queue: # 被取消的消息重启后不再重放
+            _journal_done(context)
+        self.sessions[session_id][0] = Dequeue() # 清空该 session 对应的消息队列，重置为新的空队列
+        return list(self.futures.get(session_id, []))
+
+# 在消息日志中记录消息处理结束，没有开启日志或者消息没有写入日志时不做任何事
+def _journal_done(context: Context):
+    journal_id = context.get("journal_id") if context is not None else None
+    if journal_id is not None:
+        get_journal().complete(journal_id)
+
+
+# 是否是以 "#" 开头的管理命令，管理命令优先处理，不会因为过载被丢弃，也不会被取消
+def _is_command(context: Context):
+    return context.type == ContextType.TEXT and context.content.startswith("#")
+
+
+# 设置 future 的结果，future 可能已经因为消息被取消而提前结束，这时忽略
+def _set_result(future: Future, result=None):
+    try:
+        future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def _set_exception(future: Future, exception):
+    try:
+        future.set_exception(exception)
+    except InvalidStateError:
+        pass
+
+
+# 消息被取消时结束代表处理流程的 future：还没开始执行的直接取消，正在执行的以 Cancelled 异常结束
+def _abort(future: Future):
+    if not future.cancel():
+        _set_exception(future, Cancelled("cancelled"))
+
+
+# 消息队列的指标，会话和队列是所有通道实例共享的类属性，采集时直接读取
+def _queue_stats(field):
+    def collect():
+        with ChatChannel.lock:
+            if field == "sessions":
+                return len(ChatChannel.sessions)
+            if field == "queued":
+                return ChatChannel.queued_count
+            if field == "in_flight":
+                return ChatChannel.in_flight
+            return max([session[0].qsize() for session in ChatChannel.sessions.values()] or [0])
+    return collect
+
+
+metrics.gauge("chat_sessions", "Sessions with queued or running messages", func=_queue_stats("sessions"))
+metrics.gauge("chat_queued_messages", "Messages waiting in all session queues", func=_queue_stats("queued"))
+metrics.gauge("chat_in_flight_messages", "Messages being handled", func=_queue_stats("in_flight"))
+metrics.gauge("chat_session_queue_max_depth", "Length of the longest session queue", func=_queue_stats("max_depth"))
 
 # 检查前缀
 def check_prefix(content, prefix_list):
@@ -0,0 +1,158 @@
+import re
+import threading
+from functools import lru_cache
+from config import conf
+
+# _compose_context 中用到的白名单、黑名单、触发前缀和关键词的预编译结果。
+# 每条消息都要做这些匹配，原来的做法是每次都从配置中读取列表并逐个 startswith/find，@ 的正则也是每条消息重新拼接。
+# 这里在配置变化时（load_config 重新加载或者通过 conf()[key] = value 修改）才重新构建一次：
+#   白名单、黑名单使用 frozenset，O(1) 判断；
+#   前缀和关键词各自编译成一个正则，由正则引擎一次扫描完成匹配。正则的候选分支按列表顺序尝试，
+#   因此返回的前缀和原来 check_prefix 按列表顺序查找的结果一致。
+class ContextMatcher:
+    def __init__(self, config):
+        self.config = config
+        self.version = config.version
+        group_name_white_list = config.get("group_name_white_list", []) or []
+        self.group_name_white_list = frozenset(group_name_white_list)
+        self.all_group = "ALL_GROUP" in self.group_name_white_list
+        self.group_name_keyword = _compile_contain(config.get("group_name_keyword_white_list", []))
+        group_chat_in_one_session = config.get("group_chat_in_one_session", []) or []
+        self.group_chat_in_one_session = frozenset(group_chat_in_one_session)
+        self.all_group_in_one_session = "ALL_GROUP" in self.group_chat_in_one_session
+        self.nick_name_black_list = frozenset(config.get("nick_name_black_list", []) or [])
+        self.group_chat_prefix = _compile_prefix(config.get("group_chat_prefix"))
+        self.group_chat_keyword = _compile_contain(config.get("group_chat_keyword"))
+        self.single_chat_prefix = _compile_prefix(config.get("single_chat_prefix", [""]))
+        self.image_create_prefix = _compile_prefix(config.get("image_create_prefix", [""]))
+        self.group_at_off = config.get("group_at_off", False)
+        self.trigger_by_self = config.get("trigger_by_self", True)
+        self.always_reply_voice = config.get("always_reply_voice")
+        self.voice_reply_voice = config.get("voice_reply_voice")
+
+    # 群名称是否在白名单中，或者包含白名单关键词
+    def group_allowed(self, group_name):
+        return (
+            self.all_group
+            or group_name in self.group_name_white_list
+            or _search(self.group_name_keyword, group_name) is not None
+        )
+
+    # 群聊是否所有成员共用一个会话
+    def group_in_one_session(self, group_name):
+        return self.all_group_in_one_session or group_name in self.group_chat_in_one_session
+
+    def match_group_prefix(self, content):
+        return _match(self.group_chat_prefix, content)
+
+    def match_group_keyword(self, content):
+        return True if _search(self.group_chat_keyword, content) is not None else None
+
+    def match_single_prefix(self, content):
+        return _match(self.single_chat_prefix, content)
+
+    def match_image_prefix(self, content):
+        return _match(self.image_create_prefix, content)
+
+
+# 把前缀列表编译成一个锚定在开头的正则，列表为空时返回 None
+def _compile_prefix(prefix_list):
+    if not prefix_list:
+        return None
+    return re.compile("|".join(re.escape(prefix) for prefix in prefix_list))
+
+
+# 把关键词列表编译成一个用于查找的正则，列表为空时返回 None
+def _compile_contain(keyword_list):
+    if not keyword_list:
+        return None
+    return re.compile("|".join(re.escape(keyword) for keyword in keyword_list))
+
+
+# 返回匹配到的前缀，没有匹配时返回 None，和 check_prefix 的返回值一致
+def _match(pattern, content):
+    if pattern is None:
+        return None
+    m = pattern.match(content)
+    return m.group(0) if m else None
+
+
+def _search(pattern, content):
+    if pattern is None:
+        return None
+    return pattern.search(content)
+
+
+# 匹配 "@昵称" 加空格或四分之一空格的正则，按昵称缓存
+@lru_cache(maxsize=1024)
+def at_pattern(name):
+    return re.compile(f"@{re.escape(name)}(\u2005|\u0020)")
+
+
+_matcher = None
+_matcher_lock = threading.Lock()
+
+# 获取当前配置对应的 ContextMatcher，配置对象被替换或者版本号变化时自动重新构建
+def get_matcher() -> ContextMatcher:
+    config = conf()
+    matcher = _matcher
+    if matcher is not None and matcher.config is config and matcher.version == config.version:
+        return matcher
+    return _rebuild(config)
+
+
+def _rebuild(config):
+    global _matcher
+    with _matcher_lock:
+        if _matcher is None or _matcher.config is not config or _matcher.version != config.version:
+            _matcher = ContextMatcher(config)
+        return _matcher
+
+
+# 性能对比：python -m channel.context_matcher
+if __name__ == "__main__":
+    import timeit
+    from channel.chat_channel import check_contain, check_prefix
+
+    config = conf()
+    config["group_name_white_list"] = ["group{}".format(i) for i in range(200)]
+    config["group_name_keyword_white_list"] = ["keyword{}".format(i) for i in range(50)]
+    config["group_chat_in_one_session"] = ["group{}".format(i) for i in range(0, 200, 2)]
+    config["group_chat_prefix"] = ["@bot", "@机器人", "bot"]
+    config["group_chat_keyword"] = ["关键词{}".format(i) for i in range(50)]
+    config["single_chat_prefix"] = ["bot", "@bot"]
+    config["image_create_prefix"] = ["画", "看", "找"]
+    group_name = "some group name keyword49"
+    content = "@bot 你好，请帮我写一首关于春天的诗，关键词49"
+    at_list = ["张三", "李四", "王五"]
+
+    def before():
+        c = conf()
+        any([
+            group_name in c.get("group_name_white_list", []),
+            "ALL_GROUP" in c.get("group_name_white_list", []),
+            check_contain(group_name, c.get("group_name_keyword_white_list", [])),
+        ])
+        any([group_name in c.get("group_chat_in_one_session", []), "ALL_GROUP" in c.get("group_chat_in_one_session", [])])
+        check_prefix(content, c.get("group_chat_prefix"))
+        check_contain(content, c.get("group_chat_keyword"))
+        text = re.sub(f"@{re.escape('bot')}(\u2005|\u0020)", r"", content)
+        for at in at_list:
+            text = re.sub(f"@{re.escape(at)}(\u2005|\u0020)", r"", text)
+        check_prefix(text, c.get("image_create_prefix", [""]))
+
+    def after():
+        m = get_matcher()
+        m.group_allowed(group_name)
+        m.group_in_one_session(group_name)
+        m.match_group_prefix(content)
+        m.match_group_keyword(content)
+        text = at_pattern("bot").sub(r"", content)
+        for at in at_list:
+            text = at_pattern(at).sub(r"", text)
+        m.match_image_prefix(text)
+
+    number = 20000
+    for name, func in [("before", before), ("after", after)]:
+        cost = min(timeit.repeat(func, number=number, repeat=5)) / number
+        print("{}: {:.2f} us/message".format(name, cost * 1e6))
@@ -0,0 +1,102 @@
+from collections import deque
+
+# 会话之间的公平调度：加权的差额轮询（Deficit Round Robin）。
+# 就绪的会话按“流”分组，私聊的流就是会话本身，群聊中所有成员的会话属于同一个群的流，
+# 这样一个有 200 个活跃成员的群和一个私聊得到的处理机会由权重决定，而不是由会话数量决定。
+# 每个流轮到时获得等于权重的额度，每派发一条消息消耗 1，额度不足 1 时轮到下一个流；同一个流中的会话依次轮流派发。
+# 权重小于 1 的流额度会跨轮次累积，比如权重 0.5 的流每两轮派发一条消息。
+# 另外有一条优先通道：有待处理管理命令的会话放入优先通道，先于所有流派发。
+# 不是线程安全的，调用方必须持有 ChatChannel.lock。
+MIN_WEIGHT = 0.01
+
+
+class _Flow:
+    __slots__ = ("key", "weight", "deficit", "in_turn", "sessions")
+
+    def __init__(self, key, weight):
+        self.key = key
+        self.weight = weight
+        self.deficit = 0.0 # 当前剩余的额度
+        self.in_turn = False # 是否已经领取了本轮的额度
+        self.sessions = deque() # 流中就绪的会话
+
+
+class FairScheduler:
+    def __init__(self):
+        self.flows = {} # 流 --> _Flow，只包含在就绪队列中的流
+        self.ready_flows = deque() # 轮询顺序
+        self.priority = deque() # 优先通道中的会话
+        self.ready = {} # 就绪的 session_id --> 所属的流，优先通道中的会话为 None
+
+    def __len__(self):
+        return len(self.ready)
+
+    def __contains__(self, session_id):
+        return session_id in self.ready
+
+    # 会话中有待处理的消息，放入所属流的就绪队列；priority 为 True 时放入优先通道。已经就绪的会话不会重复加入
+    def push(self, session_id, flow_key, weight=1.0, priority=False):
+        if session_id in self.ready:
+            if not priority or self.ready[session_id] is None:
+                return
+            # 普通消息还在排队时又来了管理命令，从流中移到优先通道
+            flow = self.flows.get(self.ready[session_id])
+            if flow is not None and session_id in flow.sessions:
+                flow.sessions.remove(session_id)
+        if priority:
+            self.ready[session_id] = None
+            self.priority.append(session_id)
+            return
+        flow = self.flows.get(flow_key)
+        if flow is None:
+            flow = self.flows[flow_key] = _Flow(flow_key, weight)
+            self.ready_flows.append(flow)
+        flow.weight = max(MIN_WEIGHT, weight)
+        flow.sessions.append(session_id)
+        self.ready[session_id] = flow_key
+
+    # 是否有管理命令等待派发
+    def has_priority(self):
+        return bool(self.priority)
+
+    # 取出下一个要派发的会话，返回 (session_id, 所属的流)，优先通道中的会话所属的流为 None，没有就绪会话时返回 (None, None)。
+    # priority_only 为 True 时只从优先通道中取
+    # 流在下一次 pop 时才判断是否结束本轮，因为刚派发的会话如果还有消息，会在这之前被重新放回流中
+    def pop(self, priority_only=False):
+        if self.priority:
+            session_id = self.priority.popleft()
+            del self.ready[session_id]
+            return session_id, None
+        if priority_only:
+            return None, None
+        while self.ready_flows:
+            flow = self.ready_flows[0]
+            if not flow.sessions: # 流中没有就绪的会话了，离开就绪队列，剩余额度作废
+                self.ready_flows.popleft()
+                del self.flows[flow.key]
+                continue
+            if not flow.in_turn:
+                flow.in_turn = True
+                flow.deficit += flow.weight
+            if flow.deficit < 1: # 额度用完，轮到下一个流
+                flow.in_turn = False
+                self.ready_flows.rotate(-1)
+                continue
+            flow.deficit -= 1
+            session_id = flow.sessions.popleft()
+            del self.ready[session_id]
+            return session_id, flow.key
+        return None, None
+
+    # 取出的会话最终没有派发消息（并发已满或者队列已被清空），退还消耗的额度
+    def refund(self, flow_key):
+        flow = self.flows.get(flow_key) if flow_key is not None else None
+        if flow is not None:
+            flow.deficit += 1
+
+    def stats(self) -> dict:
+        return {
+            "ready_sessions": len(self.ready),
+            "ready_flows": sum(1 for flow in self.ready_flows if flow.sessions),
+            "priority": len(self.priority),
+        }
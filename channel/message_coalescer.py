@@ -0,0 +1,92 @@
+import threading
+import time
+from bridge.context import Context, ContextType
+from common.log import logger
+from config import conf
+
+# 消息合并：用户经常连续发送几条短消息，如果每条都单独调用一次大模型，既浪费 token 又会得到多条零碎的回复。
+# 开启后（message_coalesce_window > 0），同一会话中在窗口时间内连续到达的文本消息会被合并成一条再放入消息队列，
+# 每来一条新消息窗口就重新计时，合并后的长度不超过 message_coalesce_max_length。
+# 以下消息不会被合并，并且会先把该会话中等待合并的消息放入队列，保证消息顺序不变：
+#   以 "#" 开头的管理命令、语音转文字的消息、图片/语音等非文本消息、画图命令，以及群聊中不同成员发送的消息
+class MessageCoalescer:
+    def __init__(self, flush):
+        self.flush = flush # 把消息放入消息队列的函数
+        self.pending = {} # session_id --> 等待合并的消息 [context, 内容列表, 合并后长度, 截止时间]
+        self.cond = threading.Condition()
+        self.thread = None # 到期后负责放入队列的后台线程，第一次使用时创建
+
+    # 接收一条消息，返回 True 表示消息已被接收（可能还在等待合并）
+    def offer(self, context: Context):
+        window = conf().get("message_coalesce_window", 0)
+        session_id = context["session_id"]
+        with self.cond: # 在锁内调用 flush，保证同一会话的消息按到达顺序入队
+            pending = self.pending.get(session_id)
+            if window <= 0 or not self._mergeable(context):
+                if pending:
+                    self._flush_pending(session_id)
+                return self.flush(context)
+            content = context.content
+            if pending and not self._same_sender(pending[0], context):
+                self._flush_pending(session_id)
+                pending = None
+            if pending and pending[2] + len(content) + 1 > conf().get("message_coalesce_max_length", 1000):
+                self._flush_pending(session_id)
+                pending = None
+            deadline = time.monotonic() + window
+            if pending:
+                # 使用最新一条消息的 context，回复时引用的是用户最后发送的消息
+                pending[0] = context
+                pending[1].append(content)
+                pending[2] += len(content) + 1
+                pending[3] = deadline
+            else:
+                self.pending[session_id] = [context, [content], len(content), deadline]
+                self._ensure_thread()
+            self.cond.notify()
+        return True
+
+    # 只有直接发送的文本消息可以合并
+    def _mergeable(self, context: Context):
+        return (
+            context.type == ContextType.TEXT
+            and not context.content.startswith("#")
+            and context.get("origin_ctype", ContextType.TEXT) == ContextType.TEXT
+        )
+
+    # 群聊中即使共用一个会话，也只合并同一个成员发送的消息，因为回复时会 @ 发送者
+    def _same_sender(self, a: Context, b: Context):
+        if not a.get("isgroup", False):
+            return True
+        return getattr(a.get("msg"), "actual_user_id", None) == getattr(b.get("msg"), "actual_user_id", None)
+
+    # 把会话中等待合并的消息放入队列，调用方必须已经持有 self.cond
+    def _flush_pending(self, session_id):
+        context, contents, _, _ = self.pending.pop(session_id)
+        if len(contents) > 1:
+            context.content = "\n".join(contents)
+            context["coalesced"] = len(contents) # 记录合并的消息条数
+            logger.debug("[coalescer] merge {} messages in session {}".format(len(contents), session_id))
+        try:
+            self.flush(context)
+        except Exception as e:
+            logger.exception(e)
+
+    def _ensure_thread(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="message-coalescer", daemon=True)
+            self.thread.start()
+
+    # 后台线程：等待最早到期的会话，到期后把合并好的消息放入队列
+    def _run(self):
+        with self.cond:
+            while True:
+                if not self.pending:
+                    self.cond.wait()
+                    continue
+                now = time.monotonic()
+                expired = [sid for sid, item in self.pending.items() if item[3] <= now]
+                for session_id in expired:
+                    self._flush_pending(session_id)
+                if not expired:
+                    self.cond.wait(min(item[3] for item in self.pending.values()) - now)
@@ -0,0 +1,348 @@
+import copy
+import itertools
+import multiprocessing
+import pickle
+import threading
+import time
+import weakref
+import zlib
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+from queue import Full
+from bridge.context import Context
+from common.log import logger
+from common.cancellation import CancelToken
+from common import metrics
+from config import conf
+from plugins import PluginManager
+
+# 多进程模式：插件（Banwords、Role 等）、tiktoken 计数、图片和语音转换都是 CPU 密集型的，受 GIL 限制单个进程最多只能用满一个核。
+# 配置 process_workers 为 N 后，通道所在的主进程只负责收发消息和会话排队，生成回复交给 N 个工作进程：
+#   按 session_id 的哈希分片，同一会话总是交给同一个工作进程，会话历史（SessionManager）保持一致；
+#   每个工作进程有自己的 Bridge、SessionManager 和 PluginManager，在进程内生成并装饰回复；
+#   回复传回主进程后由通道发送，插件在工作进程中直接调用 channel.send 发送的消息也会转发回主进程发送；
+#   工作进程异常退出时自动重启，已经派发给它但还没有返回的消息会按原来的顺序重新派发给新的进程。
+# 主进程和工作进程之间通过 Pipe 传递 pickle 后的 context 和 reply，context 中不能序列化的部分（原始消息对象、追踪记录等）不会传给工作进程。
+
+MAX_ATTEMPTS = 3 # 同一条消息最多派发的次数，避免一条导致进程崩溃的消息反复拖垮工作进程
+_UNPORTABLE_KEYS = ("trace", "channel", "cancel_token") # 不传给工作进程的 context 字段，工作进程中会创建新的 cancel_token
+
+WORKER_RESTARTS = metrics.counter("process_worker_restarts_total", "Worker processes restarted after exiting unexpectedly", ["worker"])
+
+
+class _Worker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None # 主进程一端的 Pipe
+        self.started = 0 # 进程启动的时间
+        self.lock = threading.Lock() # 保护 conn 的发送和 in_flight，保证重启时重新派发的顺序
+        self.in_flight = {} # task_id --> [pickle 后的任务, future, 派发次数]
+
+
+class ProcessWorkers:
+    def __init__(self, channel, size):
+        self.size = size
+        self.channel_ref = weakref.ref(channel)
+        # 工作进程中需要用到的通道信息，工作进程中的通道只用来运行插件和装饰回复，不会连接消息平台
+        self.channel_info = {
+            "channel_type": channel.channel_type,
+            "name": channel.name,
+            "user_id": channel.user_id,
+            "not_support_replytype": list(channel.NOT_SUPPORT_REPLYTYPE),
+            "load_plugins": bool(PluginManager().instances), # 主进程加载了插件时，工作进程也加载插件
+        }
+        self.mp = multiprocessing.get_context("spawn") # 主进程中已经有很多线程，fork 可能复制到被其他线程持有的锁，所以使用 spawn
+        self.contexts = weakref.WeakValueDictionary() # task_id --> 主进程中原始的 context，转发插件发送的消息时使用
+        self._task_ids = itertools.count(1)
+        self.workers = [_Worker(i) for i in range(size)]
+        for worker in self.workers:
+            self._start(worker)
+        self._collector = threading.Thread(target=self._collect, name="process-workers", daemon=True)
+        self._collector.start()
+        logger.info("[process_workers] started {} worker processes".format(size))
+
+    # 会话分片，使用 crc32 而不是 hash()，保证结果在不同进程和重启前后一致
+    def shard(self, session_id):
+        return zlib.crc32(str(session_id).encode("utf-8")) % self.size
+
+    # 把 context 交给会话对应的工作进程，返回的 future 的结果是装饰后的 reply，没有回复时为 None
+    def submit(self, context: Context) -> Future:
+        future = Future()
+        task_id = next(self._task_ids)
+        try:
+            data = pickle.dumps(("task", task_id, _portable(context, task_id)))
+        except Exception as e:
+            logger.error("[process_workers] context can not be sent to worker process: {}".format(e))
+            future.set_exception(e)
+            return future
+        self.contexts[task_id] = context
+        worker = self.workers[self.shard(context["session_id"])]
+        with worker.lock:
+            worker.in_flight[task_id] = [data, future, 1]
+            self._send(worker, data)
+        token = context.get("cancel_token")
+        if token is not None: # 主进程中取消消息时，通知工作进程取消对应的处理
+            token.add_callback(lambda: self._cancel(worker, task_id))
+        return future
+
+    def _cancel(self, worker, task_id):
+        with worker.lock:
+            if task_id in worker.in_flight:
+                self._send(worker, pickle.dumps(("cancel", task_id, None)))
+
+    # 返回各工作进程的状态
+    def stats(self) -> list:
+        result = []
+        for worker in self.workers:
+            with worker.lock:
+                result.append({
+                    "worker": worker.index,
+                    "pid": worker.process.pid,
+                    "alive": worker.process.is_alive(),
+                    "in_flight": len(worker.in_flight),
+                })
+        return result
+
+    def _start(self, worker):
+        config_dict = dict(conf())
+        config_dict["process_workers"] = 0
+        config_dict["journal_path"] = "" # 消息日志只由主进程写入
+        parent_conn, child_conn = self.mp.Pipe()
+        process = self.mp.Process(
+            target=_worker_main,
+            args=(worker.index, child_conn, config_dict, self.channel_info),
+            name="process-worker-{}".format(worker.index),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        worker.process = process
+        worker.conn = parent_conn
+        worker.started = time.time()
+
+    # 发送任务，调用方必须已经持有 worker.lock。进程已经退出时发送会失败，任务留在 in_flight 中，重启后会重新派发
+    def _send(self, worker, data):
+        try:
+            worker.conn.send_bytes(data)
+        except (OSError, EOFError) as e:
+            logger.warning("[process_workers] send to worker {} failed: {}".format(worker.index, e))
+
+    # 收集线程，同时等待所有工作进程的回复和进程退出
+    def _collect(self):
+        while True:
+            waitables = {}
+            for worker in self.workers:
+                waitables[worker.conn] = worker
+                waitables[worker.process.sentinel] = worker
+            restarted = set()
+            for ready in wait(list(waitables), timeout=1):
+                worker = waitables[ready]
+                if worker.index in restarted: # 这个进程在本轮中已经被重启过，等待的对象已经失效
+                    continue
+                if ready is worker.conn and self._receive(worker):
+                    continue
+                # 进程已经退出，先取完它退出前已经发出的结果，避免这些消息被重复处理
+                while self._receive(worker, block=False):
+                    pass
+                self._restart(worker)
+                restarted.add(worker.index)
+
+    # 读取并处理一条工作进程发来的消息，返回 False 表示连接已经断开或者没有可读的数据
+    def _receive(self, worker, block=True):
+        try:
+            if not block and not worker.conn.poll():
+                return False
+            kind, task_id, ok, payload = pickle.loads(worker.conn.recv_bytes())
+        except (EOFError, OSError):
+            return False
+        if kind == "send":
+            self._relay_send(task_id, *payload)
+            return True
+        if kind == "cancel_session":
+            self._relay_cancel(payload)
+            return True
+        with worker.lock:
+            entry = worker.in_flight.pop(task_id, None)
+        if entry is None:
+            return True
+        future = entry[1]
+        if ok:
+            future.set_result(payload)
+        else:
+            future.set_exception(payload)
+        return True
+
+    # 转发工作进程中插件直接调用 channel.send 发送的消息
+    def _relay_send(self, task_id, reply, context):
+        channel = self.channel_ref()
+        if channel is None:
+            return
+        context = self.contexts.get(task_id) or context
+        from common.worker_pool import get_pool
+        try:
+            get_pool("send").submit(channel._send, reply, context)
+        except Full:
+            channel._send(reply, context)
+
+    # 转发工作进程中插件（godcmd 的 #reset、#stop 等）调用的 cancel_session / cancel_all_session。
+    # 排队的消息和处理中的消息都在主进程中追踪，取消后主进程再通知工作进程取消对应的处理。session_id 为 None 表示取消所有会话
+    def _relay_cancel(self, session_id):
+        channel = self.channel_ref()
+        if channel is None:
+            return
+        if session_id is None:
+            channel.cancel_all_session()
+        else:
+            channel.cancel_session(session_id)
+
+    # 重启退出的工作进程，并把它还没有返回的消息重新派发给新的进程
+    def _restart(self, worker):
+        worker.process.join(timeout=1) # 连接断开时进程可能还没有完全退出
+        logger.error("[process_workers] worker {} (pid {}) exited with code {}, restarting".format(
+            worker.index, worker.process.pid, worker.process.exitcode))
+        WORKER_RESTARTS.inc(worker=str(worker.index))
+        if time.time() - worker.started < 1: # 启动后马上退出，可能是配置或环境问题，稍等一下再重启，避免一直空转
+            time.sleep(1)
+        failed = []
+        with worker.lock:
+            worker.conn.close()
+            self._start(worker)
+            for task_id in sorted(worker.in_flight):
+                entry = worker.in_flight[task_id]
+                if entry[2] >= MAX_ATTEMPTS:
+                    failed.append(worker.in_flight.pop(task_id)[1])
+                    continue
+                entry[2] += 1
+                self._send(worker, entry[0])
+        if worker.in_flight:
+            logger.info("[process_workers] requeue {} messages to worker {}".format(len(worker.in_flight), worker.index))
+        for future in failed:
+            future.set_exception(RuntimeError("worker process exited {} times while handling the message".format(MAX_ATTEMPTS)))
+
+
+# 去掉 context 中不能在进程之间传递的字段（追踪记录、通道、带锁的 cancel_token），主进程和工作进程两个方向都使用
+def _strip(context: Context):
+    return Context(context.type, context.content, {k: v for k, v in context.kwargs.items() if k not in _UNPORTABLE_KEYS})
+
+
+# 构造可以传给工作进程的 context 副本，去掉原始消息中不能序列化的部分
+def _portable(context: Context, task_id):
+    kwargs = _strip(context).kwargs
+    kwargs["worker_task_id"] = task_id
+    msg = kwargs.get("msg")
+    if msg is not None:
+        msg = copy.copy(msg)
+        msg._prepare_fn = None # 需要下载的附件已经在主进程中准备好了
+        try:
+            pickle.dumps(msg._rawmsg)
+        except Exception:
+            msg._rawmsg = None
+        kwargs["msg"] = msg
+    return Context(context.type, context.content, kwargs)
+
+
+_workers = None
+_workers_lock = threading.Lock()
+
+
+# 获取工作进程池，第一次使用时按配置 process_workers 启动工作进程
+def get_process_workers(channel) -> ProcessWorkers:
+    global _workers
+    if _workers is None:
+        with _workers_lock:
+            if _workers is None:
+                _workers = ProcessWorkers(channel, int(conf().get("process_workers", 0)))
+    return _workers
+
+
+def _collect_in_flight():
+    workers = _workers
+    if workers is None:
+        return {}
+    return {(str(stats["worker"]),): stats["in_flight"] for stats in workers.stats()}
+
+
+metrics.gauge("process_worker_in_flight", "Messages dispatched to the worker process and not yet returned", ["worker"], func=_collect_in_flight)
+
+
+# 工作进程的入口
+def _worker_main(index, conn, config_dict, channel_info):
+    import config as config_module
+    from common.worker_pool import get_pool
+
+    config_module.config = config_module.Config(config_dict)
+    config_module.config.load_user_datas()
+    if channel_info["load_plugins"]:
+        PluginManager().load_plugins()
+    channel = _worker_channel(channel_info, conn)
+    pool = get_pool("llm")
+    logger.info("[process_workers] worker {} started".format(index))
+
+    tokens = {} # task_id --> 正在处理的消息的 CancelToken
+
+    def handle(task_id, context):
+        try:
+            reply = channel._generate_reply(context)
+            if reply and reply.content:
+                reply = channel._decorate_reply(context, reply)
+            else:
+                reply = None
+            channel.reply_to_parent("result", task_id, True, reply)
+        except BaseException as e:
+            channel.reply_to_parent("result", task_id, False, e)
+        finally:
+            tokens.pop(task_id, None)
+
+    while True:
+        try:
+            kind, task_id, context = pickle.loads(conn.recv_bytes())
+        except (EOFError, OSError): # 主进程已经退出
+            break
+        if kind == "cancel":
+            token = tokens.get(task_id)
+            if token is not None:
+                token.cancel("cancelled by main process")
+            continue
+        context["cancel_token"] = tokens[task_id] = CancelToken()
+        try:
+            pool.submit(handle, task_id, context)
+        except Full as e:
+            channel.reply_to_parent("result", task_id, False, e)
+
+
+# 工作进程中使用的通道，继承 ChatChannel 以复用生成和装饰回复的逻辑，但不启动消费线程，也不连接消息平台
+def _worker_channel(channel_info, conn):
+    from channel.chat_channel import ChatChannel
+
+    class WorkerChannel(ChatChannel):
+        channel_type = channel_info["channel_type"]
+        NOT_SUPPORT_REPLYTYPE = channel_info["not_support_replytype"]
+
+        def __init__(self):
+            self.name = channel_info["name"]
+            self.user_id = channel_info["user_id"]
+            self.conn_lock = threading.Lock() # 多个处理线程共用一个 Pipe 发送结果
+
+        # 插件直接发送的消息转发给主进程，主进程使用原始的 context 发送；retry_cnt 和 ChatChannel._send 的参数保持兼容，重试由主进程负责
+        def send(self, reply, context, retry_cnt=0):
+            self.reply_to_parent("send", context.get("worker_task_id"), True, (reply, _strip(context)))
+
+        def cancel_session(self, session_id):
+            self.reply_to_parent("cancel_session", None, True, session_id)
+
+        def cancel_all_session(self):
+            self.reply_to_parent("cancel_session", None, True, None)
+
+        def reply_to_parent(self, kind, task_id, ok, payload):
+            try:
+                data = pickle.dumps((kind, task_id, ok, payload))
+            except Exception as e: # 回复或者异常不能序列化
+                if kind == "send":
+                    logger.error("[process_workers] drop reply that can not be sent to main process: {}".format(e))
+                    return
+                data = pickle.dumps(("result", task_id, False, RuntimeError("can not send result to main process: {}".format(e))))
+            with self.conn_lock:
+                conn.send_bytes(data)
+
+    return WorkerChannel()
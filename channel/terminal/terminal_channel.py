@@ -28,6 +28,7 @@ class TerminalMessage(ChatMessage):
 # 定义一个终端交互的通道类，模拟聊天机器人在终端中的对话
 class TerminalChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE] # 定义不支持的回复类型，比如语音类型
+    STREAM_MODE = "render" # 流式回复收到一段打印一段
     # 定义发送消息的方法，用于输出机器人回复
     def send(self, reply: Reply, context: Context):
         print("\nBot:") # 输出机器人回复的前缀
@@ -57,7 +58,17 @@ class TerminalChannel(ChatChannel):
         print("\nUser:", end="")  # 提示用户输入下一条消息
         sys.stdout.flush() # 刷新标准输出缓冲区
         return
-    
+
+    # 逐段打印流式回复
+    def send_stream(self, stream, context: Context):
+        print("\nBot:")
+        try:
+            for delta in stream:
+                print(delta, end="", flush=True) # 每段立即输出，不等待换行
+        finally:
+            print("\n\nUser:", end="")  # 提示用户输入下一条消息
+            sys.stdout.flush()
+
     def startup(self):
         context = Context() # 初始化消息上下文对象
         logger.setLevel("WARN") # 设置日志级别为 "WARN"（仅显示警告及以上的日志）
@@ -2,7 +2,7 @@ import sys
 import time
 import web
 import json
-from queue import Queue  # 用于实现消息队列
+from queue import Queue, Empty  # 用于实现消息队列
 from bridge.context import *
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel, check_prefix
@@ -33,6 +33,7 @@ class WebMessage(ChatMessage):
 @singleton
 class WebChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE] # 定义不支持的回复类型，如语音
+    STREAM_MODE = "render" # 流式回复的每一段作为一个 SSE 事件推送给页面
     _instance = None # 单例实例
     
     # def __new__(cls):
@@ -77,9 +78,6 @@ class WebChannel(ChatChannel):
             # 获取用户ID，如果没有则使用默认值
             # user_id = getattr(context.get("session", None), "session_id", "default_user")
             user_id = context["receiver"]
-            # 如果用户ID没有对应的消息队列，则为其创建一个
-            if user_id not in self.message_queues:
-                self.message_queues[user_id] = Queue()
             # 构造消息数据结构
             message_data = {
                 "type": str(reply.type), # 消息类型
@@ -87,11 +85,23 @@ class WebChannel(ChatChannel):
                 "timestamp": time.time()  # 消息时间戳
             }
             # 将消息加入对应用户的队列
-            self.message_queues[user_id].put(message_data)
+            self._get_queue(user_id).put(message_data)
             logger.debug(f"Message queued for user {user_id}") # 日志记录消息入队成功
         except Exception as e: # 日志记录异常信息
             logger.error(f"Error in send method: {e}")
             raise  # 抛出异常
+    # 逐段推送流式回复：同一条回复的片段带有相同的 stream_id，页面把它们追加到同一条消息中，最后一个事件的 done 为 True
+    def send_stream(self, stream, context: Context):
+        queue = self._get_queue(context["receiver"])
+        stream_id = self._generate_msg_id()
+        try:
+            for delta in stream:
+                queue.put({"type": str(ReplyType.STREAM), "stream_id": stream_id, "content": delta, "done": False, "timestamp": time.time()})
+        finally:
+            queue.put({"type": str(ReplyType.STREAM), "stream_id": stream_id, "content": "", "done": True, "timestamp": time.time()})
+    # 获取用户的消息队列，没有时创建
+    def _get_queue(self, user_id):
+        return self.message_queues.setdefault(user_id, Queue())
     # 处理 Server-Sent Events (SSE) 实现实时通信。
     def sse_handler(self, user_id):
         # 设置响应头，表明是 SSE 流
@@ -99,20 +109,20 @@ class WebChannel(ChatChannel):
         web.header('Cache-Control', 'no-cache') # 禁止缓存，确保实时性
         web.header('Connection', 'keep-alive') # 保持连接不断开，持续推送数据
         # 确保用户有对应的消息队列，如果没有则初始化一个
-        if user_id not in self.message_queues:
-            self.message_queues[user_id] = Queue()
+        queue = self._get_queue(user_id)
         
         try:    
             while True:  # 不断循环，持续发送数据
                 try:
-                    # 发送心跳消息，防止连接超时
-                    yield f": heartbeat\n\n"  # SSE 的注释消息格式，以确保连接活跃
-                    # 检查用户消息队列是否有新消息（非阻塞）
-                    if not self.message_queues[user_id].empty():
-                        message = self.message_queues[user_id].get_nowait() # 从消息队列中非阻塞地获取消息
-                        # 将消息内容转为 JSON 格式并发送到客户端
-                        yield f"data: {json.dumps(message)}\n\n"
-                    time.sleep(0.5) # 延迟 0.5 秒，降低 CPU 占用率
+                    # 等待新消息，有消息时立即发送，流式回复的片段不会因为轮询间隔而延迟
+                    try:
+                        message = queue.get(timeout=0.5)
+                    except Empty:
+                        # 0.5 秒内没有消息时发送心跳消息，防止连接超时
+                        yield f": heartbeat\n\n"  # SSE 的注释消息格式，以确保连接活跃
+                        continue
+                    # 将消息内容转为 JSON 格式并发送到客户端
+                    yield f"data: {json.dumps(message)}\n\n"
                 except Exception as e: # 出现异常时,记录错误日志并中断循环
                     logger.error(f"SSE Error: {e}")
                     break
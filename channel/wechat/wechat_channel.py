@@ -12,6 +12,7 @@ from channel.chat_channel import ChatChannel
 from channel import chat_channel
 from channel.wechat.wechat_message import *
 from common.expired_dict import ExpiredDict
+from common.journal import get_journal
 from common.log import logger
 from common.singleton import singleton
 from common.time_check import time_checker
@@ -108,6 +109,7 @@ class WechatChannel(ChatChannel):
         super().__init__()
         self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds", 3600))
         self.auto_login_times = 0
+        self.replay_pending = False # 是否有等待登录后重放的消息日志
 
     def startup(self):
         try:
@@ -126,11 +128,28 @@ class WechatChannel(ChatChannel):
             self.user_id = itchat.instance.storageClass.userName
             self.name = itchat.instance.storageClass.nickName
             logger.info("Wechat login success, user_id: {}, nickname: {}".format(self.user_id, self.name))
+            if self.replay_pending:
+                self.replay_pending = False
+                super().replay_journal()
             # start message listener
             itchat.run()
         except Exception as e:
             logger.exception(e)
 
+    # 登录成功之前无法发送回复，消息日志推迟到登录之后再重放
+    def replay_journal(self):
+        self.replay_pending = True
+        return 0
+
+    # 消息日志中的 receiver 是上次登录时的 UserName，只有热启动（hot_reload）恢复了上次的登录状态时才仍然有效。
+    # 重新扫码登录后 UserName 都会变化，重放的回复无法送达，直接在日志中标记为完成并丢弃
+    def _replay(self, context: Context):
+        if conf().get("hot_reload", False):
+            return super()._replay(context)
+        logger.warning("[WX] drop journal entry {} after a fresh login, receiver={} is no longer valid".format(context["journal_id"], context.get("receiver")))
+        get_journal().complete(context["journal_id"])
+        return False
+
     def exitCallback(self):
         try:
             from common.linkai_client import chat_client
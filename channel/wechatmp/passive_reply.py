@@ -134,6 +134,7 @@ class Query:
                     (reply_type, reply_content) = channel.cache_dict[from_user].pop(0)
                     if not channel.cache_dict[from_user]:  # If popping the message makes the list empty, delete the user entry from cache
                         del channel.cache_dict[from_user]
+                    channel.save_cache(from_user)
                 except IndexError:
                     return "success"
 
@@ -148,7 +149,7 @@ class Query:
                             max_split=1,
                         )
                         reply_text = splits[0] + continue_text
-                        channel.cache_dict[from_user].append(("text", splits[1]))
+                        channel.cache_reply(from_user, "text", splits[1])
 
                     logger.info(
                         "[wechatmp] Request {} do send to {} {}: {}\n{}".format(
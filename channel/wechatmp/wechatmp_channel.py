@@ -17,6 +17,7 @@ from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wechatmp.common import *
 from channel.wechatmp.wechatmp_client import WechatMPClient
+from common.journal import get_journal
 from common.log import logger
 from common.singleton import singleton
 from common.utils import split_string_by_utf8_length, remove_markdown_symbol
@@ -31,6 +32,10 @@ from voice.audio_convert import any_to_mp3, split_audio
 #         private_key='/ssl/cert.key')
 
 
+# Key prefix of the cached replies saved in the journal
+CACHE_STATE_PREFIX = "wechatmp_cache:"
+
+
 @singleton
 class WechatMPChannel(ChatChannel):
     def __init__(self, passive_reply=True):
@@ -46,12 +51,19 @@ class WechatMPChannel(ChatChannel):
         if aes_key:
             self.crypto = WeChatCrypto(token, aes_key, appid)
         if self.passive_reply:
+            # Passive replies are fetched one per request, so a streamed reply is buffered and sent at once
+            self.STREAM_MODE = None
             # Cache the reply to the user's first message
             self.cache_dict = defaultdict(list)
             # Record whether the current message is being processed
             self.running = set()
             # Count the request from wechat official server by message_id
             self.request_cnt = dict()
+            # Restore the cached replies saved in the journal before restart
+            journal = get_journal()
+            if journal is not None:
+                for key, items in journal.states(CACHE_STATE_PREFIX).items():
+                    self.cache_dict[key[len(CACHE_STATE_PREFIX):]] = [tuple(item) for item in items]
             # The permanent media need to be deleted to avoid media number limit
             self.delete_media_loop = asyncio.new_event_loop()
             t = threading.Thread(target=self.start_loop, args=(self.delete_media_loop,))
@@ -77,13 +89,34 @@ class WechatMPChannel(ChatChannel):
         self.client.material.delete(media_id)
         logger.info("[wechatmp] permanent media {} has been deleted".format(media_id))
 
+    # Cache a reply until the user's next request, and save it to the journal if enabled
+    def cache_reply(self, receiver, reply_type, content):
+        self.cache_dict[receiver].append((reply_type, content))
+        self.save_cache(receiver)
+
+    # Save the cached replies of the user to the journal, an empty cache is removed
+    def save_cache(self, receiver):
+        journal = get_journal()
+        if journal is not None:
+            journal.set_state(CACHE_STATE_PREFIX + receiver, [list(item) for item in self.cache_dict.get(receiver, [])] or None)
+
+    # A replayed message is running like a new request, its reply will be cached for the user's next request
+    def _replay(self, context: Context):
+        if not self.passive_reply:
+            return super()._replay(context)
+        self.running.add(context["session_id"])
+        accepted = super()._replay(context)
+        if not accepted:
+            self.running.discard(context["session_id"])
+        return accepted
+
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
         if self.passive_reply:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
                 reply_text = remove_markdown_symbol(reply.content)
                 logger.info("[wechatmp] text cached, receiver {}\n{}".format(receiver, reply_text))
-                self.cache_dict[receiver].append(("text", reply_text))
+                self.cache_reply(receiver, "text", reply_text)
             elif reply.type == ReplyType.VOICE:
                 voice_file_path = reply.content
                 duration, files = split_audio(voice_file_path, 60 * 1000)
@@ -104,7 +137,7 @@ class WechatMPChannel(ChatChannel):
                         return
                     media_id = response["media_id"]
                     logger.info("[wechatmp] voice uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                    self.cache_dict[receiver].append(("voice", media_id))
+                    self.cache_reply(receiver, "voice", media_id)
 
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
@@ -124,7 +157,7 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                self.cache_reply(receiver, "image", media_id)
             elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
                 image_storage = reply.content
                 image_storage.seek(0)
@@ -139,7 +172,7 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                self.cache_reply(receiver, "image", media_id)
             elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
                 video_url = reply.content
                 video_res = requests.get(video_url, stream=True)
@@ -158,7 +191,7 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
+                self.cache_reply(receiver, "video", media_id)
 
             elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
                 video_storage = reply.content
@@ -174,7 +207,7 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
+                self.cache_reply(receiver, "video", media_id)
 
         else:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
@@ -0,0 +1,50 @@
+import asyncio
+import functools
+import threading
+from common.log import logger
+from common.worker_pool import get_pool
+try:
+    import aiohttp # 异步 HTTP 客户端，只有开启 async_mode 并使用原生异步的 bot 时才需要
+except ImportError:
+    aiohttp = None
+
+# 整个进程共用一个后台事件循环线程，异步模式下所有消息处理协程都运行在这个循环中
+_loop = None
+_loop_lock = threading.Lock()
+_http_session = None # aiohttp 的 ClientSession，必须在事件循环内创建和使用
+
+# 获取后台事件循环，第一次调用时创建并在守护线程中运行
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is not None:
+        return _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="async-loop", daemon=True)
+            thread.start()
+            _loop = loop
+            logger.info("[async_loop] event loop started")
+        return _loop
+
+# 在后台事件循环中运行协程，可以在任意线程中调用，返回 concurrent.futures.Future
+def submit(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+# 在指定的线程池中运行同步函数并等待结果，用于在协程中调用还没有异步化的代码（插件、同步 bot 等）
+async def run_sync(pool_name, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pool(pool_name), functools.partial(fn, *args, **kwargs))
+
+# 获取共享的 aiohttp 会话，连接会在多个请求之间复用
+async def get_http_session():
+    global _http_session
+    if aiohttp is None:
+        raise RuntimeError("aiohttp is required for async_mode, please install it: pip install aiohttp")
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession()
+    return _http_session
+
+# 把秒数形式的超时配置转换成 aiohttp 的超时对象，None 表示不限制
+def http_timeout(seconds):
+    return aiohttp.ClientTimeout(total=seconds)
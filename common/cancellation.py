@@ -0,0 +1,74 @@
+import threading
+import time
+from common.log import logger
+
+# 协作式取消。
+# future.cancel() 只能取消还没开始执行的任务，已经在调用模型接口或者在重试前 sleep 的任务会继续执行并发出过期的回复。
+# 每条消息的 context["cancel_token"] 中带有一个 CancelToken，ChatChannel.cancel_session / cancel_all_session 会取消它：
+#   处理流程在各个阶段之间（调用 bot、语音转换、发送回复）检查是否已经被取消；
+#   bot 重试前的等待使用 token.sleep，取消时立即结束，不再重试；
+#   通过 add_callback 注册的回调会在取消时执行，用来结束等待中的 future（会话的并发配额立即释放）、取消异步请求等；
+#   已经取消的消息不会再发送回复。
+# 同步的 HTTP 请求无法从其他线程中断，请求返回后检查到已取消会直接丢弃结果。
+
+
+# 消息已被取消。继承 BaseException，避免被 bot 和插件中 except Exception 的重试逻辑当作普通错误处理
+class Cancelled(BaseException):
+    pass
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reason = None # 取消的原因
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    # 取消，只有第一次调用有效，注册的回调在当前线程中依次执行
+    def cancel(self, reason="cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning("[cancellation] cancel callback error: {}".format(e))
+
+    # 注册取消时执行的回调，已经取消时立即执行
+    def add_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    # 已经取消时抛出 Cancelled
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+    # 可以被取消打断的 sleep，取消时抛出 Cancelled
+    def sleep(self, seconds):
+        if self._event.wait(seconds):
+            raise Cancelled(self.reason)
+
+
+# 下面两个函数兼容 token 为 None 的情况（比如插件自己构造的 context 中没有 cancel_token）
+def check(token: CancelToken):
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def sleep(token: CancelToken, seconds):
+    if token is None:
+        time.sleep(seconds)
+        return
+    token.sleep(seconds)
@@ -0,0 +1,49 @@
+from common import http_client
+from common import metrics
+from config import conf
+
+# 会话压缩：会话的 token 数超过 conversation_max_tokens 的 compaction_threshold 后，
+# 在后台（compaction 线程池）用便宜的模型把较早的对话总结成一条摘要，下次请求时替换掉这些消息（见 bot/session_manager.py）。
+# 之前的摘要也在被总结的消息中，摘要会滚动更新；最近的 compaction_keep_messages 条消息保持原样。
+# 开启 conversation_compaction 后，每次请求发送的上下文更短，又不会像直接丢弃最早的对话那样突然忘记之前的内容。
+# 摘要默认通过 OpenAI 兼容的 /chat/completions 接口生成，compaction_api_base、compaction_api_key 为空时使用 open_ai_api_base、open_ai_api_key；
+# 其他模型可以覆盖 SessionManager.summarize。
+
+COMPACTIONS = metrics.counter("session_compactions_total", "Session compactions by result", ["result"])
+SAVED_TOKENS = metrics.counter("session_compaction_saved_tokens_total", "Prompt tokens removed from sessions by compaction")
+
+SUMMARY_PREFIX = "以下是之前对话的摘要：\n"
+
+_PROMPT = "请用简洁的语言总结下面的对话，保留用户的身份、偏好、已经确认的事实、做出的决定和还没有解决的问题，" \
+          "省略寒暄和重复的内容。对话中如果有之前的摘要，请把它合并到新的摘要中。只输出摘要本身。"
+
+
+# 是否开启会话压缩
+def enabled():
+    return conf().get("conversation_compaction", False)
+
+
+# 开始压缩的 token 数
+def threshold(max_tokens):
+    return int(max_tokens * conf().get("compaction_threshold", 0.8))
+
+
+# 把 (角色, 文本) 列表总结成一段摘要，失败时抛出异常
+def summarize(lines) -> str:
+    api_key = conf().get("compaction_api_key") or conf().get("open_ai_api_key")
+    api_base = conf().get("compaction_api_base") or conf().get("open_ai_api_base") or "https://api.openai.com/v1"
+    transcript = "\n".join("{}: {}".format(role, text) for role, text in lines)
+    body = {
+        "model": conf().get("compaction_model", "gpt-4o-mini"),
+        "messages": [{"role": "system", "content": _PROMPT}, {"role": "user", "content": transcript}],
+        "temperature": 0.3,
+        "max_tokens": conf().get("compaction_summary_max_tokens", 500),
+    }
+    headers = {"Content-Type": "application/json", "Authorization": "Bearer " + api_key}
+    res = http_client.post(api_base.rstrip("/") + "/chat/completions", headers=headers, json=body, proxy=True,
+                           timeout=(5, conf().get("compaction_timeout", 120)))
+    res.raise_for_status()
+    summary = res.json()["choices"][0]["message"]["content"].strip()
+    if not summary:
+        raise ValueError("empty summary")
+    return summary
@@ -35,3 +35,12 @@ class Dequeue(Queue):
     # _putleft 方法是将元素放入队列的左边，队列是双端队列（deque）
     def _putleft(self, item): # 这个self.queue是collections.deque对象
         self.queue.appendleft(item)
+    # 从队列左侧开始查找第一个满足条件的元素并将其移除，返回被移除的元素，没有找到时返回 None
+    def remove_first(self, predicate):
+        with self.mutex:
+            for item in self.queue:
+                if predicate(item):
+                    self.queue.remove(item)
+                    self.not_full.notify() # 队列腾出了空间，唤醒等待插入的线程
+                    return item
+        return None
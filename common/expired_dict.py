@@ -1,27 +1,72 @@
-from datetime import datetime, timedelta
-# 一个设置有缓存有效期的字典
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from common import metrics
+from common import timer_wheel
+
+_instances = weakref.WeakValueDictionary() # id --> ExpiredDict 实例，用于统计缓存大小（dict 不可哈希，不能放进 WeakSet）
+
+REMOVED = metrics.counter("expired_dict_removed_total", "Entries removed from ExpiredDict caches without being deleted by the caller", ["reason"])
+
+
+# 一个设置有缓存有效期的字典，读写都会刷新条目的有效期
+# 值直接保存在字典中，另外用一个 OrderedDict 按最近访问的顺序记录每个 key 的过期时间（time.monotonic()）。
+# 有效期都相同，最近访问的顺序也就是过期的顺序，最早过期的条目总是在最前面：
+#   读写时只需要把 key 移到末尾，O(1)；
+#   写入时从最前面顺带删除已经过期的条目，每个条目只会被删除一次，均摊 O(1)，不再需要等到条目被再次访问；
+#   keys()、items() 等先清理过期条目，再直接返回字典中的内容，不需要逐个检查。
+# 可选：max_size 限制条目数，超过时淘汰最久没有访问的条目（LRU）；
+#      sweep_interval 秒在共用的时间轮（见 common/timer_wheel.py）中清理一次，长时间没有写入的缓存也会释放过期的条目。
+# 所有操作都加锁，可以在多个线程中使用。
 class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):  # 初始化方法，接受过期时间（秒）
+    def __init__(self, expires_in_seconds, max_size=None, sweep_interval=None):  # 初始化方法，接受过期时间（秒）
         super().__init__() # 调用父类字典的初始化方法
         self.expires_in_seconds = expires_in_seconds # 设置过期时间（秒）
-     # 获取字典中的元素，如果元素已过期则抛出异常
+        self.max_size = max_size # 最多保存的条目数，None 表示不限制
+        self._deadlines = OrderedDict() # key --> 过期时间，按最近访问的顺序排列
+        self._lock = threading.RLock()
+        _instances[id(self)] = self
+        if sweep_interval:
+            _schedule_sweep(weakref.ref(self), sweep_interval)
+
+    # 获取字典中的元素，如果元素已过期则抛出异常
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)  # 获取值和过期时间
-        if datetime.now() > expiry_time: # 如果当前时间大于过期时间
-            del self[key] # 删除该键值对
-            raise KeyError("expired {}".format(key))  # 抛出过期异常
-        self.__setitem__(key, value) # 更新过期时间
-        return value # 返回值
-     # 设置字典中的元素，保存值和过期时间
+        with self._lock:
+            deadline = self._deadlines.get(key)
+            if deadline is None:
+                raise KeyError(key)
+            now = time.monotonic()
+            if now > deadline: # 已经过期
+                self._remove(key, "expired")
+                raise KeyError("expired {}".format(key))
+            self._touch(key, now) # 更新过期时间
+            return super().__getitem__(key)
+
+    # 设置字典中的元素，保存值并刷新过期时间
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))  # 存储值和过期时间
+        with self._lock:
+            now = time.monotonic()
+            super().__setitem__(key, value)
+            self._touch(key, now)
+            self._sweep(now)
+            if self.max_size is not None:
+                while len(self._deadlines) > self.max_size:
+                    self._remove(next(iter(self._deadlines)), "size")
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+            del self._deadlines[key]
+
     # 获取字典中的元素，若不存在或已过期则返回默认值
     def get(self, key, default=None):
         try:
             return self[key] # 尝试获取元素
         except KeyError:
             return default  # 如果元素不存在或已过期，返回默认值
+
     # 检查字典中是否存在某个键，并且未过期
     def __contains__(self, key):
         try:
@@ -29,13 +74,99 @@ class ExpiredDict(dict):
             return True  # 如果能获取，表示存在
         except KeyError:
             return False  # 如果抛出异常，表示不存在或已过期
-     # 获取字典中所有存在且未过期的键
+
+    _MISSING = object()
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            try:
+                value = self[key]
+            except KeyError:
+                if default is ExpiredDict._MISSING:
+                    raise
+                return default
+            del self[key]
+            return value
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            try:
+                return self[key]
+            except KeyError:
+                self[key] = default
+                return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._deadlines.clear()
+
+    # 获取字典中所有存在且未过期的键
     def keys(self):
-        keys = list(super().keys()) # 获取所有的键
-        return [key for key in keys if key in self] # 只返回未过期的键
+        with self._lock:
+            self._sweep(time.monotonic())
+            return list(super().keys())
+
     # 获取字典中所有存在且未过期的键值对
     def items(self):
-        return [(key, self[key]) for key in self.keys()]  # 返回未过期的键值对
+        with self._lock:
+            self._sweep(time.monotonic())
+            return list(super().items())
+
+    def values(self):
+        with self._lock:
+            self._sweep(time.monotonic())
+            return list(super().values())
+
     # 获取字典中所有未过期的键的迭代器
     def __iter__(self):
-        return self.keys().__iter__()  # 返回未过期的键的迭代器
+        return iter(self.keys())
+
+    def __len__(self):
+        with self._lock:
+            self._sweep(time.monotonic())
+            return super().__len__()
+
+    # 删除所有已经过期的条目
+    def sweep(self):
+        with self._lock:
+            self._sweep(time.monotonic())
+
+    # 以下方法调用方必须持有 self._lock
+    def _touch(self, key, now):
+        self._deadlines[key] = now + self.expires_in_seconds
+        self._deadlines.move_to_end(key)
+
+    # 从最早过期的一端删除已经过期的条目
+    def _sweep(self, now):
+        deadlines = self._deadlines
+        while deadlines:
+            key, deadline = next(iter(deadlines.items()))
+            if deadline >= now:
+                break
+            self._remove(key, "expired")
+
+    def _remove(self, key, reason):
+        del self._deadlines[key]
+        super().__delitem__(key)
+        REMOVED.inc(reason=reason)
+
+
+# 定时清理缓存，缓存被回收后不再继续
+def _schedule_sweep(ref, interval):
+    def sweep():
+        cache = ref()
+        if cache is not None:
+            cache.sweep()
+            _schedule_sweep(ref, interval)
+    timer_wheel.schedule(interval, sweep)
+
+
+# 缓存的数量和条目总数（包括已过期但还没有被删除的条目）
+metrics.gauge("expired_dict_instances", "Number of ExpiredDict caches", func=lambda: len(_instances))
+metrics.gauge("expired_dict_entries", "Entries held by all ExpiredDict caches, including expired ones not yet removed",
+              func=lambda: sum(dict.__len__(d) for d in list(_instances.values())))
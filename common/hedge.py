@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from common import cancellation
+from common import metrics
+from common.cancellation import CancelToken
+from common.log import logger
+from common.worker_pool import get_pool
+from config import conf
+
+# 对冲请求（hedged request），降低长尾耗时。
+# 模型接口偶尔会有卡住的请求，p99 耗时主要由这些请求决定。开启 hedge_requests 后，请求超过最近耗时的 hedge_percentile 分位数
+# 还没有返回时，再发出一个相同的请求，使用先成功返回的结果并取消另一个（同步的 HTTP 请求无法中断，取消后丢弃结果，也不再重试）。
+# hedge_target 为 same 时对冲请求发给同一个服务（ChatGPT、Moonshot 的 bot 内部），
+# 为 alternate 时发给路由中排在第二的服务（需要配置 chat_providers，见 bridge/provider_router.py）。
+# 额外的请求数受 hedge_budget 限制：每个请求积累 hedge_budget 个额度，发出一个对冲请求消耗一个，0.05 表示最多多出 5% 的请求。
+# 耗时样本少于 hedge_min_samples 个时使用固定的 hedge_delay 秒。
+# 用法：result, index = hedger.run([attempt, attempt], ok, cancel_token)，attempt(token) 为一次请求，index 为胜出的请求（0 为原始请求）
+
+HEDGES = metrics.counter("hedge_requests_total", "Hedged requests by outcome", ["name", "result"])
+
+_SAMPLES = 200 # 计算分位数使用的最近耗时样本数
+_BUDGET_BURST = 10 # 额度最多积累的个数，避免长时间没有对冲后短时间内发出大量对冲请求
+_WAIT_INTERVAL = 0.5 # 检查消息是否被取消的间隔（秒）
+
+
+# 是否对发给 target（same 或 alternate）的请求开启对冲
+def enabled(target):
+    return conf().get("hedge_requests", False) and conf().get("hedge_target", "same") == target
+
+
+class Hedger:
+    def __init__(self, name):
+        self.name = name # 指标和日志中的名称
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=_SAMPLES) # 最近成功请求的耗时
+        self._budget = 0.0 # 可以发出的对冲请求数
+
+    # 发出对冲请求前的等待时间
+    def delay(self):
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < conf().get("hedge_min_samples", 20):
+            return conf().get("hedge_delay", 10)
+        index = int(len(samples) * conf().get("hedge_percentile", 95) / 100)
+        return samples[min(index, len(samples) - 1)]
+
+    def _deposit(self):
+        with self._lock:
+            self._budget = min(self._budget + conf().get("hedge_budget", 0.05), _BUDGET_BURST)
+
+    def _withdraw(self):
+        with self._lock:
+            if self._budget >= 1:
+                self._budget -= 1
+                return True
+            return False
+
+    def _record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    # 到了发出下一个请求的时间，额度不足时返回 False
+    def _fire(self):
+        if self._withdraw():
+            HEDGES.inc(name=self.name, result="fired")
+            return True
+        HEDGES.inc(name=self.name, result="skipped")
+        logger.debug("[hedge] {} budget exhausted, not hedging".format(self.name))
+        return False
+
+    # 处理结束的请求，返回胜出的 (结果, 序号)，还没有结果时返回 None。全部结束且都失败时返回第一个请求的结果，它抛出的异常原样抛出
+    def _settle(self, outcomes, launched, ok):
+        for index, outcome in enumerate(outcomes):
+            if outcome is not None and outcome[0] is None and ok(outcome[1]):
+                self._record(outcome[2])
+                HEDGES.inc(name=self.name, result="won_primary" if index == 0 else "won_hedge")
+                if index > 0:
+                    logger.info("[hedge] {} hedged request won after {:.2f}s".format(self.name, outcome[2]))
+                return outcome[1], index
+        if all(outcome is not None for outcome in outcomes[:launched]):
+            error, result, seconds = outcomes[0]
+            if error is not None:
+                raise error
+            return result, 0
+        return None
+
+    # 执行 attempts[0]，超过等待时间还没有结果时执行下一个，返回 (先成功的结果, 序号)。
+    # attempt(token) 在 hedge 线程池中执行，token 是这次请求自己的取消标记，另一个请求胜出或者消息被取消时会被取消
+    def run(self, attempts, ok, cancel_token=None):
+        self._deposit()
+        tokens = [_child(cancel_token) for _ in attempts]
+        outcomes = [None] * len(attempts) # (异常, 结果, 耗时)
+        futures = {}
+        pool = get_pool("hedge")
+
+        def launch(index):
+            futures[pool.submit(_timed, attempts[index], tokens[index])] = index
+
+        launch(0)
+        hedge_at = time.monotonic() + self.delay()
+        try:
+            while True:
+                timeout = _WAIT_INTERVAL
+                if len(futures) < len(attempts):
+                    timeout = max(0, min(timeout, hedge_at - time.monotonic()))
+                done, _ = wait([f for f, i in futures.items() if outcomes[i] is None], timeout, FIRST_COMPLETED)
+                for future in done:
+                    error = future.exception()
+                    outcomes[futures[future]] = (error, None, 0) if error is not None else (None,) + future.result()
+                settled = self._settle(outcomes, len(futures), ok)
+                if settled is not None:
+                    return settled
+                cancellation.check(cancel_token)
+                if len(futures) < len(attempts) and time.monotonic() >= hedge_at:
+                    if self._fire():
+                        launch(len(futures))
+                        hedge_at = time.monotonic() + self.delay()
+                    else:
+                        hedge_at = float("inf")
+        finally:
+            for token in tokens: # 没有结束的请求不再需要
+                token.cancel("hedge finished")
+
+    # run 的异步版本，attempt(token) 返回协程，没有胜出的请求直接取消对应的任务
+    async def arun(self, attempts, ok, cancel_token=None):
+        self._deposit()
+        tokens = [_child(cancel_token) for _ in attempts]
+        outcomes = [None] * len(attempts)
+        tasks = {}
+
+        def launch(index):
+            tasks[asyncio.ensure_future(_atimed(attempts[index], tokens[index]))] = index
+
+        launch(0)
+        hedge_at = time.monotonic() + self.delay()
+        try:
+            while True:
+                timeout = _WAIT_INTERVAL
+                if len(tasks) < len(attempts):
+                    timeout = max(0, min(timeout, hedge_at - time.monotonic()))
+                done, _ = await asyncio.wait([t for t, i in tasks.items() if outcomes[i] is None], timeout=timeout, return_when=FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception() if not task.cancelled() else cancellation.Cancelled("hedge cancelled")
+                    outcomes[tasks[task]] = (error, None, 0) if error is not None else (None,) + task.result()
+                settled = self._settle(outcomes, len(tasks), ok)
+                if settled is not None:
+                    return settled
+                cancellation.check(cancel_token)
+                if len(tasks) < len(attempts) and time.monotonic() >= hedge_at:
+                    if self._fire():
+                        launch(len(tasks))
+                        hedge_at = time.monotonic() + self.delay()
+                    else:
+                        hedge_at = float("inf")
+        finally:
+            for task in tasks:
+                task.cancel()
+            for token in tokens:
+                token.cancel("hedge finished")
+
+
+# 每个请求使用自己的取消标记，消息被取消时一起取消
+def _child(parent):
+    token = CancelToken()
+    if parent is not None:
+        parent.add_callback(token.cancel)
+    return token
+
+
+def _timed(attempt, token):
+    start = time.monotonic()
+    result = attempt(token)
+    return result, time.monotonic() - start
+
+
+async def _atimed(attempt, token):
+    start = time.monotonic()
+    result = await attempt(token)
+    return result, time.monotonic() - start
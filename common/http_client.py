@@ -0,0 +1,147 @@
+import threading
+import time
+from http import cookiejar
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import metrics
+from common.log import logger
+from config import conf
+
+# 所有 bot、语音和翻译服务共用的 HTTP 客户端。
+# 直接调用 requests.post / requests.get 时每个请求都会新建连接，访问同一个接口也要重新进行 TCP 和 TLS 握手。
+# 这里使用一个共享的 requests.Session，按 host 维护连接池并保持长连接，同时统一：
+#   超时：调用方没有指定 timeout 时使用 http_timeout（[连接超时, 读取超时]）
+#   代理：proxy=True 的请求使用配置中的 proxy，只有访问境外接口（OpenAI 等）的服务需要，国内接口保持直连
+#   指标：按 host 统计请求数、耗时和连接池的使用情况
+# 连接池的大小由 http_pool_connections（缓存多少个 host 的连接池）和 http_pool_maxsize（每个 host 保持的连接数）配置。
+# requests/urllib3 只支持 HTTP/1.1，长连接复用已经省掉了大部分握手开销，这里不提供 HTTP/2。
+# 用法和 requests 相同：http_client.post(url, headers=headers, json=body, timeout=(5, 60))
+
+REQUESTS = metrics.counter("http_client_requests_total", "HTTP requests sent through the shared client", ["host", "status"])
+LATENCY = metrics.histogram("http_client_request_seconds", "Latency of HTTP requests sent through the shared client", ["host"],
+                            buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf")))
+
+_session = None
+_adapter = None
+_session_lock = threading.Lock()
+
+
+# 获取共享的会话，第一次调用时按配置创建
+def get_session() -> requests.Session:
+    global _session, _adapter
+    if _session is not None:
+        return _session
+    with _session_lock:
+        if _session is None:
+            session = _new_session()
+            _adapter = session.get_adapter("https://")
+            _session = session
+            logger.info("[http_client] session created, pool_connections={}, pool_maxsize={}".format(
+                _adapter._pool_connections, _adapter._pool_maxsize))
+        return _session
+
+
+# 给 openai SDK 使用的独立会话，有自己的连接池，proxy 为 True 时设置配置的代理。
+# 不能把共享的会话交给 openai：openai 不会给传入的会话设置 openai.proxy，而且每隔几分钟会调用 session.close()，
+# 会关闭所有服务共用的连接池
+def new_session(proxy=False) -> requests.Session:
+    session = _new_session()
+    if proxy and proxies():
+        session.proxies.update(proxies())
+    return session
+
+
+def _new_session():
+    adapter = HTTPAdapter(pool_connections=conf().get("http_pool_connections", 20), pool_maxsize=conf().get("http_pool_maxsize", 20))
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # 和直接调用 requests.post 一样不保存 cookie，避免不同用户、不同服务的请求之间互相影响
+    session.cookies.set_policy(cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+# 配置的代理，没有配置时返回 None
+def proxies():
+    proxy = conf().get("proxy")
+    if not proxy:
+        return None
+    return {"http": proxy, "https": proxy}
+
+
+# 发送请求，参数和 requests.request 相同。proxy 为 True 时使用配置的代理（调用方传入 proxies 时以调用方为准）
+def request(method, url, proxy=False, **kwargs) -> requests.Response:
+    if kwargs.get("timeout") is None:
+        kwargs["timeout"] = tuple(conf().get("http_timeout", [10, 300]))
+    if proxy and "proxies" not in kwargs:
+        kwargs["proxies"] = proxies()
+    host = urlsplit(url).hostname or ""
+    start = time.time()
+    try:
+        response = get_session().request(method, url, **kwargs)
+    except Exception as e:
+        REQUESTS.inc(host=host, status=type(e).__name__)
+        raise
+    finally:
+        LATENCY.observe(time.time() - start, host=host)
+    REQUESTS.inc(host=host, status=str(response.status_code))
+    return response
+
+
+def get(url, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+# 逐个返回 SSE（text/event-stream）响应中 data 字段的内容，收到 [DONE] 时结束，结束或被放弃时关闭响应把连接还给连接池。
+# 请求时需要传入 stream=True，否则 requests 会先读完整个响应
+def iter_sse_data(response: requests.Response):
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                return
+            yield data
+    finally:
+        response.close()
+
+
+# 返回每个 host 连接池的使用情况：created 为建立过的连接数，requests 为通过该连接池发送的请求数，idle 为空闲的长连接数
+def pool_stats() -> list:
+    if _adapter is None:
+        return []
+    result = []
+    pools = _adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        result.append({
+            "host": pool.host,
+            "created": pool.num_connections,
+            "requests": pool.num_requests,
+            "idle": pool.pool.qsize() if pool.pool is not None else 0,
+        })
+    return result
+
+
+# 连接池的指标，每次采集时读取。同一个 host 的 http 和 https 连接池合并统计
+def _collect(field):
+    def collect():
+        values = {}
+        for stats in pool_stats():
+            values[(stats["host"],)] = values.get((stats["host"],), 0) + stats[field]
+        return values
+    return collect
+
+
+metrics.counter("http_client_connections_created_total", "Connections opened by the shared HTTP client", ["host"], func=_collect("created"))
+metrics.gauge("http_client_idle_connections", "Keep-alive connections waiting in the pool", ["host"], func=_collect("idle"))
@@ -0,0 +1,291 @@
+import json
+import os
+import threading
+import time
+from bridge.context import Context, ContextType
+from bridge.reply import ReplyType
+from channel.chat_message import ChatMessage
+from common import metrics
+from common.log import logger
+from config import conf
+
+# 消息日志（预写日志）：进程重启或崩溃时，排队中的消息和正在处理的消息都会丢失。
+# 开启后（journal_path 不为空），被接收进消息队列的每条消息都会以一行 JSON 追加写入日志文件，处理结束（回复、出错、被取消或被丢弃）时再追加一条完成记录，
+# 启动时没有完成记录的消息会被重新放入消息队列处理。记录的格式：
+#   {"op": "add", "id": 1, "ctx": {...}}       接收的消息
+#   {"op": "done", "id": 1}                    消息处理结束
+#   {"op": "state", "key": "...", "value": ...} 通道需要持久化的其他状态（比如公众号被动回复的缓存），value 为 null 表示删除
+# 写入由后台线程批量完成（组提交）：每 journal_flush_interval 秒把这段时间内的所有记录一次写入并 fsync，
+# 调用方只是把记录放入缓冲区，不会等待磁盘；代价是崩溃时最多丢失最近一个批次的记录。
+# 文件超过 journal_max_bytes 时进行压缩：只把还没完成的消息和当前的状态写入新文件，再原子替换旧文件。
+# 重放是“至少一次”语义：回复已经发出、但完成记录还没写入磁盘时崩溃，重启后会再回复一次。
+
+# 不写入日志的 context 参数：追踪记录、取消令牌和通道对象只在当前进程中有意义
+_TRANSIENT_KEYS = ("trace", "cancel_token", "channel", "journal_id")
+# ChatMessage 中会被保存的字段，以下划线开头的（原始消息、准备函数）无法序列化
+_MESSAGE_FIELDS = [name for name in vars(ChatMessage) if not name.startswith("_") and not callable(getattr(ChatMessage, name))]
+_ENUMS = {"ContextType": ContextType, "ReplyType": ReplyType}
+
+FSYNC_SECONDS = metrics.histogram("journal_fsync_seconds", "Time spent writing and fsyncing one journal batch",
+                                  buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, float("inf")))
+BATCH_RECORDS = metrics.histogram("journal_batch_records", "Records written in one journal batch",
+                                  buckets=(1, 2, 5, 10, 50, 100, 500, float("inf")))
+COMPACTIONS = metrics.counter("journal_compactions_total", "Times the journal file was compacted")
+
+
+class Journal:
+    def __init__(self, path, flush_interval=0.05, max_bytes=16 * 1024 * 1024):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self._cond = threading.Condition()
+        self._buffer = [] # 等待写入的记录
+        self._writing = False # 后台线程是否正在写入一个批次
+        self._entries = {} # id --> 还没完成的消息，dict 保持插入顺序，压缩和重放时按接收顺序输出
+        self._states = {} # key --> value
+        self._next_id = 1
+        self._unfinished = self._load() # 上次运行时没有完成的消息，由 take_unfinished 取走一次
+        self._compact_at = max_bytes
+        self._file = open(path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="journal-writer", daemon=True)
+        self._thread.start()
+
+    # 读取已有的日志文件，恢复未完成的消息和状态。进程在写入中途崩溃时最后一行可能不完整，直接忽略
+    def _load(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("[journal] skip broken record in {}".format(self.path))
+                    continue
+                op = record.get("op")
+                if op == "add":
+                    self._entries[record["id"]] = record["ctx"]
+                    self._next_id = max(self._next_id, record["id"] + 1)
+                elif op == "done":
+                    self._entries.pop(record["id"], None)
+                elif op == "state":
+                    if record.get("value") is None:
+                        self._states.pop(record["key"], None)
+                    else:
+                        self._states[record["key"]] = record["value"]
+        if self._entries:
+            logger.info("[journal] {} unfinished messages in {}".format(len(self._entries), self.path))
+        return list(self._entries.items())
+
+    # 记录一条接收的消息，返回消息在日志中的 id
+    def append(self, data) -> int:
+        with self._cond:
+            journal_id = self._next_id
+            self._next_id += 1
+            self._entries[journal_id] = data
+            self._write({"op": "add", "id": journal_id, "ctx": data})
+        return journal_id
+
+    # 记录消息处理结束
+    def complete(self, journal_id):
+        with self._cond:
+            if self._entries.pop(journal_id, None) is not None:
+                self._write({"op": "done", "id": journal_id})
+
+    # 保存一项状态，value 为 None 时删除
+    def set_state(self, key, value):
+        with self._cond:
+            if value is None:
+                if self._states.pop(key, None) is None:
+                    return
+            else:
+                self._states[key] = value
+            self._write({"op": "state", "key": key, "value": value})
+
+    # 返回 key 以 prefix 开头的所有状态
+    def states(self, prefix=""):
+        with self._cond:
+            return {key: value for key, value in self._states.items() if key.startswith(prefix)}
+
+    # 取走上次运行时没有完成的消息 [(id, data)]，只返回一次，避免重复重放
+    def take_unfinished(self):
+        with self._cond:
+            entries, self._unfinished = self._unfinished, []
+            return entries
+
+    # 还没完成的消息数
+    def pending_count(self):
+        with self._cond:
+            return len(self._entries)
+
+    # 把记录放入缓冲区并唤醒后台线程，调用方必须已经持有 self._cond
+    def _write(self, record):
+        if self._closed:
+            return
+        self._buffer.append(json.dumps(record, ensure_ascii=False))
+        if len(self._buffer) == 1:
+            self._cond.notify_all()
+
+    # 后台线程：等到有记录后再等待 flush_interval，让这段时间内的记录合并成一个批次写入
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closed:
+                    self._cond.wait()
+                if not self._buffer and self._closed:
+                    return
+            if self.flush_interval > 0 and not self._closed:
+                time.sleep(self.flush_interval)
+            self._flush_batch()
+
+    # 写入缓冲区中的记录并 fsync，文件过大时压缩
+    def _flush_batch(self):
+        with self._cond:
+            lines, self._buffer = self._buffer, []
+            self._writing = True
+        try:
+            if lines:
+                with FSYNC_SECONDS.time():
+                    data = "\n".join(lines) + "\n"
+                    self._file.write(data)
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                self._size += len(data.encode("utf-8"))
+                BATCH_RECORDS.observe(len(lines))
+            if self._size >= self._compact_at:
+                self._compact()
+        except Exception as e:
+            logger.exception("[journal] write failed: {}".format(e))
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+    # 压缩：把未完成的消息和状态写入临时文件，fsync 后原子替换日志文件。
+    # 内存中的 _entries 和 _states 已经包含了缓冲区中所有记录的结果，所以替换后缓冲区可以直接丢弃
+    def _compact(self):
+        with self._cond:
+            records = [{"op": "add", "id": journal_id, "ctx": data} for journal_id, data in self._entries.items()]
+            records += [{"op": "state", "key": key, "value": value} for key, value in self._states.items()]
+            self._buffer = []
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp_path, self.path)
+        self._file.close()
+        self._file = open(self.path, "a", encoding="utf-8")
+        old_size, self._size = self._size, size
+        # 存活的记录本身就很大时，避免每个批次都重新压缩
+        self._compact_at = max(self.max_bytes, size * 2)
+        COMPACTIONS.inc()
+        logger.info("[journal] compacted {} from {} to {} bytes, {} records".format(self.path, old_size, size, len(records)))
+
+    # 等待缓冲区中的记录全部写入磁盘
+    def flush(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._buffer or self._writing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    # 写入剩余的记录并关闭文件，之后的记录会被忽略
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=5)
+        self._file.close()
+
+
+# 把 context 转换为可以写入日志的 dict，无法序列化的参数会被跳过
+def dump_context(context: Context) -> dict:
+    kwargs = {}
+    for key, value in context.kwargs.items():
+        if key in _TRANSIENT_KEYS:
+            continue
+        if key == "msg" and isinstance(value, ChatMessage):
+            fields = {}
+            for name in _MESSAGE_FIELDS:
+                field = _dump_value(getattr(value, name, None))
+                if _serializable(field):
+                    fields[name] = field
+            kwargs[key] = {"__msg__": fields}
+            continue
+        value = _dump_value(value)
+        if not _serializable(value):
+            logger.debug("[journal] skip unserializable context value: {}".format(key))
+            continue
+        kwargs[key] = value
+    return {"type": context.type.name, "content": context.content, "kwargs": kwargs}
+
+
+# 从日志中的 dict 恢复 context，msg 会恢复为普通的 ChatMessage（没有原始消息对象，附件已经在 content 指向的文件中）
+def load_context(data) -> Context:
+    kwargs = {}
+    for key, value in data["kwargs"].items():
+        if isinstance(value, dict) and "__msg__" in value:
+            msg = ChatMessage(None)
+            for name, field in value["__msg__"].items():
+                setattr(msg, name, _load_value(field))
+            msg._prepared = True
+            kwargs[key] = msg
+        else:
+            kwargs[key] = _load_value(value)
+    return Context(ContextType[data["type"]], data["content"], kwargs)
+
+
+def _dump_value(value):
+    for name, enum in _ENUMS.items():
+        if isinstance(value, enum):
+            return {"__enum__": name, "name": value.name}
+    return value
+
+
+def _serializable(value):
+    try:
+        json.dumps(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def _load_value(value):
+    if isinstance(value, dict) and "__enum__" in value:
+        return _ENUMS[value["__enum__"]][value["name"]]
+    return value
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+# 返回全局的消息日志，没有配置 journal_path 时返回 None
+def get_journal():
+    global _journal
+    if _journal is None:
+        path = conf().get("journal_path", "")
+        if not path:
+            return None
+        with _journal_lock:
+            if _journal is None:
+                _journal = Journal(path, conf().get("journal_flush_interval", 0.05), conf().get("journal_max_bytes", 16 * 1024 * 1024))
+    return _journal
+
+
+# 进程退出前把缓冲区中的记录写入磁盘
+def close_journal():
+    if _journal is not None:
+        _journal.close()
+
+
+metrics.gauge("journal_pending_entries", "Accepted messages not yet marked done in the journal",
+              func=lambda: _journal.pending_count() if _journal is not None else 0)
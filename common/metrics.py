@@ -0,0 +1,218 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from common.log import logger
+
+# 简单的指标收集，输出 Prometheus 的文本格式，用于监控队列积压、线程池饱和度和模型接口耗时等。
+# 指标在使用的模块中定义，例如：
+#   MESSAGES = metrics.counter("chat_messages_received_total", "Messages received", ["channel"])
+#   MESSAGES.inc(channel="wx")
+# 配置 metrics_port 后，在单独的端口上提供 /metrics 接口，和各通道自己的 HTTP 服务互不影响。
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.func = func # 采集时计算数值的函数，返回数值或者 {标签值元组: 数值}，用于从已有的统计数据中读取
+        self._lock = threading.Lock()
+        self._values = {} # 标签值元组 --> 数值
+        if not self.labelnames and self.type != "histogram":
+            self._values[()] = 0 # 没有标签的指标从 0 开始输出
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+    def samples(self):
+        if self.func is not None:
+            return self._collect()
+        with self._lock:
+            return [(self.name + self._format_labels(key), value) for key, value in self._values.items()]
+
+    def _collect(self):
+        try:
+            result = self.func()
+        except Exception as e:
+            logger.warning("[metrics] collect {} failed: {}".format(self.name, e))
+            return []
+        if not isinstance(result, dict):
+            return [(self.name, result)]
+        return [(self.name + self._format_labels(key if isinstance(key, tuple) else (key,)), value) for key, value in result.items()]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.type)]
+        for name, value in self.samples():
+            lines.append("{} {}".format(name, _format_value(value)))
+        return "\n".join(lines)
+
+
+# 只增不减的计数器
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+# 可增可减的数值
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+# 直方图，统计耗时等数值的分布
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [[0] * len(self.buckets), 0, 0] # [各区间计数, 总和, 总数]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[0][i] += 1
+                    break
+            data[1] += value
+            data[2] += 1
+
+    # 统计代码块的耗时，用法：with histogram.time(bot="chatGPT"): ...
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, c in zip(self.buckets, counts):
+                    cumulative += c
+                    le = "+Inf" if bound == float("inf") else _format_value(bound)
+                    result.append((self.name + "_bucket" + self._format_labels(key, ("le", le)), cumulative))
+                result.append((self.name + "_sum" + self._format_labels(key), total))
+                result.append((self.name + "_count" + self._format_labels(key), count))
+        return result
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+_metrics = {} # 指标名称 --> 指标对象
+_metrics_lock = threading.Lock()
+
+
+def _register(cls, name, *args, **kwargs):
+    with _metrics_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+
+# 获取或创建指标，同名的指标只会创建一次
+def counter(name, documentation, labelnames=(), func=None) -> Counter:
+    return _register(Counter, name, documentation, labelnames, func=func)
+
+
+def gauge(name, documentation, labelnames=(), func=None) -> Gauge:
+    return _register(Gauge, name, documentation, labelnames, func=func)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+# 输出所有指标的 Prometheus 文本格式
+def render() -> str:
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # 不输出每次采集的访问日志
+        pass
+
+
+_server = None
+
+
+# 在单独的线程中启动指标服务，端口为 0 时不启动
+def start_server(port, host="127.0.0.1"):
+    global _server
+    if not port or _server is not None:
+        return _server
+    try:
+        _server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    except Exception as e:
+        logger.error("[metrics] start metrics server on {}:{} failed: {}".format(host, port, e))
+        return None
+    threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("[metrics] serving metrics on http://{}:{}/metrics".format(host, port))
+    return _server
@@ -0,0 +1,189 @@
+import threading
+import time
+
+from common import metrics
+from config import conf
+
+# 按 key 限流的令牌桶，不使用后台线程：每次访问时按经过的时间补充令牌（惰性补充）。
+# 每个 key 有两个维度：每分钟请求数（rpm）和每分钟 token 数（tpm），为 0 表示不限制该维度。
+#   请求数在调用模型之前扣除；token 数在请求结束后按实际用量扣除（charge），可以扣成负数，欠下的额度补回来之前新的请求需要等待。
+# try_acquire 不阻塞，返回 0 表示获取成功，否则返回还需要等待的秒数（retry after），调用方可以先处理其他任务，到时间再来；
+# acquire 是阻塞的版本，兼容原来 TokenBucket.get_token 的用法。
+#
+# 消息调度使用的多维度限流由 rate_limits 配置，每个维度对每个 key 单独计数：
+#   "rate_limits": {"user": {"rpm": 10, "tpm": 20000}, "group": {"rpm": 30}, "model": {"rpm": 500, "tpm": 90000}, "api_key": {...}}
+# user 为发送消息的用户，group 为群聊，model 为模型，api_key 为使用的 API 密钥。
+# ChatChannel 派发消息前调用 check(context)，被限流的会话延后到可以获取时再派发，不占用处理线程；
+# Bridge 在模型回复后调用 charge(context, tokens)，token 数使用会话中已经计算好的 token 数（Session.tokens）。
+
+WAITS = metrics.counter("token_bucket_waits_total", "Token requests that had to wait for a token")
+WAIT_SECONDS = metrics.histogram("token_bucket_wait_seconds", "Time spent waiting for a token", buckets=(0.1, 0.5, 1, 3, 10, 30, 60, float("inf")))
+TIMEOUTS = metrics.counter("token_bucket_timeouts_total", "Token requests that timed out")
+DEFERRED = metrics.counter("rate_limit_deferred_total", "Messages deferred by the rate limiter", ["dimension"])
+
+_MAX_KEYS = 10000 # key 的数量超过这个值时清理已经补满的桶（长时间没有请求的 key）
+
+
+class _Bucket:
+    __slots__ = ("level", "updated")
+
+    def __init__(self, level, now):
+        self.level = level
+        self.updated = now
+
+
+class RateLimiter:
+    def __init__(self, rpm=0, tpm=0, initial=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.initial = initial # 新 key 的初始令牌比例，None 表示桶是满的
+        self._lock = threading.Lock()
+        self._requests = {} # key --> 请求数的桶
+        self._tokens = {} # key --> token 数的桶
+
+    # 按经过的时间补充令牌，返回 key 对应的桶，调用方必须持有 self._lock
+    def _bucket(self, buckets, key, limit, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= _MAX_KEYS:
+                self._prune(buckets, limit, now)
+            bucket = buckets[key] = _Bucket(limit if self.initial is None else limit * self.initial, now)
+            return bucket
+        bucket.level = min(limit, bucket.level + (now - bucket.updated) * limit / 60)
+        bucket.updated = now
+        return bucket
+
+    @staticmethod
+    def _prune(buckets, limit, now):
+        for key in [k for k, b in buckets.items() if b.level + (now - b.updated) * limit / 60 >= limit]:
+            del buckets[key]
+
+    # 需要等待的秒数，调用方必须持有 self._lock。tokens 为预计使用的 token 数，桶中至少要有 min(tokens, tpm) 且不少于 1 个
+    def _wait(self, key, tokens, now):
+        wait = 0
+        if self.rpm > 0:
+            bucket = self._bucket(self._requests, key, self.rpm, now)
+            wait = max(wait, (1 - bucket.level) * 60 / self.rpm)
+        if self.tpm > 0:
+            bucket = self._bucket(self._tokens, key, self.tpm, now)
+            need = min(max(tokens, 1), self.tpm)
+            wait = max(wait, (need - bucket.level) * 60 / self.tpm)
+        return wait
+
+    # 扣除一次请求和预计的 token 数，调用方必须持有 self._lock，且已经通过 _wait 确认不需要等待
+    def _take(self, key, tokens, now):
+        if self.rpm > 0:
+            self._bucket(self._requests, key, self.rpm, now).level -= 1
+        if self.tpm > 0 and tokens > 0:
+            self._bucket(self._tokens, key, self.tpm, now).level -= tokens
+
+    # 不阻塞地获取，成功时返回 0，否则返回需要等待的秒数
+    def try_acquire(self, key=None, tokens=0):
+        now = time.monotonic()
+        with self._lock:
+            wait = self._wait(key, tokens, now)
+            if wait <= 0:
+                self._take(key, tokens, now)
+                return 0
+            return wait
+
+    # 阻塞地获取，超过 timeout 秒还没有获取到时返回 False
+    def acquire(self, key=None, tokens=0, timeout=None):
+        start = None
+        while True:
+            wait = self.try_acquire(key, tokens)
+            if wait <= 0:
+                if start is not None:
+                    WAIT_SECONDS.observe(time.monotonic() - start)
+                return True
+            now = time.monotonic()
+            if start is None:
+                start = now
+                WAITS.inc()
+            if timeout is not None:
+                left = start + timeout - now
+                if left <= 0:
+                    TIMEOUTS.inc()
+                    WAIT_SECONDS.observe(now - start)
+                    return False
+                wait = min(wait, left)
+            time.sleep(wait)
+
+    # 请求结束后按实际用量扣除 token 数
+    def charge(self, key, tokens):
+        if self.tpm <= 0 or tokens <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._bucket(self._tokens, key, self.tpm, now).level -= tokens
+
+
+# 消息在各个维度上的 key
+def _keys(context):
+    msg = context.get("msg")
+    if context.get("isgroup", False):
+        user = getattr(msg, "actual_user_id", None)
+        group = getattr(msg, "other_user_id", None) or context.get("session_id")
+    else:
+        user, group = context.get("receiver"), None
+    return {
+        "user": user or context.get("session_id"),
+        "group": group,
+        "model": context.get("gpt_model") or conf().get("model"),
+        "api_key": context.get("openai_api_key") or "default",
+    }
+
+
+_limiters = {}
+_settings = None
+_lock = threading.Lock()
+
+
+# 按 rate_limits 创建各个维度的限流器，配置变化（#更新配置）后重新创建，调用方必须持有 _lock
+def _dimensions():
+    global _limiters, _settings
+    settings = conf().get("rate_limits") or {}
+    if settings != _settings:
+        _limiters = {name: RateLimiter(item.get("rpm", 0), item.get("tpm", 0)) for name, item in settings.items()}
+        _settings = settings
+    return _limiters
+
+
+# 检查消息能否现在处理，所有维度都允许时扣除一次请求并返回 (0, None)，否则不扣除，返回 (需要等待的秒数, 被限流的维度)
+def check(context):
+    now = time.monotonic()
+    with _lock:
+        limiters = _dimensions()
+        if not limiters:
+            return 0, None
+        keys = _keys(context)
+        wait, dimension = 0, None
+        for name, limiter in limiters.items():
+            if keys.get(name) is None:
+                continue
+            with limiter._lock:
+                seconds = limiter._wait(keys[name], 0, now)
+            if seconds > wait:
+                wait, dimension = seconds, name
+        if wait > 0:
+            DEFERRED.inc(dimension=dimension)
+            return wait, dimension
+        for name, limiter in limiters.items():
+            if keys.get(name) is not None:
+                with limiter._lock:
+                    limiter._take(keys[name], 0, now)
+        return 0, None
+
+
+# 记录消息实际使用的 token 数
+def charge(context, tokens):
+    if not tokens:
+        return
+    with _lock:
+        limiters = _dimensions()
+    if not limiters:
+        return
+    keys = _keys(context)
+    for name, limiter in limiters.items():
+        if keys.get(name) is not None:
+            limiter.charge(keys[name], tokens)
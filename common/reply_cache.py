@@ -0,0 +1,220 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from bridge.context import ContextType
+from bridge.reply import Reply, ReplyType
+from common import metrics
+from common.log import logger
+from config import conf
+
+# 回复缓存：很多问题（常见问题、固定的帮助类提问）会被不同的用户反复提问，每次都要调用一次收费的模型接口。
+# 开启 reply_cache 后，相同的问题在 reply_cache_ttl 秒内直接使用缓存的回复。缓存的 key 由以下内容计算：
+#   bot 类型、模型、会话的系统提示（character_desc 或角色插件设置的角色描述）、归一化后的问题，以及最近 reply_cache_history_turns 轮对话
+# 归一化：全角转半角、转小写、合并空白、去掉末尾的标点，"你好吗？" 和 "你好吗" 命中同一条缓存。
+# 缓存分两级：内存中按 LRU 淘汰，条数不超过 reply_cache_max_entries、总大小不超过 reply_cache_max_bytes；
+# 配置 reply_cache_path 后还会写入 sqlite 文件，内存中被淘汰或者重启后仍然可以命中。
+# 以下情况不使用缓存：
+#   非文本消息、管理命令（# 开头）、插件把 context["reply_cache"] 设为 False、会话在 reply_cache_bypass_sessions 中、
+#   bot 没有会话管理（无法保持对话记录一致），以及开启 reply_cache_bypass_history 时会话中已有 key 之外的对话记录（上下文会影响回答）
+# 命中缓存时仍然通过 session_query 和 session_reply 把问题和回复加入会话，和调用了模型一样。
+
+LOOKUPS = metrics.counter("reply_cache_lookups_total", "Reply cache lookups", ["result"])
+BYPASSED = metrics.counter("reply_cache_bypassed_total", "Requests not eligible for the reply cache", ["reason"])
+EVICTIONS = metrics.counter("reply_cache_evictions_total", "Entries evicted from the in-memory reply cache")
+
+# 归一化时去掉的末尾标点
+_TRAILING_PUNCTUATION = "?!.~。？！～…"
+_SPACES = re.compile(r"\s+")
+# 每写入多少条清理一次 sqlite 中过期的记录
+_PURGE_EVERY = 1000
+
+
+class ReplyCache:
+    def __init__(self, ttl=3600, max_entries=10000, max_bytes=32 * 1024 * 1024, path=""):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key --> (过期时间, 回复文本)，按最近使用的顺序排列
+        self._bytes = 0
+        self._puts = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS reply_cache (key TEXT PRIMARY KEY, expire_at REAL, text TEXT)")
+            self._db.commit()
+
+    # 返回缓存的回复文本，没有或者已过期时返回 None。过期时间使用 time.time()，sqlite 中的记录重启后仍然有效
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    LOOKUPS.inc(result="hit_memory")
+                    return entry[1]
+                self._remove(key)
+            if self._db is not None:
+                row = self._db.execute("SELECT expire_at, text FROM reply_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[0] > now:
+                    self._put_memory(key, row[0], row[1]) # 放回内存
+                    LOOKUPS.inc(result="hit_disk")
+                    return row[1]
+        LOOKUPS.inc(result="miss")
+        return None
+
+    def put(self, key, text):
+        expire_at = time.time() + self.ttl
+        with self._lock:
+            self._put_memory(key, expire_at, text)
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO reply_cache (key, expire_at, text) VALUES (?, ?, ?)", (key, expire_at, text))
+                    self._puts += 1
+                    if self._puts % _PURGE_EVERY == 0:
+                        self._db.execute("DELETE FROM reply_cache WHERE expire_at <= ?", (time.time(),))
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.warning("[reply_cache] write sqlite failed: {}".format(e))
+
+    # 写入内存并按 LRU 淘汰，调用方必须持有 self._lock
+    def _put_memory(self, key, expire_at, text):
+        if key in self._entries:
+            self._remove(key)
+        size = _size(key, text)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (expire_at, text)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            EVICTIONS.inc()
+
+    def _remove(self, key):
+        expire_at, text = self._entries.pop(key)
+        self._bytes -= _size(key, text)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM reply_cache")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes}
+
+
+def _size(key, text):
+    return len(key) + len(text.encode("utf-8"))
+
+
+# 归一化问题文本
+def normalize(query):
+    text = unicodedata.normalize("NFKC", query).lower()
+    text = _SPACES.sub(" ", text).strip()
+    return text.rstrip(_TRAILING_PUNCTUATION + " ")
+
+
+# 计算这次请求的缓存 key，不使用缓存时返回 None。需要在调用 bot 之前计算，之后会话中会多出这次的问题和回复
+def cache_key(bot, bot_type, query, context):
+    cache = get_reply_cache()
+    if cache is None:
+        return None
+    reason = _bypass_reason(bot, query, context)
+    if reason:
+        BYPASSED.inc(reason=reason)
+        return None
+    session = bot.sessions.build_session(context["session_id"])
+    history = [message for message in session.messages if message.get("role") != "system"]
+    turns = conf().get("reply_cache_history_turns", 0)
+    recent = history[max(0, len(history) - turns * 2):] if turns > 0 else []
+    if len(recent) < len(history) and conf().get("reply_cache_bypass_history", True):
+        BYPASSED.inc(reason="history")
+        return None
+    model = context.get("gpt_model") or conf().get("model")
+    data = json.dumps([bot_type, model, session.system_prompt, recent, normalize(query)], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _bypass_reason(bot, query, context):
+    if context is None or context.type != ContextType.TEXT:
+        return "type"
+    if context.get("reply_cache") is False:
+        return "context"
+    if not query or query.startswith("#") or query in conf().get("clear_memory_commands", ["#清除记忆"]):
+        return "command"
+    if context.get("session_id") in conf().get("reply_cache_bypass_sessions", []):
+        return "session"
+    if getattr(bot, "sessions", None) is None:
+        return "no_session"
+    return None
+
+
+# 查询缓存，命中时把问题和回复加入会话并返回文本回复
+def load(bot, key, query, context):
+    cache = get_reply_cache()
+    text = cache.get(key) if cache is not None else None
+    if text is None:
+        return None
+    logger.info("[reply_cache] hit, session_id={}, query={}".format(context["session_id"], query))
+    bot.sessions.session_query(query, context["session_id"])
+    bot.sessions.session_reply(text, context["session_id"])
+    return Reply(ReplyType.TEXT, text)
+
+
+# 缓存模型生成的文本回复，流式回复在完整结束后缓存，错误和提示类回复不缓存
+def save(key, reply):
+    cache = get_reply_cache()
+    if cache is None or not reply:
+        return
+    if reply.type == ReplyType.TEXT and reply.content:
+        cache.put(key, reply.content)
+    elif reply.type == ReplyType.STREAM:
+        stream = reply.content
+        on_complete = stream.on_complete
+
+        def complete(text):
+            if on_complete:
+                on_complete(text)
+            cache.put(key, text)
+        stream.on_complete = complete
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+# 返回全局的回复缓存，没有开启 reply_cache 时返回 None
+def get_reply_cache():
+    global _cache
+    if not conf().get("reply_cache", False):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ReplyCache(
+                    conf().get("reply_cache_ttl", 3600),
+                    conf().get("reply_cache_max_entries", 10000),
+                    conf().get("reply_cache_max_bytes", 32 * 1024 * 1024),
+                    conf().get("reply_cache_path", ""),
+                )
+    return _cache
+
+
+def _collect(field):
+    return lambda: _cache.stats()[field] if _cache is not None else 0
+
+
+metrics.gauge("reply_cache_entries", "Entries in the in-memory reply cache", func=_collect("entries"))
+metrics.gauge("reply_cache_bytes", "Approximate size of the in-memory reply cache", func=_collect("bytes"))
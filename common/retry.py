@@ -0,0 +1,291 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import Future
+from queue import Full
+
+from common import cancellation
+from common import metrics
+from common import timer_wheel
+from common.log import logger
+from common.worker_pool import get_pool
+from config import conf
+
+# 调用模型接口的重试策略，所有 bot 共用：
+#   退避：第 n 次重试前等待 min(retry_max_delay, base * 2^n)，再加上随机抖动（equal jitter，取一半固定、一半随机），
+#        避免大量请求在同一时间重试。base 为 bot 按错误类型给出的等待秒数（限流 20 秒、超时 5 秒等）。
+#   重试预算：每个请求积累 retry_budget 次重试的额度，另外每秒固定积累 retry_min_per_second 次，额度用完后不再重试，
+#        服务出故障时重试不会让请求量翻倍。额度一开始是满的，请求量小的时候有固定的额度，预算只在请求量大时起作用。
+#   熔断：每个服务一个熔断器。连续失败 circuit_breaker_failures 次后打开，打开期间请求直接失败，不再调用接口；
+#        circuit_breaker_open_seconds 秒后进入半开状态，放行一个探测请求，成功则关闭，失败则重新打开。
+#        只有超时、连接错误、5xx 和上游返回的 429 算作失败；上下文过长、内容审核、用户自己的 API 密钥无效等 4xx 错误
+#        只和单个请求有关，既不算失败也不算成功（见 is_failure），不会因为个别用户的错误让所有人都被熔断。
+#   延后重试：在 ChatChannel 的线程池中处理的消息，重试不在处理线程中 sleep，而是抛出 RetryLater，由 Bridge 转换为
+#        DEFERRED 回复，到时间后由时间轮（common/timer_wheel.py）把重试提交回 llm 线程池，等待期间不占用线程。
+#        其他调用方（插件直接调用 bot、对冲请求、路由、多进程和异步模式）仍然在当前线程或协程中等待。
+
+RETRIES = metrics.counter("retry_attempts_total", "Retries of model API requests", ["provider", "mode"])
+DROPPED = metrics.counter("retry_dropped_total", "Retries not made because of the retry budget", ["provider"])
+REJECTED = metrics.counter("circuit_breaker_rejected_total", "Requests failed fast by an open circuit breaker", ["provider"])
+TRANSITIONS = metrics.counter("circuit_breaker_transitions_total", "Circuit breaker state changes", ["provider", "state"])
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+_BUDGET_BURST = 10 # 重试额度最多积累的次数
+
+
+# 需要等待 delay 秒后再执行 call 重试，继承 BaseException，穿过 bot 中 except Exception 的错误处理
+class RetryLater(BaseException):
+    def __init__(self, delay, call, cancel_token=None):
+        super().__init__("retry after {:.1f}s".format(delay))
+        self.delay = delay
+        self.call = call
+        self.cancel_token = cancel_token
+
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0 # 连续失败的次数
+        self.opened_at = 0
+        self.probe_at = None # 半开状态下探测请求发出的时间
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            TRANSITIONS.inc(provider=self.name, state=state)
+            logger.warning("[retry] circuit breaker of {} is {}".format(self.name, state))
+
+    # 是否允许发出请求
+    def allow(self):
+        now = time.monotonic()
+        open_seconds = conf().get("circuit_breaker_open_seconds", 30)
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if now - self.opened_at < open_seconds:
+                    return False
+                self._set_state(HALF_OPEN)
+            # 半开状态只放行一个探测请求，探测请求没有结果（比如被取消）时超过 open_seconds 再放行下一个
+            if self.probe_at is not None and now - self.probe_at < open_seconds:
+                return False
+            self.probe_at = now
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.probe_at = None
+            self._set_state(CLOSED)
+
+    # 请求的结果不能说明服务是否可用（客户端错误），半开状态下允许马上发出下一个探测请求
+    def neutral(self):
+        with self._lock:
+            self.probe_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= conf().get("circuit_breaker_failures", 5):
+                self.probe_at = None
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+
+class RetryPolicy:
+    def __init__(self, name):
+        self.name = name # 服务名称，用于指标和日志
+        self.breaker = CircuitBreaker(name)
+        self._budget = float(_BUDGET_BURST) # 启动后的第一批失败也可以重试
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    # 发出请求前调用，熔断器打开时返回 False，调用方直接返回错误。retry_count 为 0 的新请求积累重试额度
+    def allow(self, retry_count=0):
+        if retry_count == 0:
+            with self._lock:
+                self._refill(conf().get("retry_budget", 0.2))
+        if self.breaker.allow():
+            return True
+        REJECTED.inc(provider=self.name)
+        return False
+
+    def success(self):
+        self.breaker.success()
+
+    # 请求失败，error 为请求抛出的异常，客户端错误不计入熔断器（见 is_failure）
+    def failure(self, error=None):
+        if error is not None and not is_failure(error):
+            self.neutral()
+            return
+        self.breaker.failure()
+
+    # 请求因为客户端错误失败，不计入熔断器
+    def neutral(self):
+        self.breaker.neutral()
+
+    # 第 retry_count 次重试前等待的秒数
+    def backoff(self, retry_count, base):
+        delay = min(conf().get("retry_max_delay", 60), base * 2 ** retry_count)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    # 按时间积累固定的额度，再加上 amount，调用方必须已经持有 self._lock
+    def _refill(self, amount=0.0):
+        now = time.monotonic()
+        amount += (now - self._refilled_at) * conf().get("retry_min_per_second", 1)
+        self._budget = min(self._budget + amount, _BUDGET_BURST)
+        self._refilled_at = now
+
+    def _withdraw(self):
+        with self._lock:
+            self._refill()
+            if self._budget >= 1:
+                self._budget -= 1
+                return True
+        DROPPED.inc(provider=self.name)
+        logger.warning("[retry] retry budget of {} exhausted".format(self.name))
+        return False
+
+    # 等待后执行 call 重试并返回它的结果。重试额度用完时不重试，返回 fallback（bot 的错误结果）。
+    # 当前线程允许延后重试时抛出 RetryLater，不在线程中等待
+    def retry(self, retry_count, base, call, fallback, cancel_token=None):
+        if not self._withdraw():
+            return fallback
+        delay = self.backoff(retry_count, base)
+        logger.warning("[retry] {} retry {} after {:.1f}s".format(self.name, retry_count + 1, delay))
+        if deferring():
+            RETRIES.inc(provider=self.name, mode="deferred")
+            raise RetryLater(delay, call, cancel_token)
+        RETRIES.inc(provider=self.name, mode="inline")
+        cancellation.sleep(cancel_token, delay)
+        return call()
+
+    # retry 的异步版本，call 返回协程，等待时不占用线程
+    async def aretry(self, retry_count, base, call, fallback):
+        if not self._withdraw():
+            return fallback
+        delay = self.backoff(retry_count, base)
+        logger.warning("[retry] {} retry {} after {:.1f}s".format(self.name, retry_count + 1, delay))
+        RETRIES.inc(provider=self.name, mode="async")
+        await asyncio.sleep(delay)
+        return await call()
+
+
+# 异常是否说明服务不可用：超时、连接错误、5xx 和上游返回的 429。
+# 状态码从各个 SDK 的异常中读取：openai 的 http_status，anthropic 等的 status_code，aiohttp 的 status，requests 的 response.status_code。
+# 没有状态码的异常按类型名判断，openai 的 Timeout、APIConnectionError，requests 的 ConnectionError、ReadTimeout 等都属于这一类。
+# 本地限流抛出的 RateLimitError 没有状态码，不算失败
+def is_failure(error):
+    status = _status_code(error)
+    if status is not None:
+        return status >= 500 or status == 429
+    if isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    name = type(error).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def _status_code(error):
+    for status in (getattr(error, "http_status", None), getattr(error, "status_code", None), getattr(error, "status", None),
+                   getattr(getattr(error, "response", None), "status_code", None)):
+        if isinstance(status, int):
+            return status
+    return None
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+# 获取服务的重试策略，同一个服务的所有 bot 实例共用熔断器和重试额度
+def get_policy(name) -> RetryPolicy:
+    policy = _policies.get(name)
+    if policy is None:
+        with _policies_lock:
+            policy = _policies.setdefault(name, RetryPolicy(name))
+    return policy
+
+
+_local = threading.local()
+
+
+# 当前线程是否允许延后重试
+def deferring():
+    return getattr(_local, "deferring", False)
+
+
+# 在 with 块中允许（或禁止）延后重试
+class allow_defer:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+    def __enter__(self):
+        self.saved = deferring()
+        _local.deferring = self.enabled
+
+    def __exit__(self, exc_type, exc, tb):
+        _local.deferring = self.saved
+
+
+# 执行 fn 并用 after 处理结果。fn 抛出 RetryLater 时，重试的结果同样经过 after 处理
+def chain(fn, after):
+    try:
+        result = fn()
+    except RetryLater as e:
+        call = e.call
+        raise RetryLater(e.delay, lambda: chain(call, after), e.cancel_token)
+    return after(result)
+
+
+# 延后执行重试，返回重试最终结果的 future。重试再次需要等待时重新放入时间轮
+def defer(retry_later: RetryLater) -> Future:
+    future = Future()
+
+    def run(pending):
+        try:
+            cancellation.check(pending.cancel_token)
+            with allow_defer():
+                result = pending.call()
+        except RetryLater as again:
+            schedule(again)
+            return
+        except BaseException as e:
+            future.set_exception(e)
+            return
+        future.set_result(result)
+
+    def submit(pending):
+        try:
+            get_pool("llm").submit(run, pending)
+        except Full as e:
+            future.set_exception(e)
+
+    def schedule(pending):
+        timer_wheel.schedule(pending.delay, lambda: submit(pending))
+
+    schedule(retry_later)
+    return future
+
+
+# 返回 future 的结果经过 fn 处理后的 future
+def then(future: Future, fn) -> Future:
+    result = Future()
+
+    def done(f):
+        try:
+            result.set_result(fn(f.result()))
+        except BaseException as e:
+            result.set_exception(e)
+    future.add_done_callback(done)
+    return result
+
+
+def _collect_state():
+    return {(name,): _STATE_VALUES[policy.breaker.state] for name, policy in list(_policies.items())}
+
+
+metrics.gauge("circuit_breaker_state", "Circuit breaker state per provider (0 closed, 1 half-open, 2 open)", ["provider"], func=_collect_state)
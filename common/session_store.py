@@ -0,0 +1,260 @@
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from common import metrics
+from common.log import logger
+from config import conf
+
+# 会话存储：SessionManager 保存会话的字典（见 bot/session_manager.py），所有 bot 共用。
+# 内存中按 LRU 保存，会话数不超过 session_store_max_entries、估算的总大小不超过 session_store_max_bytes，
+# 超出时淘汰最久没有使用的会话；expires_in_seconds 秒没有使用的会话过期，每次写入时从最久没有使用的一端顺带清理，不需要等到再次访问。
+# 配置 session_store_path 后还会使用 sqlite 文件（WAL 模式）：内存中被淘汰的会话写入文件，下次收到消息时读回内存；
+# 退出时（SIGINT/SIGTERM）把内存中的会话全部写入文件，重启后会话仍然可以继续。没有配置时淘汰的会话直接丢弃。
+# 不同 bot 的会话用 namespace（会话类和模型）区分。会话使用 pickle 序列化。
+
+LOOKUPS = metrics.counter("session_store_lookups_total", "Session lookups by tier", ["result"])
+EVICTIONS = metrics.counter("session_store_evictions_total", "Sessions removed from memory", ["reason"])
+SPILLS = metrics.counter("session_store_spills_total", "Sessions written to the sqlite tier")
+
+_stores = weakref.WeakSet() # 所有的会话存储，用于统计和退出时写入文件
+# 每写入多少次清理一次 sqlite 中过期的会话
+_PURGE_EVERY = 1000
+
+
+class SessionStore:
+    def __init__(self, namespace, expires=0, max_entries=10000, max_bytes=64 * 1024 * 1024, path=""):
+        self.namespace = namespace
+        self.expires = expires # 会话过期的秒数，0 表示不过期
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._entries = OrderedDict() # session_id --> [会话, 估算大小, 过期时间]，按最近使用的顺序排列
+        self._bytes = 0
+        self._recent = None # 最近访问的会话，访问之后通常会被修改（加入消息），下次操作时重新估算大小
+        self._db = _open(path) if path else None
+        _stores.add(self)
+
+    def get(self, session_id, default=None):
+        now = time.time()
+        with self._lock:
+            self._refresh_recent()
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                if entry[2] > now:
+                    entry[2] = self._expire_at(now)
+                    self._entries.move_to_end(session_id)
+                    self._recent = session_id
+                    LOOKUPS.inc(result="hit_memory")
+                    return entry[0]
+                self._remove(session_id)
+                EVICTIONS.inc(reason="expired")
+            session = self._load(session_id, now)
+            if session is None:
+                LOOKUPS.inc(result="miss")
+                return default
+            LOOKUPS.inc(result="hit_disk")
+            self._put(session_id, session, now)
+            return session
+
+    def __getitem__(self, session_id):
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def __setitem__(self, session_id, session):
+        with self._lock:
+            self._refresh_recent()
+            self._put(session_id, session, time.time())
+
+    def __delitem__(self, session_id):
+        with self._lock:
+            found = session_id in self._entries
+            if found:
+                self._remove(session_id)
+            if self._db is not None:
+                found = self._execute("DELETE FROM sessions WHERE namespace = ? AND session_id = ?", (self.namespace, session_id)) or found
+            if not found:
+                raise KeyError(session_id)
+
+    def pop(self, session_id, default=None):
+        with self._lock:
+            session = self.get(session_id)
+            if session is None:
+                return default
+            del self[session_id]
+            return session
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._recent = None
+            if self._db is not None:
+                self._execute("DELETE FROM sessions WHERE namespace = ?", (self.namespace,))
+
+    # 把内存中的会话全部写入 sqlite，退出前调用
+    def flush(self):
+        if self._db is None:
+            return
+        with self._lock:
+            for session_id, entry in list(self._entries.items()):
+                self._spill(session_id, entry[0], entry[2])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes}
+
+    def _expire_at(self, now):
+        return now + self.expires if self.expires else float("inf")
+
+    # 写入内存并按 LRU 淘汰，调用方必须持有 self._lock
+    def _put(self, session_id, session, now):
+        if session_id in self._entries:
+            self._remove(session_id)
+        size = _size(session)
+        self._entries[session_id] = [session, size, self._expire_at(now)]
+        self._bytes += size
+        self._recent = session_id
+        # 最久没有使用的会话在前面，先清理过期的，再按数量和大小淘汰，刚写入的会话不会被淘汰
+        while len(self._entries) > 1:
+            oldest, (old_session, _, expire_at) = next(iter(self._entries.items()))
+            if expire_at <= now:
+                reason = "expired"
+            elif len(self._entries) > self.max_entries:
+                reason = "entries"
+            elif self._bytes > self.max_bytes:
+                reason = "bytes"
+            else:
+                break
+            self._remove(oldest)
+            EVICTIONS.inc(reason=reason)
+            if reason != "expired":
+                self._spill(oldest, old_session, expire_at)
+
+    def _remove(self, session_id):
+        entry = self._entries.pop(session_id)
+        self._bytes -= entry[1]
+        if self._recent == session_id:
+            self._recent = None
+
+    # 重新估算最近访问的会话的大小
+    def _refresh_recent(self):
+        entry = self._entries.get(self._recent) if self._recent is not None else None
+        if entry is not None:
+            size = _size(entry[0])
+            self._bytes += size - entry[1]
+            entry[1] = size
+
+    def _spill(self, session_id, session, expire_at):
+        if self._db is None:
+            return
+        try:
+            data = pickle.dumps(session)
+        except Exception as e:
+            logger.warning("[session_store] can not pickle session {}: {}".format(session_id, e))
+            return
+        if self._execute("INSERT OR REPLACE INTO sessions (namespace, session_id, expire_at, data) VALUES (?, ?, ?, ?)",
+                         (self.namespace, session_id, None if expire_at == float("inf") else expire_at, data)):
+            SPILLS.inc()
+
+    # 从 sqlite 读取会话，没有或者已过期时返回 None
+    def _load(self, session_id, now):
+        if self._db is None:
+            return None
+        with _db_lock:
+            try:
+                row = self._db.execute("SELECT expire_at, data FROM sessions WHERE namespace = ? AND session_id = ?",
+                                       (self.namespace, session_id)).fetchone()
+            except sqlite3.Error as e:
+                logger.warning("[session_store] read sqlite failed: {}".format(e))
+                return None
+        if row is None or (row[0] is not None and row[0] <= now):
+            return None
+        try:
+            return pickle.loads(row[1])
+        except Exception as e: # 会话类修改过，旧的数据无法读取时当作新会话
+            logger.warning("[session_store] can not load session {}: {}".format(session_id, e))
+            return None
+
+    # 执行写入语句，返回是否修改了记录
+    def _execute(self, sql, args):
+        global _writes
+        with _db_lock:
+            try:
+                changed = self._db.execute(sql, args).rowcount > 0
+                _writes += 1
+                if _writes % _PURGE_EVERY == 0:
+                    self._db.execute("DELETE FROM sessions WHERE expire_at <= ?", (time.time(),))
+                self._db.commit()
+                return changed
+            except sqlite3.Error as e:
+                logger.warning("[session_store] write sqlite failed: {}".format(e))
+                return False
+
+
+# 估算会话占用的内存（字节），只计算消息，消息之外的属性都很小
+def _size(session):
+    size = 512
+    for message in getattr(session, "messages", ()):
+        size += sys.getsizeof(message)
+        for value in message.values():
+            size += sys.getsizeof(value)
+    return size
+
+
+_connections = {} # path --> sqlite 连接，所有会话存储共用
+_db_lock = threading.Lock()
+_writes = 0
+
+
+def _open(path):
+    with _db_lock:
+        db = _connections.get(path)
+        if db is None:
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS sessions (namespace TEXT, session_id TEXT, expire_at REAL, data BLOB, "
+                       "PRIMARY KEY (namespace, session_id))")
+            db.commit()
+            _connections[path] = db
+        return db
+
+
+# 按配置创建会话存储
+def create_store(namespace) -> SessionStore:
+    return SessionStore(
+        namespace,
+        conf().get("expires_in_seconds", 0),
+        conf().get("session_store_max_entries", 10000),
+        conf().get("session_store_max_bytes", 64 * 1024 * 1024),
+        conf().get("session_store_path", ""),
+    )
+
+
+# 把所有会话存储中的会话写入 sqlite，退出时调用
+def flush_all():
+    for store in list(_stores):
+        try:
+            store.flush()
+        except Exception as e:
+            logger.warning("[session_store] flush {} failed: {}".format(store.namespace, e))
+
+
+def _collect(field):
+    return lambda: sum(store.stats()[field] for store in list(_stores))
+
+
+metrics.gauge("session_store_entries", "Sessions held in memory by all session stores", func=_collect("entries"))
+metrics.gauge("session_store_bytes", "Approximate size of the sessions held in memory", func=_collect("bytes"))
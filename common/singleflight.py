@@ -0,0 +1,126 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+
+from common import cancellation
+from common import metrics
+from common.cancellation import Cancelled
+
+# 合并相同的并发请求（single flight）：同一个 key 同时只有一个调用方（leader）真正执行，
+# 其他调用方（follower）等待 leader 的结果，leader 出错时 follower 收到同样的异常。
+# window 大于 0 时，leader 结束后的 window 秒内到达的相同请求也直接使用这个结果。
+# leader 的消息被取消（Cancelled）时，等待中的 follower 不受影响，重新发起请求。
+# follower 等待期间自己的消息被取消时立即结束等待。
+
+FLIGHTS = metrics.counter("singleflight_calls_total", "Calls through the single-flight layer", ["role"])
+
+_WAIT_INTERVAL = 0.5 # follower 检查取消的间隔（秒）
+
+
+class _Flight:
+    __slots__ = ("future", "done_at")
+
+    def __init__(self):
+        self.future = Future()
+        self.done_at = None # leader 结束的时间
+
+
+class SingleFlight:
+    def __init__(self, window=0):
+        self.window = window
+        self._lock = threading.Lock()
+        self._flights = {} # key --> _Flight，包含进行中的和 window 内结束的
+        self._finished = deque() # (结束时间, key)，按结束顺序清理过期的结果
+
+    # 加入 key 对应的请求，返回 (future, 是否是 leader)
+    def _join(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            flight = self._flights.get(key)
+            if flight is not None:
+                FLIGHTS.inc(role="follower")
+                return flight.future, False
+            flight = self._flights[key] = _Flight()
+            FLIGHTS.inc(role="leader")
+            return flight.future, True
+
+    # leader 结束，通知等待的 follower
+    def _finish(self, key, future, result=None, exception=None):
+        now = time.monotonic()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight.future is future:
+                if self.window > 0 and exception is None:
+                    flight.done_at = now
+                    self._finished.append((now, key))
+                else:
+                    del self._flights[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    # 清理 window 已过的结果，调用方必须持有 self._lock
+    def _purge(self, now):
+        while self._finished and now - self._finished[0][0] >= self.window:
+            done_at, key = self._finished.popleft()
+            flight = self._flights.get(key)
+            if flight is not None and flight.done_at == done_at:
+                del self._flights[key]
+
+    # 执行 fn 或者等待相同请求的结果，返回 (结果, 是否使用了其他调用方的结果)
+    def do(self, key, fn, cancel_token=None):
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                return self._lead(key, future, fn), False
+            try:
+                while True:
+                    try:
+                        return future.result(timeout=_WAIT_INTERVAL), True
+                    except TimeoutError:
+                        cancellation.check(cancel_token)
+            except Cancelled:
+                cancellation.check(cancel_token)
+                # leader 的消息被取消了，重新发起请求
+
+    def _lead(self, key, future, fn):
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    # do 的异步版本，fn 返回协程。follower 等待时不占用线程
+    async def ado(self, key, fn, cancel_token=None):
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                try:
+                    result = await fn()
+                except asyncio.CancelledError:
+                    self._finish(key, future, exception=Cancelled("leader cancelled")) # follower 重新发起请求
+                    raise
+                except BaseException as e:
+                    self._finish(key, future, exception=e)
+                    raise
+                self._finish(key, future, result)
+                return result, False
+            waiter = asyncio.wrap_future(future)
+            try:
+                while True:
+                    try:
+                        return await asyncio.wait_for(asyncio.shield(waiter), _WAIT_INTERVAL), True
+                    except asyncio.TimeoutError:
+                        cancellation.check(cancel_token)
+            except Cancelled:
+                cancellation.check(cancel_token)
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for flight in self._flights.values() if flight.done_at is None)
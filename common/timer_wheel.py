@@ -0,0 +1,105 @@
+import threading
+import time
+
+from common import metrics
+from common.log import logger
+
+# 时间轮（hashed timing wheel）：用一个后台线程管理所有延时任务，代替每个延时任务占用一个线程 sleep。
+# 时间轮分为 slots 个槽，每 tick 秒前进一格，到期时间超过一圈的任务记录剩余的圈数。
+# 添加和取消任务都是 O(1)，每 tick 只处理当前槽中的任务；没有任务时线程阻塞等待，不会空转。
+# 回调在时间轮的线程中执行，只应该做很轻的工作（比如把任务提交到线程池），耗时的工作会推迟其他任务。
+
+PENDING = metrics.gauge("timer_wheel_pending", "Timers waiting in the timer wheel", func=lambda: _wheel.pending() if _wheel else 0)
+
+
+class Timer:
+    __slots__ = ("fn", "rounds", "cancelled")
+
+    def __init__(self, fn, rounds):
+        self.fn = fn
+        self.rounds = rounds # 还要转几圈才到期
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self._cursor = 0 # 当前指向的槽
+        self._count = 0 # 等待中的任务数（包括已取消、还没有被清理的）
+        self._cond = threading.Condition()
+        self._thread = None
+
+    # delay 秒后在时间轮线程中执行 fn，返回可以 cancel 的 Timer
+    def schedule(self, delay, fn) -> Timer:
+        # 向上取整后再加一格：下一次前进可能就在眼前，只按 delay 计算格数最多会提前一格执行。
+        # 加一格之后不会提前执行，加上取整，最多推迟不到两格
+        ticks = max(1, int(delay / self.tick + 0.999999) + 1)
+        with self._cond:
+            timer = Timer(fn, (ticks - 1) // len(self.slots))
+            self.slots[(self._cursor + ticks) % len(self.slots)].append(timer)
+            self._count += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="timer-wheel", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return timer
+
+    def pending(self):
+        return self._count
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            with self._cond:
+                while self._count == 0: # 没有任务时等待，有新任务时从当前时间重新计时
+                    self._cond.wait()
+                    next_tick = time.monotonic() + self.tick
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_tick += self.tick
+            for timer in self._advance():
+                try:
+                    timer.fn()
+                except Exception as e:
+                    logger.exception("[timer_wheel] timer callback error: {}".format(e))
+
+    # 前进一格，返回到期的任务
+    def _advance(self):
+        with self._cond:
+            self._cursor = (self._cursor + 1) % len(self.slots)
+            slot = self.slots[self._cursor]
+            due, remain = [], []
+            for timer in slot:
+                if timer.cancelled:
+                    self._count -= 1
+                elif timer.rounds > 0:
+                    timer.rounds -= 1
+                    remain.append(timer)
+                else:
+                    self._count -= 1
+                    due.append(timer)
+            self.slots[self._cursor] = remain
+            return due
+
+
+_wheel = None
+_wheel_lock = threading.Lock()
+
+
+# 全局共用的时间轮
+def get_timer_wheel() -> TimerWheel:
+    global _wheel
+    if _wheel is None:
+        with _wheel_lock:
+            if _wheel is None:
+                _wheel = TimerWheel()
+    return _wheel
+
+
+def schedule(delay, fn) -> Timer:
+    return get_timer_wheel().schedule(delay, fn)
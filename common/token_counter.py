@@ -0,0 +1,76 @@
+from functools import lru_cache
+
+from common import const
+from common.log import logger
+
+# 计算会话消息的 token 数，所有会话类共用。
+# 每条消息的 token 数只在第一次计算时编码（见 bot/session_manager.py 的 Session.calc_tokens），
+# tiktoken 的编码器按模型缓存，不再每次计算都 import tiktoken 和查找编码器。
+# refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+
+# 使用 gpt-3.5-turbo 计数规则的模型
+_GPT35_MODELS = ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]
+# 使用 gpt-4 计数规则的模型
+_GPT4_MODELS = ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+                "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
+                "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
+                const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]
+
+
+# 按字符数估算 token 数的模型
+def by_character(model):
+    return model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI)
+
+
+# 模型使用的计数规则：gpt-3.5-turbo 或 gpt-4，其他模型按 gpt-3.5-turbo 计数
+@lru_cache(maxsize=None)
+def _rule(model):
+    if model == "gpt-4" or model in _GPT4_MODELS:
+        return "gpt-4"
+    if model != "gpt-3.5-turbo" and model not in _GPT35_MODELS and not model.startswith("claude-3"):
+        # 每个模型只提示一次
+        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+    return "gpt-3.5-turbo"
+
+
+# 模型的 tiktoken 编码器，按模型缓存。strict 为 False 时找不到模型的编码使用 cl100k_base
+@lru_cache(maxsize=None)
+def get_encoding(model, strict=False):
+    import tiktoken # 没有安装时在第一次使用时抛出异常，由调用方按不精确的方式处理
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        if strict:
+            raise
+        logger.debug("Warning: model not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# 单条消息的 token 数（不包括每次回复的固定开销，见 reply_tokens）
+def count_message(message, model):
+    if by_character(model):
+        return len(message["content"])
+    rule = _rule(model)
+    encoding = get_encoding(rule)
+    if rule == "gpt-3.5-turbo":
+        tokens_per_message = 4 # 每条消息有4个token的开销，格式为<|start|>{role/name}\n{content}<|end|>\n
+        tokens_per_name = -1 # 如果消息包含名称，则角色字段不再使用
+    else:
+        tokens_per_message = 3
+        tokens_per_name = 1 # 如果消息包含名称，角色字段需要1个额外的token
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
+# 每次回复固定的 token 开销：回复会被预先加上<|start|>的token
+def reply_tokens(model):
+    return 0 if by_character(model) else 3
+
+
+# 字符串的 token 数
+def count_string(string, model):
+    return len(get_encoding(model, strict=True).encode(string, disallowed_special=()))
@@ -0,0 +1,171 @@
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from common.log import logger
+from config import conf
+
+# 消息处理链路的耗时追踪。
+# 按 trace_sample_rate 的比例对收到的消息采样，被采样的消息会在 context["trace"] 中带上一个 Trace 对象，
+# 处理过程中各个阶段（构造 context、每个插件的事件处理、调用 bot、语音转换、装饰回复、发送）记录为一个 span，
+# 消息处理完成后整条记录以一行 JSON 的形式追加写入 trace_export_path。
+# 没有被采样的消息 span() 直接返回一个空操作对象，几乎没有额外开销。
+# 汇总导出文件中各阶段的 p50/p95/p99：python -m common.trace traces.jsonl
+
+
+class Trace:
+    __slots__ = ("trace_id", "msg_id", "session_id", "start", "spans", "_lock")
+
+    def __init__(self, msg_id=None):
+        self.trace_id = uuid.uuid4().hex
+        self.msg_id = msg_id
+        self.session_id = None
+        self.start = time.time()
+        self.spans = [] # [(阶段名称, 相对开始时间的毫秒数, 耗时毫秒数, 附加信息)]
+        self._lock = threading.Lock() # 不同阶段可能在不同的线程中记录
+
+    def add(self, name, start, end, **attrs):
+        with self._lock:
+            self.spans.append((name, (start - self.start) * 1000, (end - start) * 1000, attrs))
+
+    def to_dict(self, status):
+        return {
+            "trace_id": self.trace_id,
+            "msg_id": self.msg_id,
+            "session_id": self.session_id,
+            "start": self.start,
+            "duration_ms": round((time.time() - self.start) * 1000, 3),
+            "status": status,
+            "spans": [
+                dict(name=name, offset_ms=round(offset, 3), duration_ms=round(duration, 3), **attrs)
+                for name, offset, duration, attrs in self.spans
+            ],
+        }
+
+
+class _Span:
+    __slots__ = ("trace", "name", "attrs", "start")
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.trace.add(self.name, self.start, time.time(), **self.attrs)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+# 按采样率决定是否追踪这条消息，返回 Trace 对象，不追踪时返回 None
+def start_trace(msg_id=None):
+    rate = conf().get("trace_sample_rate", 0)
+    if not rate or random.random() >= rate:
+        return None
+    return Trace(msg_id)
+
+
+# 记录 context 中某个阶段的耗时，用法：with span(context, "send"): ...
+def span(context, name, **attrs):
+    trace = context.get("trace") if context is not None else None
+    if trace is None:
+        return _NOOP_SPAN
+    return _Span(trace, name, attrs)
+
+
+# 消息处理结束，导出 context 中的追踪记录
+def finish(context, status="ok"):
+    trace = context.get("trace") if context is not None else None
+    if trace is None:
+        return
+    if trace.session_id is None:
+        trace.session_id = context.get("session_id")
+    export(trace, status)
+
+
+_export_lock = threading.Lock()
+_export_file = None
+_export_path = None
+
+
+# 以 JSONL 格式追加写入追踪记录
+def export(trace: Trace, status="ok"):
+    global _export_file, _export_path
+    line = json.dumps(trace.to_dict(status), ensure_ascii=False)
+    path = conf().get("trace_export_path", "traces.jsonl")
+    with _export_lock:
+        try:
+            if _export_file is None or _export_path != path:
+                if _export_file is not None:
+                    _export_file.close()
+                _export_file = open(path, "a", encoding="utf-8")
+                _export_path = path
+            _export_file.write(line + "\n")
+            _export_file.flush()
+        except Exception as e:
+            logger.warning("[trace] export failed: {}".format(e))
+
+
+# 计算百分位数，values 必须已经排好序
+def _percentile(values, p):
+    if not values:
+        return 0
+    index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+# 汇总导出文件，返回 {阶段名称: {"count", "p50", "p95", "p99", "max"}}，"total" 为整条消息的处理耗时
+def summarize(path):
+    durations = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            durations.setdefault("total", []).append(record["duration_ms"])
+            for s in record.get("spans", []):
+                durations.setdefault(s["name"], []).append(s["duration_ms"])
+    result = {}
+    for name, values in durations.items():
+        values.sort()
+        result[name] = {
+            "count": len(values),
+            "p50": _percentile(values, 50),
+            "p95": _percentile(values, 95),
+            "p99": _percentile(values, 99),
+            "max": values[-1],
+        }
+    return result
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python -m common.trace <traces.jsonl>")
+        sys.exit(1)
+    stats = summarize(sys.argv[1])
+    width = max([len(name) for name in stats] + [5])
+    print("{:<{w}} {:>7} {:>10} {:>10} {:>10} {:>10}".format("stage", "count", "p50(ms)", "p95(ms)", "p99(ms)", "max(ms)", w=width))
+    for name, s in sorted(stats.items(), key=lambda item: -item[1]["p50"]):
+        print("{:<{w}} {:>7} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(name, s["count"], s["p50"], s["p95"], s["p99"], s["max"], w=width))
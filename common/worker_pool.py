@@ -0,0 +1,112 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full # 队列已满时抛出的异常，和 Dequeue 的 putleft 保持一致
+from config import conf
+from common.log import logger
+from common import metrics
+
+# 默认的线程池划分，按任务的负载类型隔离，避免慢的 LLM 请求把其他类型的任务也堵住
+# llm：调用大模型等网络请求，耗时长，占用线程多
+# media：语音转码等 CPU 密集型任务
+# send：回复的装饰和发送（包括发送失败时的重试等待）
+# hedge：开启对冲请求（hedge_requests）时每次请求的各个尝试，调用方在自己的线程中等待先成功的结果
+# compaction：开启会话压缩（conversation_compaction）时在后台生成对话摘要，排满时跳过这次压缩
+# max_queue 为 0 表示排队数量不设上限
+DEFAULT_POOLS = {
+    "llm": {"max_workers": 8, "max_queue": 0},
+    "media": {"max_workers": 2, "max_queue": 0},
+    "send": {"max_workers": 4, "max_queue": 0},
+    "hedge": {"max_workers": 8, "max_queue": 0},
+    "compaction": {"max_workers": 2, "max_queue": 100},
+}
+
+# 带有排队上限和使用率统计的线程池
+# 继承 ThreadPoolExecutor，因此 _shutdown、_initializer 等属性和原来的 handler_pool 用法保持兼容
+class WorkerPool(ThreadPoolExecutor):
+    def __init__(self, name, max_workers, max_queue=0):
+        super().__init__(max_workers=max_workers, thread_name_prefix="pool-" + name)
+        self.name = name # 线程池名称
+        self.max_workers = max_workers # 最大线程数
+        self.max_queue = max_queue # 最大排队任务数，0 表示不限制
+        self._stats_lock = threading.Lock() # 保护下面这些统计数据
+        self.queued = 0 # 已提交但还没开始执行的任务数
+        self.active = 0 # 正在执行的任务数
+        self.completed = 0 # 已执行完的任务数
+        self.rejected = 0 # 因为排队已满被拒绝的任务数
+
+    # 提交任务，如果排队的任务数已达上限则抛出 Full 异常
+    def submit(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            if self.max_queue > 0 and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise Full("worker pool {} is full".format(self.name))
+            self.queued += 1
+
+        def run():
+            with self._stats_lock: # 任务开始执行，从排队状态变为执行状态
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        future = super().submit(run)
+        future.add_done_callback(self._on_done)
+        return future
+
+    # 任务在开始执行前就被取消时，run 不会执行，需要在这里修正排队计数
+    def _on_done(self, future):
+        if future.cancelled():
+            with self._stats_lock:
+                self.queued -= 1
+
+    # 返回线程池当前的使用情况，用于观察和调整线程池大小
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "name": self.name,
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "active": self.active,
+                "queued": self.queued,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "utilization": round(self.active / self.max_workers, 3) if self.max_workers else 0,
+            }
+
+
+_pools = {} # 线程池名称 --> WorkerPool 实例
+_pools_lock = threading.Lock()
+
+# 获取指定名称的线程池，第一次使用时根据配置 worker_pools 创建
+# 配置示例: "worker_pools": {"llm": {"max_workers": 16, "max_queue": 200}}，没有配置的项使用 DEFAULT_POOLS 中的默认值
+def get_pool(name) -> WorkerPool:
+    pool = _pools.get(name)
+    if pool is not None:
+        return pool
+    with _pools_lock:
+        if name not in _pools:
+            setting = dict(DEFAULT_POOLS.get(name, DEFAULT_POOLS["llm"]))
+            setting.update((conf().get("worker_pools") or {}).get(name, {}))
+            _pools[name] = WorkerPool(name, int(setting.get("max_workers", 8)), int(setting.get("max_queue", 0)))
+            logger.info("[worker_pool] create pool {}: {}".format(name, setting))
+        return _pools[name]
+
+# 返回所有已创建线程池的使用情况
+def pool_stats() -> list:
+    return [pool.stats() for pool in list(_pools.values())]
+
+
+# 线程池的使用情况指标，每次采集时读取
+def _collect(field):
+    return lambda: {(stats["name"],): stats[field] for stats in pool_stats()}
+
+
+metrics.gauge("worker_pool_active", "Tasks running in the worker pool", ["pool"], func=_collect("active"))
+metrics.gauge("worker_pool_queued", "Tasks waiting in the worker pool", ["pool"], func=_collect("queued"))
+metrics.gauge("worker_pool_max_workers", "Maximum threads of the worker pool", ["pool"], func=_collect("max_workers"))
+metrics.counter("worker_pool_completed_total", "Tasks completed by the worker pool", ["pool"], func=_collect("completed"))
+metrics.counter("worker_pool_rejected_total", "Tasks rejected because the worker pool queue was full", ["pool"], func=_collect("rejected"))
@@ -47,16 +47,95 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    # 按负载类型划分的线程池配置，llm: 生成回复, media: 语音转码, send: 发送回复，例如 {"llm": {"max_workers": 16, "max_queue": 200}}
+    "worker_pools": {},
+    # 消息队列的过载保护，0 表示不限制
+    "max_queue_size_in_session": 0,  # 单个会话最多排队的消息数
+    "max_pending_messages": 0,  # 所有会话合计最多排队的消息数
+    "max_in_flight": 0,  # 所有会话合计最多同时处理的消息数
+    "queue_shed_policy": "drop_newest",  # 队列满时的处理策略，drop_oldest: 丢弃最早的消息, drop_newest: 丢弃新消息, busy_reply: 丢弃新消息并回复繁忙提示
+    "queue_busy_reply": "当前消息太多啦，请稍后再试",  # busy_reply 策略下回复的提示语
+    # 会话之间的公平调度：按权重轮流派发各会话的消息，群聊中所有成员的会话合计按一个群调度，管理命令优先派发
+    "fair_scheduling": True,  # 开启后没有配置 max_in_flight 时，同时生成回复的消息数不超过生成回复的线程数（发送和等待重试的消息不计入），其余消息在会话队列中按权重排队
+    "schedule_weight_private": 1.0,  # 私聊的调度权重
+    "schedule_weight_group": 1.0,  # 每个群的调度权重
+    "schedule_weight_admin": 2.0,  # 管理员会话的权重倍数
+    "schedule_channel_weights": {},  # 按通道类型设置的权重倍数，例如 {"wechatmp": 2.0}
+    "process_workers": 0,  # 生成回复的工作进程数，按会话分片，用于利用多核处理插件、token 计数、语音转换等 CPU 密集型任务，0 表示不使用多进程
+    "journal_path": "",  # 消息日志文件，记录接收的消息和处理结果，重启后重新处理没有完成的消息，为空表示不开启，例如 "journal.jsonl"
+    "journal_flush_interval": 0.05,  # 消息日志批量写入磁盘（fsync）的间隔（秒）
+    "journal_max_bytes": 16777216,  # 消息日志文件超过该大小时压缩，只保留没有完成的消息
+    "async_mode": False,  # 是否使用异步模式处理消息，开启后等待模型回复时不占用线程，需要安装aiohttp
+    "message_coalesce_window": 0,  # 连续消息合并的等待时间（秒），同一会话在该时间内连续发送的文本消息会合并成一条处理，0 表示不合并
+    "message_coalesce_max_length": 1000,  # 合并后消息的最大长度
+    "trace_sample_rate": 0,  # 消息处理耗时追踪的采样率，0~1，0 表示不追踪
+    "trace_export_path": "traces.jsonl",  # 追踪记录的导出文件，JSONL 格式，汇总：python -m common.trace traces.jsonl
+    "metrics_port": 0,  # Prometheus 格式监控指标的端口，访问 http://metrics_host:metrics_port/metrics，0 表示不开启
+    "metrics_host": "127.0.0.1",  # 监控指标服务监听的地址
+    # 各个模型、语音、翻译服务共用的 HTTP 客户端（见 common/http_client.py）
+    "http_timeout": [10, 300],  # 没有单独指定超时的请求使用的 [连接超时, 读取超时]（秒）
+    "http_pool_connections": 20,  # 最多缓存多少个 host 的连接池
+    "http_pool_maxsize": 20,  # 每个 host 最多保持的长连接数，建议不小于生成回复的线程数
+    # 流式回复：模型边生成边输出，终端和网页通道逐字显示，微信等通道按句子分段发送。支持的 bot：chatGPT、moonshot、minimax、智谱AI
+    "stream_reply": False,  # 是否开启流式回复，多进程模式（process_workers）下不生效
+    "stream_chunk_min_chars": 50,  # 按句子分段发送时每段至少的字符数，避免发送过多的短消息
+    # 回复缓存：相同的问题直接使用缓存的回复，不再调用模型（见 common/reply_cache.py）
+    "reply_cache": False,  # 是否开启回复缓存
+    "reply_cache_ttl": 3600,  # 缓存的有效期（秒）
+    "reply_cache_max_entries": 10000,  # 内存中最多缓存的回复数，超过时淘汰最久没有使用的
+    "reply_cache_max_bytes": 33554432,  # 内存中缓存的回复总大小上限
+    "reply_cache_path": "",  # sqlite 缓存文件，为空表示只缓存在内存中，例如 "reply_cache.db"
+    "reply_cache_history_turns": 0,  # 缓存 key 中包含最近几轮对话，为 0 时只根据问题本身缓存
+    "reply_cache_bypass_history": True,  # 会话中有缓存 key 之外的对话记录时不使用缓存，避免忽略上下文
+    "reply_cache_bypass_sessions": [],  # 不使用缓存的会话 id
+    "singleflight": False,  # 合并相同的并发请求（模型、API 密钥和完整的消息列表都相同），只调用一次模型；带图片、文件或 app_code 的请求不合并
+    "singleflight_window": 0,  # 请求结束后多少秒内到达的相同请求也使用它的结果，为 0 表示只合并同时进行的请求
+    # 多个聊天服务之间的路由和故障转移，至少配置两个时生效，每一项是 bot 类型或者 {"bot_type": ..., "model": ...}
+    "chat_providers": [],
+    "router_ewma_alpha": 0.3,  # 耗时和错误率的移动平均中最新一次请求的权重
+    "router_error_penalty": 5,  # 错误率对得分的影响，得分 = 平均耗时 * (1 + router_error_penalty * 错误率)
+    "router_failure_threshold": 3,  # 连续失败多少次后进入冷却
+    "router_cooldown": 30,  # 冷却的秒数，冷却中的服务排到最后
+    "router_max_attempts": 0,  # 每个请求最多尝试几个服务，0 表示全部
+    # 对冲请求：请求超过最近耗时的 hedge_percentile 分位数还没有返回时再发出一个相同的请求，使用先成功的结果
+    "hedge_requests": False,
+    "hedge_target": "same",  # same：发给同一个服务（ChatGPT、Moonshot），alternate：发给路由中排在第二的服务（需要配置 chat_providers）
+    "hedge_percentile": 95,
+    "hedge_delay": 10,  # 耗时样本不足 hedge_min_samples 个时，发出对冲请求前等待的秒数
+    "hedge_min_samples": 20,
+    "hedge_budget": 0.05,  # 对冲请求最多占请求数的比例
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    # 会话存储（见 common/session_store.py）：内存中按 LRU 淘汰，配置文件路径后淘汰的会话写入 sqlite，重启后仍然可以继续
+    "session_store_max_entries": 10000,  # 内存中最多保存的会话数
+    "session_store_max_bytes": 67108864,  # 内存中会话的总大小上限（估算）
+    "session_store_path": "",  # sqlite 文件，为空表示淘汰的会话直接丢弃，例如 "sessions.db"
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    # 会话压缩（见 common/compaction.py）：token 数达到阈值后在后台把较早的对话总结成一条摘要，代替直接丢弃最早的对话
+    "conversation_compaction": False,
+    "compaction_threshold": 0.8,  # 达到 conversation_max_tokens 的多少比例时开始压缩
+    "compaction_keep_messages": 4,  # 最近的多少条消息保持原样，不参与总结
+    "compaction_model": "gpt-4o-mini",  # 生成摘要的模型，使用 OpenAI 兼容的接口
+    "compaction_api_base": "",  # 为空时使用 open_ai_api_base
+    "compaction_api_key": "",  # 为空时使用 open_ai_api_key
+    "compaction_summary_max_tokens": 500,  # 摘要的最大 token 数
+    "compaction_timeout": 120,  # 生成摘要的超时秒数
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
+    # 按用户、群、模型、API 密钥限制每分钟的请求数和 token 数，例如 {"user": {"rpm": 10, "tpm": 20000}, "model": {"rpm": 500}}，
+    # 超出时消息延后处理，维度见 common/rate_limiter.py
+    "rate_limits": {},
+    # 调用模型接口的重试和熔断（见 common/retry.py）
+    "retry_budget": 0.2,  # 每个请求积累的重试额度，0.2 表示重试最多占请求数的 20%
+    "retry_min_per_second": 1,  # 不论请求量多少，每秒固定积累的重试额度，请求量小时也可以重试
+    "retry_max_delay": 60,  # 重试前最长等待的秒数
+    "circuit_breaker_failures": 5,  # 连续失败多少次后熔断，熔断期间请求直接返回错误
+    "circuit_breaker_open_seconds": 30,  # 熔断多少秒后放行一个探测请求
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
     "top_p": 1,
@@ -184,6 +263,8 @@ available_setting = {
 class Config(dict):
     def __init__(self, d=None):
         super().__init__()
+        # version: 配置的版本号，每次修改配置都会加一，用于判断根据配置构建的缓存（如 ContextMatcher）是否需要重新构建
+        self.version = 0
         if d is None:
             d = {}
         for k, v in d.items():
@@ -199,6 +280,7 @@ class Config(dict):
     def __setitem__(self, key, value):
         if key not in available_setting:
             raise Exception("key {} not in available_setting".format(key))
+        self.version += 1
         return super().__setitem__(key, value)
     # 返回键对应的值
     def get(self, key, default=None):
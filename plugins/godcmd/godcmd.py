@@ -131,6 +131,10 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "pools": {
+        "alias": ["pools", "线程池"],
+        "desc": "查看消息处理线程池的使用情况",
+    },
 }
 
 
@@ -330,6 +334,7 @@ class Godcmd(Plugin):
                         cmd = next(c for c, info in ADMIN_COMMANDS.items() if cmd in info["alias"])
                         if cmd == "stop":
                             self.isrunning = False
+                            channel.cancel_all_session() # 取消正在处理和排队的消息，暂停后不再发出回复
                             ok, result = True, "服务已暂停"
                         elif cmd == "resume":
                             self.isrunning = True
@@ -352,6 +357,15 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "pools":
+                            from common.worker_pool import pool_stats
+                            ok = True
+                            result = "线程池使用情况：\n"
+                            for stats in pool_stats():
+                                result += "{name}: 执行中 {active}/{max_workers}, 排队 {queued}, 已完成 {completed}, 拒绝 {rejected}\n".format(**stats)
+                            if hasattr(channel, "queue_stats"):
+                                stats = channel.queue_stats()
+                                result += "消息队列：会话 {sessions}, 排队 {queued}, 处理中 {in_flight}, 丢弃 {shed}\n".format(**stats)
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
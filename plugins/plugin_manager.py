@@ -6,6 +6,7 @@ import json
 import os
 import sys
 
+from common import trace
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
@@ -252,6 +253,13 @@ class PluginManager: # 插件管理
             if name.upper() not in self.plugins:
                 logger.error("Plugin %s not found, but found in plugins.json" % name)
         self.activate_plugins() # 为所有插件创建实例,绑定事件监听
+    # 是否有启用的插件监听其中任意一个事件
+    def has_listeners(self, *events):
+        for event in events:
+            for name in self.listening_plugins.get(event, []):
+                if self.plugins[name].enabled:
+                    return True
+        return False
     # 这段代码的作用是 触发（发出）一个事件，并根据该事件去调用所有 监听 该事件的插件的处理函数。代码通过 emit_event 方法实现了 事件驱动 的
     # 机制，其中插件系统根据事件上下文 (e_context) 来判断哪些插件可以响应该事件，并执行相应的处理函数。
     # e_context: EventContext：e_context 是事件上下文，包含了与事件相关的各种信息，如事件名、事件的状态、是否停止事件传播等。
@@ -276,7 +284,8 @@ class PluginManager: # 插件管理
                     instance = self.instances[name] # 获取当前插件实例
                     # 获取当前插件实例对该事件的处理函数。handlers 是一个字典，其中键是事件名，值是事件对应的处理函数。
                     # 调用处理函数，并将事件上下文（e_context）和其他参数传递给它。
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
+                    with trace.span(e_context.econtext.get("context"), "plugin.{}.{}".format(e_context.event.name, name)):
+                        instance.handlers[e_context.event](e_context, *args, **kwargs)
                     # 因为在调用插件的处理函数时,有可能改变e_context的事件行为,这里检查e_context的事件行为
                     # 如果被打断,就在e_context中设置个属性,记录是哪个插件打断的,之后打印日志,返回e_context
                     # 因为在事件行为is_break的情况下,e_context.action == EventAction.CONTINUE这个条件不成立
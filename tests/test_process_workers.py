@@ -0,0 +1,84 @@
+import multiprocessing
+import threading
+import unittest
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from channel import process_workers
+from common.cancellation import CancelToken
+
+
+class _MainChannel:
+    def __init__(self):
+        self.sent = []
+        self.cancelled = []
+        self.done = threading.Event()
+
+    def _send(self, reply, context, retry_cnt=0):
+        self.sent.append((reply, context))
+        self.done.set()
+
+    def cancel_session(self, session_id):
+        self.cancelled.append(session_id)
+
+    def cancel_all_session(self):
+        self.cancelled.append(None)
+
+
+# 不启动工作进程，用一对 Pipe 连接工作进程中的通道和主进程的收集逻辑
+class WorkerSendTest(unittest.TestCase):
+    def setUp(self):
+        self.main_conn, self.worker_conn = multiprocessing.Pipe()
+        self.main_channel = _MainChannel()
+        self.workers = object.__new__(process_workers.ProcessWorkers)
+        self.workers.channel_ref = lambda: self.main_channel
+        self.workers.contexts = {}
+        self.worker = process_workers._Worker(0)
+        self.worker.conn = self.main_conn
+        info = {"channel_type": "terminal", "name": "bot", "user_id": "bot", "not_support_replytype": []}
+        self.worker_channel = process_workers._worker_channel(info, self.worker_conn)
+
+    def tearDown(self):
+        self.main_conn.close()
+        self.worker_conn.close()
+
+    def _worker_context(self, task_id):
+        # 和工作进程中插件拿到的 context 一样，带有工作进程创建的 cancel_token
+        context = Context(ContextType.TEXT, "hello", {"session_id": "s1", "worker_task_id": task_id})
+        context["cancel_token"] = CancelToken()
+        context["channel"] = self.worker_channel
+        return context
+
+    def test_send_round_trip(self):
+        original = Context(ContextType.TEXT, "hello", {"session_id": "s1"})
+        self.workers.contexts[7] = original
+        reply = Reply(ReplyType.TEXT, "from plugin")
+        self.worker_channel.send(reply, self._worker_context(7))
+        self.assertTrue(self.main_conn.poll(5)) # 回复不能序列化时工作进程会丢弃它
+        self.assertTrue(self.workers._receive(self.worker))
+        self.assertTrue(self.main_channel.done.wait(5))
+        sent_reply, sent_context = self.main_channel.sent[0]
+        self.assertEqual(sent_reply.content, "from plugin")
+        self.assertIs(sent_context, original) # 主进程使用原始的 context 发送
+
+    def test_send_accepts_retry_cnt(self):
+        self.worker_channel.send(Reply(ReplyType.TEXT, "retry"), self._worker_context(8), 1)
+        self.assertTrue(self.main_conn.poll(5)) # 回复不能序列化时工作进程会丢弃它
+        self.assertTrue(self.workers._receive(self.worker))
+        self.assertTrue(self.main_channel.done.wait(5))
+        sent_reply, sent_context = self.main_channel.sent[0]
+        self.assertEqual(sent_reply.content, "retry")
+        self.assertNotIn("cancel_token", sent_context) # 主进程中没有原始的 context 时使用去掉不能传递字段的副本
+        self.assertEqual(sent_context["session_id"], "s1")
+
+    def test_cancel_session_forwarded_to_main(self):
+        self.worker_channel.cancel_session("s1")
+        self.worker_channel.cancel_all_session()
+        for _ in range(2):
+            self.assertTrue(self.main_conn.poll(5))
+            self.assertTrue(self.workers._receive(self.worker))
+        self.assertEqual(self.main_channel.cancelled, ["s1", None])
+
+
+if __name__ == "__main__":
+    unittest.main()
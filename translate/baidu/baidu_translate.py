@@ -2,7 +2,7 @@
 import random
 from hashlib import md5
 
-import requests
+from common import http_client
 
 from config import conf
 from translate.translator import Translator
@@ -40,7 +40,7 @@ class BaiduTranslator(Translator):
         # 因为连续3次超时时,会退出循环,但是其实没有返回翻译结果,所以后面要判断一下
         while retry_cnt:
             # 发送 POST 请求到百度翻译 API
-            r = requests.post(self.url, params=payload, headers=headers)
+            r = http_client.post(self.url, params=payload, headers=headers)
             result = r.json() # 解析 JSON 响应
             # 获取返回的错误码（默认为 "52000"）
             errcode = result.get("error_code", "52000")
@@ -3,7 +3,7 @@
 import http.client
 import json
 import time
-import requests
+from common import http_client
 import datetime
 import hashlib
 import hmac
@@ -28,9 +28,9 @@ def text_to_speech_aliyun(url, text, appkey, token):
         "token": token,
         "format": "wav"
     }
-    # json.dumps(data) 会将一个 Python 字典（如 data）转换为 JSON 字符串。requests.post 方法将这个 JSON 字符串
+    # json.dumps(data) 会将一个 Python 字典（如 data）转换为 JSON 字符串。http_client.post 方法将这个 JSON 字符串
     # 作为请求的主体 (data) 发送到服务器。
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = http_client.post(url, headers=headers, data=json.dumps(data))
     if response.status_code == 200 and response.headers['Content-Type'] == 'audio/mpeg':
         # 要保存的声音文件临时路径
         output_file = TmpDir().path() + "reply-" + str(int(time.time())) + "-" + str(hash(text) & 0x7FFFFFFF) + ".wav"
@@ -170,7 +170,7 @@ class AliyunTokenGenerator:
         params['Signature'] = signature
         # 将请求参数字典转换为URL查询字符串，并构造完整的请求URL。
         url = 'http://nls-meta.cn-shanghai.aliyuncs.com/?' + urllib.parse.urlencode(params)
-        # 使用 requests.get 发送HTTP GET请求。
-        response = requests.get(url)
+        # 使用共享的 HTTP 客户端发送HTTP GET请求。
+        response = http_client.get(url)
         # 返回请求的响应内容，即阿里云返回的认证令牌信息。
         return response.text
\ No newline at end of file
@@ -1,5 +1,5 @@
 import random # 导入random模块，用于生成随机数
-import requests # 导入requests模块，用于发送HTTP请求
+from common import http_client
 from voice import audio_convert # 从voice模块中导入audio_convert，用于音频文件转换
 from bridge.reply import Reply, ReplyType # 从bridge模块中导入Reply类和ReplyType枚举，用于构建回复对象
 from common.log import logger # 从common.log模块中导入logger对象，用于记录日志
@@ -40,7 +40,7 @@ class LinkAIVoice(Voice): # 定义继承自Voice类的LinkAIVoice类，用于语
                 "model": model # 配置使用的语音识别模型
             }
             # 发送POST请求到API进行语音识别
-            res = requests.post(url, files=file_body, headers=headers, data=data, timeout=(5, 60))
+            res = http_client.post(url, files=file_body, headers=headers, data=data, timeout=(5, 60))
             if res.status_code == 200: # 如果请求成功（状态码200）
                 text = res.json().get("text") # 获取返回的文本结果
             else:
@@ -70,7 +70,7 @@ class LinkAIVoice(Voice): # 定义继承自Voice类的LinkAIVoice类，用于语
                 "app_code": conf().get("linkai_app_code") # 应用代码
             }
             # 发送POST请求到API进行文本转语音
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 120))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 120))
             if res.status_code == 200:  # 如果请求成功（状态码200）
                 # 生成一个临时文件名，并保存语音文件
                 tmp_file_name = "tmp/" + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + str(random.randint(0, 1000)) + ".mp3"
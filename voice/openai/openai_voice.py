@@ -6,7 +6,7 @@ from bridge.reply import Reply, ReplyType # 引入回复类型和回复类
 from common.log import logger  # 引入日志模块
 from config import conf # 引入配置
 from voice.voice import Voice  # 引入语音相关的父类
-import requests # 引入HTTP请求库
+from common import http_client
 from common import const # 引入常量定义
 import datetime, random # 引入日期时间和随机数模块
 
@@ -31,7 +31,7 @@ class OpenaiVoice(Voice):
                 "model": "whisper-1",  # 使用Whisper模型进行转录
             }
             # 发起HTTP POST请求，传递文件和参数
-            response = requests.post(url, headers=headers, files=files, data=data)
+            response = http_client.post(url, headers=headers, files=files, data=data, proxy=True)
             response_data = response.json() # 获取响应数据并转换为JSON格式
             text = response_data['text']  # 从响应数据中提取转录的文本
             reply = Reply(ReplyType.TEXT, text)  # 创建文本类型的回复对象
@@ -56,7 +56,7 @@ class OpenaiVoice(Voice):
                 'voice': conf().get("tts_voice_id") or "alloy"  # 语音ID，默认为"alloy"
             }
             # 发起HTTP POST请求，传递JSON数据
-            response = requests.post(url, headers=headers, json=data)
+            response = http_client.post(url, headers=headers, json=data, proxy=True)
             # 构造文件名，保存生成的语音文件
             file_name = "tmp/" + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + str(random.randint(0, 1000)) + ".mp3"
             logger.debug(f"[OPENAI] text_to_Voice file_name={file_name}, input={text}")  # 输出调试日志，记录生成的语音文件名